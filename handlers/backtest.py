@@ -0,0 +1,26 @@
+import asyncio
+import logging
+from telegram import Update
+from telegram.ext import ContextTypes
+from services.backtest import backtester
+
+logger = logging.getLogger(__name__)
+
+async def comando_backtest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Comando: /backtest
+    Mide el error de las sugerencias de precio contra los cierres reales
+    y compara reglas alternativas. Devuelve el detalle en un CSV.
+    """
+    msg = await update.message.reply_text("🧪 Reproduciendo historial de sugerencias...")
+
+    try:
+        archivo, resumen = await asyncio.to_thread(backtester.generar_reporte)
+    except Exception as e:
+        logger.error(f"Error en backtest: {e}")
+        await msg.edit_text(f"❌ Error ejecutando el backtest: {e}")
+        return
+
+    await msg.edit_text(resumen, parse_mode="HTML")
+    if archivo:
+        await update.message.reply_document(document=archivo, caption="📄 Métricas por regla y estrategia")
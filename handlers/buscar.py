@@ -0,0 +1,63 @@
+import html
+import asyncio
+from telegram import Update
+from telegram.ext import ContextTypes
+from services.buscador_productos import buscador_productos
+
+MAX_PRODUCTOS = 5
+MAX_CLIENTES = 5
+MAX_ORDENES = 5
+LIMITE_MENSAJE = 4000
+ICONOS_FUENTE = {"ventas": "🧾", "komet": "📥", "reglas": "📦"}
+
+
+def _bloque_producto(ficha: dict) -> str:
+    fuentes = " ".join(ICONOS_FUENTE.get(f, f) for f in ficha["fuentes"])
+    lineas = [f"🌸 <b>{html.escape(ficha['nombre'])}</b> {fuentes}"]
+
+    # Último precio por cliente, del más reciente al más viejo
+    precios = sorted(ficha["precios"].items(), key=lambda p: p[1][0], reverse=True)
+    for cliente, (fecha, precio, po) in precios[:MAX_CLIENTES]:
+        lineas.append(f"   👤 {html.escape(cliente)}: ${precio:,.3f} ({fecha or '¿?'} · <code>{html.escape(po)}</code>)")
+    if len(precios) > MAX_CLIENTES:
+        lineas.append(f"   <i>… y {len(precios) - MAX_CLIENTES} clientes más</i>")
+
+    sin_precio = [c for c in ficha["reglas"] if c not in ficha["precios"]]
+    if sin_precio:
+        lineas.append(f"   📦 Con regla de empaque: {html.escape(', '.join(sin_precio[:MAX_CLIENTES]))}")
+
+    for fecha, po, cliente, fuente in ficha["ordenes"][:MAX_ORDENES]:
+        if po:
+            lineas.append(f"   {ICONOS_FUENTE.get(fuente, '•')} <code>{html.escape(po)}</code> {fecha} {html.escape(cliente or '')}")
+    return "\n".join(lineas)
+
+
+async def comando_buscar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Comando: /buscar <texto>
+    Productos por nombre ('freedom 50', 'mondial white') con sus clientes, últimos precios y órdenes.
+    Sale del índice en memoria: no toca la DB.
+    """
+    texto = " ".join(context.args or []).strip()
+    if not texto:
+        await update.message.reply_text("🔤 Uso: /buscar <producto>  (Ej: /buscar freedom 50)")
+        return
+
+    fichas = await asyncio.to_thread(buscador_productos.buscar, texto, MAX_PRODUCTOS)
+    if fichas is None:
+        await update.message.reply_text("⏳ El buscador de productos aún se está cargando. Intenta en un momento.")
+        return
+    if not fichas:
+        await update.message.reply_text(f"🤷 Ningún producto coincide con «{texto}».")
+        return
+
+    aviso = "" if fichas[0]["completa"] else "\n<i>Sin coincidencia completa; se muestran las más parecidas.</i>"
+    encabezado = f"🔤 <b>Productos para «{html.escape(texto)}»</b>{aviso}\n\n"
+    mensaje = encabezado
+    for ficha in fichas:
+        bloque = _bloque_producto(ficha) + "\n\n"
+        # Se corta por producto completo: partir una etiqueta HTML rompe el mensaje
+        if len(mensaje) + len(bloque) > LIMITE_MENSAJE:
+            break
+        mensaje += bloque
+    await update.message.reply_text(mensaje.strip(), parse_mode="HTML")
@@ -1,11 +1,26 @@
-import os
-from telegram import Update
+import io
+import re
+import time
+import asyncio
+import logging
+from datetime import datetime
+from telegram import Update, InputMediaDocument
 from telegram.ext import ContextTypes
 from services.generador_pdf import generador_documentos
+from services.orquestador import orquestador, MAX_POS_LOTE
+from services.facturacion_lote import facturador_lote
+from services.eventos import emitir, FACTURAS_EMITIDAS
+
+logger = logging.getLogger(__name__)
+
+MAX_POS_ALBUM = 5          # Hasta 5 POs (10 PDFs) van como álbum; más, en un .zip
+INTERVALO_PROGRESO = 2.0   # Segundos mínimos entre ediciones del mensaje de progreso
+_FECHA = re.compile(r"^\d{4}-\d{2}-\d{2}$")
 
 async def comando_generar_factura(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Genera Factura (Cliente) y PO (Finca).
+    Una sola lectura de la orden; los dos PDFs se dibujan en paralelo y viajan desde memoria.
     """
     if not context.args:
         await update.message.reply_text("⚠️ Uso: `/factura P12345`", parse_mode="Markdown")
@@ -14,30 +29,120 @@ async def comando_generar_factura(update: Update, context: ContextTypes.DEFAULT_
     po_number = context.args[0].strip().upper()
     await update.message.reply_text(f"⚙️ Generando documentos para <b>{po_number}</b>...", parse_mode="HTML")
 
-    # Nombres de archivo
-    file_factura = f"Factura_{po_number}.pdf"
-    file_po = f"PO_Finca_{po_number}.pdf"
+    try:
+        paquete = await asyncio.to_thread(generador_documentos.obtener_paquete, po_number)
+        if not paquete:
+            await update.message.reply_text(f"❌ PO no encontrada: {po_number}")
+            return
+        pdf_factura, pdf_po = await facturador_lote.renderizar_uno(paquete)
+    except Exception as e:
+        logger.error(f"Error generando documentos de {po_number}: {e}")
+        await update.message.reply_text(f"❌ Error generando docs: {e}")
+        return
+
+    seguro = po_number.replace("/", "-")
+    # Enviar Factura
+    await update.message.reply_document(
+        document=io.BytesIO(pdf_factura),
+        filename=f"Factura_{seguro}.pdf",
+        caption=f"💵 Factura para el Cliente ({po_number})"
+    )
+    # Enviar PO
+    await update.message.reply_document(
+        document=io.BytesIO(pdf_po),
+        filename=f"PO_Finca_{seguro}.pdf",
+        caption=f"🚜 Orden para la Finca ({po_number})\n<i>(Sin precios de venta)</i>",
+        parse_mode="HTML"
+    )
 
-    # 1. Generar Factura Cliente
-    ok1, msg1 = generador_documentos.generar_factura_cliente(po_number, file_factura)
-    # 2. Generar PO Finca
-    ok2, msg2 = generador_documentos.generar_po_finca(po_number, file_po)
+    # Solo refresca el tablero de /pendientes: generar el PDF no asigna invoice_id,
+    # así que la orden sigue pendiente hasta que se registre su factura
+    emitir(FACTURAS_EMITIDAS, po_numbers=[po_number])
 
-    if ok1 and ok2:
-        # Enviar Factura
-        await update.message.reply_document(
-            document=open(file_factura, 'rb'),
-            caption=f"💵 Factura para el Cliente ({po_number})"
-        )
-        # Enviar PO
-        await update.message.reply_document(
-            document=open(file_po, 'rb'),
-            caption=f"🚜 Orden para la Finca ({po_number})\n<i>(Sin precios de venta)</i>",
-            parse_mode="HTML"
+
+def _leer_argumentos(texto: str):
+    """
+    '/facturar_FLORES_MIA 2025-11-01 2025-11-30' | '/facturar MEXT' | '/facturar 2025-11-01'
+    -> (cliente | None, desde | None, hasta | None)
+    """
+    partes = (texto or "").split()
+    comando = partes[0].split("@")[0] if partes else ""
+    cliente = comando[len("/facturar_"):] if comando.startswith("/facturar_") else None
+
+    fechas, resto = [], []
+    for p in partes[1:]:
+        (fechas if _FECHA.match(p) else resto).append(p)
+    if not cliente and resto:
+        cliente = "_".join(resto)
+    desde = fechas[0] if fechas else None
+    hasta = fechas[1] if len(fechas) > 1 else None
+    return cliente or None, desde, hasta
+
+async def comando_facturar_lote(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Comando: /facturar_<CLIENTE> [desde] [hasta]  (el atajo que imprime /pendientes)
+             /facturar <CLIENTE|desde> [desde] [hasta]
+    Todas las POs confirmadas sin factura del cliente y/o rango de fechas:
+    facturas + POs de finca en un álbum o en un .zip.
+    """
+    cliente, desde, hasta = _leer_argumentos(update.message.text)
+    if not cliente and not desde:
+        await update.message.reply_text(
+            "⚠️ Uso: `/facturar_CLIENTE [desde] [hasta]` o `/facturar 2025-11-01 2025-11-30`",
+            parse_mode="Markdown"
         )
-        
-        # Limpieza
-        os.remove(file_factura)
-        os.remove(file_po)
+        return
+
+    filtro = " | ".join(x for x in (cliente, f"{desde or '…'} → {hasta or '…'}" if desde else None) if x)
+    msg = await update.message.reply_text(f"🔎 Buscando POs pendientes: <b>{filtro}</b>...", parse_mode="HTML")
+
+    try:
+        ordenes, total = await asyncio.to_thread(orquestador.ordenes_pendientes, cliente, desde, hasta)
+        if not ordenes:
+            await msg.edit_text(f"📭 No hay POs pendientes de facturar para <b>{filtro}</b>.", parse_mode="HTML")
+            return
+        paquetes = await asyncio.to_thread(generador_documentos.obtener_datos_lote, ordenes)
+    except Exception as e:
+        logger.error(f"Error leyendo lote de facturación: {e}")
+        await msg.edit_text(f"❌ Error leyendo las órdenes: {e}")
+        return
+
+    ultimo = [0.0]
+
+    async def al_avanzar(hechos, total):
+        if hechos < total and time.monotonic() - ultimo[0] < INTERVALO_PROGRESO:
+            return
+        ultimo[0] = time.monotonic()
+        try:
+            await msg.edit_text(f"🖨 Dibujando documentos... {hechos}/{total} POs")
+        except Exception:
+            pass   # Un 'message is not modified' o un límite de Telegram no detiene el lote
+
+    documentos, errores = await facturador_lote.renderizar(paquetes, al_avanzar)
+    if not documentos:
+        await msg.edit_text(f"❌ No se pudo generar ningún documento ({len(errores)} errores).")
+        return
+
+    if len(documentos) <= MAX_POS_ALBUM:
+        album = []
+        for po_number, factura, po_finca in documentos:
+            seguro = str(po_number).replace("/", "-")
+            album.append(InputMediaDocument(io.BytesIO(factura), filename=f"Factura_{seguro}.pdf"))
+            album.append(InputMediaDocument(io.BytesIO(po_finca), filename=f"PO_Finca_{seguro}.pdf"))
+        await update.message.reply_media_group(media=album)
     else:
-        await update.message.reply_text(f"❌ Error generando docs: {msg1} // {msg2}")
+        nombre = f"Facturas_{(cliente or 'rango').replace('/', '-')}_{datetime.now().strftime('%Y%m%d_%H%M')}.zip"
+        archivo = await asyncio.to_thread(facturador_lote.empaquetar_zip, documentos, nombre)
+        await update.message.reply_document(document=archivo, caption=f"📦 {len(documentos)} facturas + POs de finca")
+
+    resumen = f"✅ {len(documentos)} POs facturadas."
+    if total > len(ordenes):
+        resumen += (
+            f"\n⚠️ Solo se tomaron las primeras {len(ordenes)} de {total} POs pendientes "
+            f"(límite {MAX_POS_LOTE}). Acota con fechas para el resto."
+        )
+    if errores:
+        resumen += "\n⚠️ Fallaron: " + ", ".join(str(po) for po, _ in errores[:10])
+    await msg.edit_text(resumen)
+
+    emitir(FACTURAS_EMITIDAS, po_numbers=[d[0] for d in documentos])
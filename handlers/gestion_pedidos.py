@@ -1,24 +1,35 @@
+import asyncio
+import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from services.motor_ventas import GestorPrediccionVentas
+from services.motor_ventas import GestorPrediccionVentas, ZONA_NEGOCIO
 from services.calculadora import calculadora 
+from services.renderizador import renderizador
+from services.enrutador import enrutador, comprimir_id, expandir_id, SEPARADOR
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
 # Instanciamos el servicio de negocio
 gestor_ventas = GestorPrediccionVentas()
 
 # --- NUEVO: COMANDO RUTINA (Fase 3) ---
+ITEMS_RUTINA = 10
+
 async def comando_rutina_diaria(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Comando: /rutina
-    Busca qué clientes deberían comprar hoy.
+    Comando: /rutina  |  /rutina all
+    Busca qué clientes deberían comprar hoy (servido desde el cronograma precalculado).
+    Con 'all' genera de una vez las propuestas de todo el día para revisarlas en lote.
     """
-    await update.message.reply_text("📅 <b>Consultando el Cronograma Maestro...</b>", parse_mode="HTML")
+    oportunidades = await asyncio.to_thread(gestor_ventas.buscar_oportunidades_del_dia)
 
-    oportunidades = gestor_ventas.buscar_oportunidades_del_dia()
+    if oportunidades and context.args and context.args[0].lower() in ("all", "todos"):
+        await _rutina_en_lote(update, context, oportunidades)
+        return
 
     if not oportunidades:
-        dia_hoy = datetime.now().strftime('%A')
+        dia_hoy = datetime.now(ZONA_NEGOCIO).strftime('%A')
         await update.message.reply_text(
             f"😴 <b>Todo tranquilo por hoy ({dia_hoy}).</b>\n"
             f"No encontré Standing Orders programadas para este día.",
@@ -26,47 +37,222 @@ async def comando_rutina_diaria(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return
 
+    texto, teclado = _pintar_rutina(oportunidades, 0)
+    await renderizador.enviar(update.message, texto, reply_markup=teclado, parse_mode="HTML")
+
+@enrutador.ruta("ru")
+async def ruta_rutina_pagina(update: Update, context: ContextTypes.DEFAULT_TYPE, pagina: str):
+    oportunidades = await asyncio.to_thread(gestor_ventas.buscar_oportunidades_del_dia)
+    texto, teclado = _pintar_rutina(oportunidades, int(pagina))
+    await renderizador.editar(update.callback_query, texto, reply_markup=teclado, parse_mode="HTML")
+
+def _pintar_rutina(oportunidades: list, pagina: int):
+    total_paginas = max(1, -(-len(oportunidades) // ITEMS_RUTINA))
+    pagina = min(max(pagina, 0), total_paginas - 1)
+    inicio = pagina * ITEMS_RUTINA
+
     keyboard = []
-    resumen_texto = f"⚡ <b>Oportunidades Detectadas para Hoy:</b>\n\n"
+    resumen_texto = (
+        f"⚡ <b>Oportunidades Detectadas para Hoy:</b> {len(oportunidades)}\n"
+        f"<i>Pág {pagina + 1}/{total_paginas}</i>\n\n"
+    )
 
-    for op in oportunidades[:10]: 
+    for op in oportunidades[inicio:inicio + ITEMS_RUTINA]:
         cliente = op['cliente']
-        producto = op.get('producto_ejemplo', 'Producto Varios')
         caja = op.get('caja_tipica', 'QB')
         
-        resumen_texto += f"🔹 <b>{cliente}</b> (Suele pedir {caja})\n"
+        resumen_texto += (
+            f"🔹 <b>{cliente}</b> (Suele pedir {caja})\n"
+            f"   └ {op.get('total_productos', 1)} productos | 💰 ~${op.get('valor_esperado', 0):,.2f}\n"
+        )
         
         # Botón mágico que simula escribir /sugerir CLIENTE
         keyboard.append([
-            InlineKeyboardButton(f"🚀 Atender a {cliente}", callback_data=f"auto_{cliente}")
+            InlineKeyboardButton(f"🚀 Atender a {cliente}", callback_data=enrutador.datos("au", cliente))
         ])
 
+    nav = []
+    if pagina > 0:
+        nav.append(InlineKeyboardButton("⬅️", callback_data=enrutador.datos("ru", pagina - 1)))
+    if pagina < total_paginas - 1:
+        nav.append(InlineKeyboardButton("➡️", callback_data=enrutador.datos("ru", pagina + 1)))
+    if nav:
+        keyboard.append(nav)
+
     resumen_texto += "\n<i>Selecciona un cliente para generar su orden:</i>"
-    
-    await update.message.reply_text(resumen_texto, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
+    return resumen_texto, InlineKeyboardMarkup(keyboard)
+
+async def preparar_cronograma(context: ContextTypes.DEFAULT_TYPE):
+    """Job diario (RUTINA_HORA): deja listo el cronograma antes de que llegue el equipo."""
+    oportunidades = await asyncio.to_thread(gestor_ventas.reconstruir_cronograma)
+    logger.info(f"📅 Cronograma del día listo: {len(oportunidades)} oportunidades.")
+
+# --- RUTINA EN LOTE (/rutina all) ---
+ITEMS_LOTE = 5
+ICONOS_LOTE = {"pendiente": "⏳", "aprobada": "✅", "saltada": "⏭️", "creando": "⚙️", "creada": "🆔", "error": "❌"}
+
+async def _rutina_en_lote(update: Update, context: ContextTypes.DEFAULT_TYPE, oportunidades: list):
+    aviso = await update.message.reply_text(
+        f"🧠 Generando {len(oportunidades)} propuestas en paralelo...", parse_mode="HTML"
+    )
+
+    codigos = [op['cliente'] for op in oportunidades]
+    resultados = await asyncio.to_thread(gestor_ventas.generar_sugerencias_lote, codigos)
+
+    context.user_data['lote_rutina'] = [
+        {
+            "codigo": codigo,
+            "pred_id": pred_id,
+            "sugerencia": sugerencia,
+            "estado": "pendiente" if pred_id else "error",
+            "po": None,
+        }
+        for codigo, (pred_id, sugerencia) in zip(codigos, resultados)
+    ]
+
+    texto, teclado = _pintar_lote(context.user_data['lote_rutina'], 0)
+    await aviso.delete()
+    await renderizador.enviar(update.message, texto, reply_markup=teclado, parse_mode="HTML")
+
+def _pintar_lote(lote: list, pagina: int):
+    total_paginas = max(1, -(-len(lote) // ITEMS_LOTE))
+    pagina = min(max(pagina, 0), total_paginas - 1)
+    inicio = pagina * ITEMS_LOTE
+    aprobadas = sum(1 for it in lote if it['estado'] == "aprobada")
+
+    texto = (
+        f"📋 <b>Revisión en Lote</b> ({len(lote)} clientes)\n"
+        f"<i>Pág {pagina + 1}/{total_paginas} | Aprobadas: {aprobadas}</i>\n"
+        f"━━━━━━━━━━━━━━━━━━━━━━\n"
+    )
+    keyboard = []
+
+    for idx in range(inicio, min(inicio + ITEMS_LOTE, len(lote))):
+        it = lote[idx]
+        sug = it['sugerencia']
+        icono = ICONOS_LOTE[it['estado']]
+
+        if it['estado'] == "error":
+            texto += f"{icono} <b>{it['codigo']}</b>: {sug.get('error')}\n\n"
+            continue
+
+        logistica = sug.get('logistica', {})
+        texto += (
+            f"{icono} <b>{it['codigo']}</b> | {sug.get('estrategia_aplicada')}\n"
+            f"   └ 🌺 {sug['producto_objetivo']} | 📦 {logistica.get('tipo_caja')} | 💵 ${sug['precio_unitario']}\n"
+        )
+        if it['po']:
+            texto += f"   └ PO <code>{it['po']}</code>\n"
+        texto += "\n"
+
+        if it['estado'] in ("pendiente", "aprobada", "saltada"):
+            keyboard.append([
+                InlineKeyboardButton(f"✅ {it['codigo']}", callback_data=enrutador.datos("la", idx)),
+                InlineKeyboardButton("⏭️ Saltar", callback_data=enrutador.datos("ls", idx)),
+            ])
+
+    nav = []
+    if pagina > 0:
+        nav.append(InlineKeyboardButton("⬅️", callback_data=enrutador.datos("lp", pagina - 1)))
+    if pagina < total_paginas - 1:
+        nav.append(InlineKeyboardButton("➡️", callback_data=enrutador.datos("lp", pagina + 1)))
+    if nav:
+        keyboard.append(nav)
+    if aprobadas:
+        keyboard.append([InlineKeyboardButton(f"🚀 Crear {aprobadas} órdenes", callback_data=enrutador.datos("lc", pagina))])
+
+    return texto, InlineKeyboardMarkup(keyboard)
+
+async def _repintar_lote(update: Update, context: ContextTypes.DEFAULT_TYPE, pagina: int):
+    lote = context.user_data.get('lote_rutina')
+    if not lote:
+        await renderizador.editar(update.callback_query, "⚠️ Sesión expirada. Vuelve a usar /rutina all.")
+        return
+    texto, teclado = _pintar_lote(lote, pagina)
+    await renderizador.editar(update.callback_query, texto, reply_markup=teclado, parse_mode="HTML")
+
+@enrutador.ruta("lp")
+async def ruta_lote_pagina(update: Update, context: ContextTypes.DEFAULT_TYPE, pagina: str):
+    await _repintar_lote(update, context, int(pagina))
+
+@enrutador.ruta("la")
+async def ruta_lote_aprobar(update: Update, context: ContextTypes.DEFAULT_TYPE, idx: str):
+    await _marcar_lote(update, context, int(idx), "aprobada")
+
+@enrutador.ruta("ls")
+async def ruta_lote_saltar(update: Update, context: ContextTypes.DEFAULT_TYPE, idx: str):
+    await _marcar_lote(update, context, int(idx), "saltada")
+
+async def _marcar_lote(update: Update, context: ContextTypes.DEFAULT_TYPE, idx: int, estado: str):
+    lote = context.user_data.get('lote_rutina') or []
+    if 0 <= idx < len(lote) and lote[idx]['estado'] in ("pendiente", "aprobada", "saltada"):
+        lote[idx]['estado'] = estado
+    await _repintar_lote(update, context, idx // ITEMS_LOTE)
+
+@enrutador.ruta("lc")
+async def ruta_lote_confirmar(update: Update, context: ContextTypes.DEFAULT_TYPE, pagina: str):
+    lote = context.user_data.get('lote_rutina') or []
+    aprobadas = [it for it in lote if it['estado'] == "aprobada"]
+    if not aprobadas:
+        await _repintar_lote(update, context, int(pagina))
+        return
+
+    # Antes del primer await: un doble toque en "lc" ya no ve aprobadas y no crea todo dos veces
+    for it in aprobadas:
+        it['estado'] = "creando"
+
+    await renderizador.responder(update.callback_query, f"⚙️ Creando {len(aprobadas)} órdenes...")
+    datos = [d for d, _ in _armar_datos_lineas([(it['sugerencia'], 1) for it in aprobadas])]
+    pos = await asyncio.to_thread(gestor_ventas.crear_ordenes_lote, datos)
+
+    for it, po in zip(aprobadas, pos):
+        it['po'] = po
+        it['estado'] = "creada" if po else "error"
+        if not po:
+            it['sugerencia'] = {**it['sugerencia'], "error": "No se pudo guardar la PO."}
+
+    await _repintar_lote(update, context, int(pagina))
 
 # --- COMANDOS EXISTENTES (Fase 1 y 2) ---
 
 async def comando_sugerir_pedido(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        await update.message.reply_text(
+        await update.effective_message.reply_text(
             "⚠️ <b>Error de Sintaxis</b>\nPor favor ingrese el código del cliente.\nEjemplo: <code>/sugerir MEXT</code>",
             parse_mode="HTML"
         )
         return
 
     codigo_cliente = context.args[0].upper().strip()
-    await update.message.reply_text(f"🧠 Consultando memoria para: <b>{codigo_cliente}</b>...", parse_mode="HTML")
+    await update.effective_message.reply_text(f"🧠 Consultando memoria para: <b>{codigo_cliente}</b>...", parse_mode="HTML")
 
-    pred_id, sugerencia = gestor_ventas.generar_sugerencia_pedido(codigo_cliente)
+    # El motor hace I/O bloqueante: lo sacamos del event loop
+    pred_id, sugerencia = await asyncio.to_thread(gestor_ventas.generar_sugerencia_pedido, codigo_cliente)
 
     if not pred_id:
-        await update.message.reply_text(f"❌ Error: {sugerencia.get('error')}")
+        await update.effective_message.reply_text(f"❌ Error: {sugerencia.get('error')}")
         return
 
     context.user_data['sugerencia_actual'] = sugerencia
+    context.user_data['carrito'] = {
+        "pred_id": pred_id,
+        "sugerencia": sugerencia,
+        # Solo la línea de la propuesta tiene auditoría (prediction_history) que corregir
+        "lineas": [{"sug": sugerencia, "cajas": 1, "auditada": True}],
+    }
+    context.user_data['carrito_esperando'] = False
+
+    texto, teclado = _pintar_carrito(context.user_data['carrito'])
+    await renderizador.enviar(update.effective_message, texto, reply_markup=teclado, parse_mode="HTML")
+
+# --- CARRITO MULTILÍNEA (/sugerir) ---
+MAX_LINEAS_CARRITO = 10
+
+def _pintar_carrito(carrito: dict):
+    sugerencia = carrito['sugerencia']
     logistica = sugerencia.get('logistica', {})
-    
+    token_pred = comprimir_id(carrito['pred_id'])
+
     texto = (
         f"📋 <b>Propuesta de Pedido</b>\n"
         f"━━━━━━━━━━━━━━━━━━━━━━\n"
@@ -78,103 +264,229 @@ async def comando_sugerir_pedido(update: Update, context: ContextTypes.DEFAULT_T
         f"   • Config: {logistica.get('ramos_x_caja')} ramos x {logistica.get('tallos_x_ramo')} tallos\n"
         f"   • Marca: <i>{logistica.get('marcacion')}</i>\n"
         f"━━━━━━━━━━━━━━━━━━━━━━\n"
-        f"¿Procedemos?"
+        f"🛒 <b>Líneas del Pedido:</b>\n"
     )
 
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Confirmar (1 Caja)", callback_data=f"aprob_{pred_id}"),
-            InlineKeyboardButton("📝 Ajustar Precio", callback_data=f"ajust_{pred_id}")
-        ],
-        [InlineKeyboardButton("❌ Cancelar", callback_data=f"cancel_{pred_id}")]
-    ]
-    
-    await update.message.reply_text(texto, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
+    keyboard = []
+    total_cajas, total_valor = 0, 0.0
+    armadas = _armar_datos_lineas([(l['sug'], l['cajas']) for l in carrito['lineas']])
+    for idx, (linea, (_, resultado)) in enumerate(zip(carrito['lineas'], armadas)):
+        sug, cajas = linea['sug'], linea['cajas']
+        caja = sug.get('logistica', {}).get('tipo_caja')
+        total_cajas += cajas
+        total_valor += resultado['valor_total']
+        texto += f"{idx + 1}. {sug['producto_objetivo']} | {cajas}x{caja} | ${sug['precio_unitario']} → <b>${resultado['valor_total']}</b>\n"
+        keyboard.append([
+            InlineKeyboardButton("➖", callback_data=enrutador.datos("pq", token_pred, idx, -1)),
+            InlineKeyboardButton(f"{idx + 1}: {cajas} {caja}", callback_data=enrutador.datos("pq", token_pred, idx, 0)),
+            InlineKeyboardButton("➕", callback_data=enrutador.datos("pq", token_pred, idx, 1)),
+            InlineKeyboardButton("📝", callback_data=enrutador.datos("pj", token_pred, idx)),
+            InlineKeyboardButton("🗑️", callback_data=enrutador.datos("px", token_pred, idx)),
+        ])
 
-async def procesar_callback_pedido(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer() 
+    texto += f"━━━━━━━━━━━━━━━━━━━━━━\n💰 <b>Total:</b> {total_cajas} cajas | ${total_valor:,.2f}\n¿Procedemos?"
+
+    if len(carrito['lineas']) < MAX_LINEAS_CARRITO:
+        keyboard.append([InlineKeyboardButton("➕ Otro Producto", callback_data=enrutador.datos("pt", token_pred))])
+    if carrito['lineas']:
+        keyboard.append([InlineKeyboardButton(f"✅ Confirmar ({total_cajas} Cajas)", callback_data=enrutador.datos("pa", token_pred))])
+    keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data=enrutador.datos("pc", token_pred))])
+    return texto, InlineKeyboardMarkup(keyboard)
+
+def _carrito_vigente(context: ContextTypes.DEFAULT_TYPE, token_pred: str):
+    """El carrito solo responde a los botones de su propia propuesta."""
+    carrito = context.user_data.get('carrito')
+    if carrito and carrito['pred_id'] == expandir_id(token_pred):
+        return carrito
+    return None
+
+async def _repintar_carrito(update: Update, carrito: dict):
+    texto, teclado = _pintar_carrito(carrito)
+    await renderizador.editar(update.callback_query, texto, reply_markup=teclado, parse_mode="HTML")
+
+# --- RUTAS DE BOTONES ---
+@enrutador.ruta("au")
+async def ruta_auto_cliente(update: Update, context: ContextTypes.DEFAULT_TYPE, *partes: str):
+    # El código de cliente viaja completo aunque traiga ':' o '_' dentro
+    context.args = [SEPARADOR.join(partes)]
+    await comando_sugerir_pedido(update, context)
 
-    data = query.data
+@enrutador.ruta("pq")
+async def ruta_carrito_cantidad(update: Update, context: ContextTypes.DEFAULT_TYPE, token_pred: str, idx: str, delta: str):
+    carrito = _carrito_vigente(context, token_pred)
+    if not carrito:
+        await renderizador.editar(update.callback_query, "⚠️ Sesión expirada. Vuelve a usar /sugerir.")
+        return
+    idx = int(idx)
+    if 0 <= idx < len(carrito['lineas']):
+        linea = carrito['lineas'][idx]
+        linea['cajas'] = max(1, linea['cajas'] + int(delta))
+    await _repintar_carrito(update, carrito)
+
+@enrutador.ruta("px")
+async def ruta_carrito_quitar(update: Update, context: ContextTypes.DEFAULT_TYPE, token_pred: str, idx: str):
+    carrito = _carrito_vigente(context, token_pred)
+    if not carrito:
+        await renderizador.editar(update.callback_query, "⚠️ Sesión expirada. Vuelve a usar /sugerir.")
+        return
+    idx = int(idx)
+    if 0 <= idx < len(carrito['lineas']):
+        carrito['lineas'].pop(idx)
+        # Los índices se corren: un ajuste de precio pendiente apuntaría a otra línea
+        context.user_data['prediccion_activa_id'] = None
+    await _repintar_carrito(update, carrito)
+
+@enrutador.ruta("pt")
+async def ruta_carrito_agregar(update: Update, context: ContextTypes.DEFAULT_TYPE, token_pred: str):
+    if not _carrito_vigente(context, token_pred):
+        await renderizador.editar(update.callback_query, "⚠️ Sesión expirada. Vuelve a usar /sugerir.")
+        return
+    context.user_data['carrito_esperando'] = True
+    context.user_data['prediccion_activa_id'] = None
+    await renderizador.responder(update.callback_query)
+    await update.callback_query.message.reply_text(
+        "➕ Escribe el producto, cajas y (opcional) precio:\n<i>Rosa Freedom 50cm, 2, 0.40</i>",
+        parse_mode="HTML"
+    )
 
-    # --- ENRUTADOR FASE 3 ---
-    if data.startswith("auto_"):
-        cliente_code = data.split("_")[1]
-        context.args = [cliente_code] 
-        await comando_sugerir_pedido(update, context)
+async def recibir_linea_carrito(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    carrito = context.user_data.get('carrito')
+    context.user_data['carrito_esperando'] = False
+    if not carrito:
+        await update.message.reply_text("⚠️ Sesión expirada. Vuelve a usar /sugerir.")
         return
 
+    partes = [p.strip() for p in update.message.text.replace(";", ",").split(",")]
     try:
-        accion, pred_id = data.split("_")
-    except: return
+        producto = partes[0]
+        cajas = int(partes[1]) if len(partes) > 1 and partes[1] else 1
+        precio = float(partes[2]) if len(partes) > 2 and partes[2] else None
+        if not producto or cajas < 1:
+            raise ValueError
+    except ValueError:
+        context.user_data['carrito_esperando'] = True
+        await update.message.reply_text("⚠️ Formato: <i>Producto, cajas, precio</i>", parse_mode="HTML")
+        return
 
-    if accion == "aprob":
-        sugerencia = context.user_data.get('sugerencia_actual')
-        
-        if not sugerencia:
-            await query.edit_message_text("⚠️ Sesión expirada. Vuelve a usar /sugerir.")
-            return
+    codigo = carrito['sugerencia']['codigo_interno']
+    linea = await asyncio.to_thread(gestor_ventas.armar_linea_adicional, codigo, producto, precio)
+    if linea.get('error'):
+        context.user_data['carrito_esperando'] = True
+        await update.message.reply_text(f"⚠️ {linea['error']}", parse_mode="HTML")
+        return
 
-        logistica = sugerencia.get('logistica', {})
-        
-        # Datos reales aprendidos
-        cantidad = 1 
-        tipo_caja = logistica.get('tipo_caja', 'QB')
-        tallos_ramo = int(logistica.get('tallos_x_ramo', 25))
-        ramos_caja = int(logistica.get('ramos_x_caja', 10))
-        
-        factor_map = {'EB': 8, 'QB': 4, 'HB': 2}
-        factor = factor_map.get(tipo_caja, 4)
-        ramos_full_teorico = ramos_caja * factor 
+    carrito['lineas'].append({"sug": linea, "cajas": cajas})
+    texto, teclado = _pintar_carrito(carrito)
+    await renderizador.enviar(update.message, texto, reply_markup=teclado, parse_mode="HTML")
 
-        precio = float(sugerencia['precio_unitario'])
-        
-        # 1. Matemática
-        resultado = calculadora.calcular_linea_pedido(
-            cantidad_cajas=cantidad,
-            tipo_caja=tipo_caja,
-            tallos_por_ramo=tallos_ramo,
-            ramos_por_caja_full=ramos_full_teorico,
-            precio_unitario=precio
+@enrutador.ruta("pa")
+async def ruta_aprobar(update: Update, context: ContextTypes.DEFAULT_TYPE, token_pred: str):
+    query = update.callback_query
+    carrito = _carrito_vigente(context, token_pred)
+    
+    if not carrito or not carrito['lineas']:
+        await renderizador.editar(query, "⚠️ Sesión expirada. Vuelve a usar /sugerir.")
+        return
+    if carrito.get('creando'):
+        # Doble toque en "pa" mientras se guarda: una sola PO
+        await renderizador.responder(query, "⏳ La orden ya se está creando...")
+        return
+
+    carrito['creando'] = True
+    armadas = _armar_datos_lineas([(l['sug'], l['cajas']) for l in carrito['lineas']])
+    try:
+        po_nuevo = await asyncio.to_thread(gestor_ventas.crear_orden_multilinea, [datos for datos, _ in armadas])
+    finally:
+        carrito['creando'] = False
+    
+    # 3. Respuesta
+    if po_nuevo:
+        context.user_data['carrito'] = None
+        msg = (
+            f"✅ <b>Orden Creada con Éxito</b>\n"
+            f"━━━━━━━━━━━━━━━━━━━━━━\n"
+            f"🆔 <b>PO:</b> <code>{po_nuevo}</code>\n"
         )
-        
-        # 2. DB Insert
+        for linea, (_, resultado) in zip(carrito['lineas'], armadas):
+            msg += (
+                f"📦 {linea['sug']['producto_objetivo']}: {resultado['meta_data']}"
+                f" | 🏷️ {linea['sug'].get('logistica', {}).get('marcacion')}\n"
+            )
+        msg += (
+            f"💰 <b>Total:</b> ${sum(r['valor_total'] for _, r in armadas):,.2f} USD\n"
+            f"━━━━━━━━━━━━━━━━━━━━━━\n"
+        )
+    else:
+        msg = "❌ Error crítico guardando PO."
+
+    await renderizador.editar(query, msg, parse_mode="HTML")
+
+def _armar_datos_lineas(lineas: list) -> list:
+    """
+    Convierte sugerencias en (datos_db, resultado_calculadora) listos para crear la orden.
+    [(sugerencia, cajas)] -> [(datos_db, resultado)] con UNA llamada vectorizada a la calculadora.
+    Sirve igual para una línea, un carrito o un lote de /rutina all.
+    """
+    if not lineas:
+        return []
+    logisticas = [sug.get('logistica', {}) for sug, _ in lineas]
+
+    # Datos reales aprendidos
+    tipos = [l.get('tipo_caja', 'QB') for l in logisticas]
+    tallos_ramo = [int(l.get('tallos_x_ramo', 25)) for l in logisticas]
+    ramos_full = [calculadora.ramos_caja_full(t, int(l.get('ramos_x_caja', 10))) for t, l in zip(tipos, logisticas)]
+    cajas = [int(c) for _, c in lineas]
+    precios = [float(sug['precio_unitario']) for sug, _ in lineas]
+
+    # 1. Matemática (todas las líneas de una vez)
+    lote = calculadora.calcular_lote(cajas, tipos, tallos_ramo, ramos_full, precios)
+
+    salida = []
+    for i, (sug, _) in enumerate(lineas):
+        resultado = {
+            "total_tallos": int(lote['total_tallos'][i]),
+            "total_ramos": int(lote['total_ramos'][i]),
+            "ramos_por_caja": int(lote['ramos_por_caja'][i]),
+            "valor_total": float(lote['valor_total'][i]),
+            "meta_data": f"{cajas[i]} x {tipos[i]} ({int(lote['ramos_por_caja'][i])} bch/box)"
+        }
+        # 2. Datos para la DB
         datos_db = {
-            "producto_descripcion": sugerencia['producto_objetivo'],
-            "cajas": cantidad,
-            "tipo_caja": tipo_caja,
+            "producto_descripcion": sug['producto_objetivo'],
+            "cajas": cajas[i],
+            "tipo_caja": tipos[i],
             "total_tallos": resultado['total_tallos'],
-            "precio_unitario": precio,
-            "cliente_nombre": sugerencia['codigo_interno'],
+            "precio_unitario": precios[i],
+            "cliente_nombre": sug['codigo_interno'],
             "vendor": "BM",
             "valor_total_pedido": resultado['valor_total'],
-            "marcacion": logistica.get('marcacion')
+            "marcacion": logisticas[i].get('marcacion')
         }
-        
-        po_nuevo = gestor_ventas.crear_orden_confirmada(datos_db)
-        
-        # 3. Respuesta
-        if po_nuevo:
-            msg = (
-                f"✅ <b>Orden Creada con Éxito</b>\n"
-                f"━━━━━━━━━━━━━━━━━━━━━━\n"
-                f"🆔 <b>PO:</b> <code>{po_nuevo}</code>\n"
-                f"📦 <b>Config:</b> {resultado['meta_data']}\n"
-                f"🏷️ <b>Marca:</b> {logistica.get('marcacion')}\n"
-                f"💰 <b>Total:</b> ${resultado['valor_total']} USD\n"
-                f"━━━━━━━━━━━━━━━━━━━━━━\n"
-            )
-        else:
-            msg = "❌ Error crítico guardando PO."
-
-        await query.edit_message_text(msg, parse_mode="HTML")
+        salida.append((datos_db, resultado))
+    return salida
 
-    elif accion == "ajust":
-        context.user_data['prediccion_activa_id'] = pred_id
-        await query.edit_message_text("📝 Escribe el nuevo precio (ej: 0.45):", parse_mode="HTML")
+@enrutador.ruta("pj")
+async def ruta_ajustar(update: Update, context: ContextTypes.DEFAULT_TYPE, token_pred: str, idx: str):
+    carrito = _carrito_vigente(context, token_pred)
+    idx = int(idx)
+    if not carrito or not 0 <= idx < len(carrito['lineas']):
+        await renderizador.editar(update.callback_query, "⚠️ Sesión expirada. Vuelve a usar /sugerir.")
+        return
+    context.user_data['prediccion_activa_id'] = carrito['pred_id']
+    context.user_data['ajuste_linea'] = idx
+    context.user_data['carrito_esperando'] = False
+    producto = carrito['lineas'][idx]['sug']['producto_objetivo']
+    await renderizador.editar(
+        update.callback_query,
+        f"📝 Escribe el nuevo precio para la línea {idx + 1} (<i>{producto}</i>), ej: 0.45:",
+        parse_mode="HTML"
+    )
 
-    elif accion == "cancel":
-        await query.edit_message_text("❌ Cancelado.")
+@enrutador.ruta("pc")
+async def ruta_cancelar(update: Update, context: ContextTypes.DEFAULT_TYPE, token_pred: str):
+    if _carrito_vigente(context, token_pred):
+        context.user_data['carrito'] = None
+    await renderizador.editar(update.callback_query, "❌ Cancelado.")
 
 async def recibir_ajuste_precio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pred_id = context.user_data.get('prediccion_activa_id')
@@ -186,14 +498,21 @@ async def recibir_ajuste_precio(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("⚠️ Número inválido.")
         return
 
-    if context.user_data.get('sugerencia_actual'):
-        context.user_data['sugerencia_actual']['precio_unitario'] = precio
+    context.user_data['prediccion_activa_id'] = None
+    idx = context.user_data.pop('ajuste_linea', None)
+    carrito = context.user_data.get('carrito')
+    if not carrito or carrito['pred_id'] != pred_id or idx is None or not 0 <= idx < len(carrito['lineas']):
+        await update.message.reply_text("⚠️ Sesión expirada. Vuelve a usar /sugerir.")
+        return
 
-    if gestor_ventas.registrar_ajuste_usuario(pred_id, precio):
-        await update.message.reply_text(
-            f"💾 Precio ajustado a <b>${precio}</b>.\nSi deseas confirmar la orden con este precio, vuelve a usar /sugerir (por ahora).",
-            parse_mode="HTML"
-        )
-        context.user_data['prediccion_activa_id'] = None
-    else:
-        await update.message.reply_text("❌ Error guardando ajuste.")
+    # Copia: la cabecera del carrito sigue mostrando la propuesta original del bot
+    linea = carrito['lineas'][idx]
+    linea['sug'] = {**linea['sug'], 'precio_unitario': precio}
+
+    aviso = f"💾 Línea {idx + 1}: precio ajustado a <b>${precio}</b>."
+    # Puede esperar a que aterrice el INSERT de la auditoría: fuera del event loop
+    if linea.get('auditada') and not await asyncio.to_thread(gestor_ventas.registrar_ajuste_usuario, pred_id, precio):
+        aviso += "\n⚠️ No se pudo guardar el ajuste en la auditoría."
+    texto, teclado = _pintar_carrito(carrito)
+    await update.message.reply_text(aviso, parse_mode="HTML")
+    await renderizador.enviar(update.message, texto, reply_markup=teclado, parse_mode="HTML")
@@ -1,71 +1,173 @@
-from telegram import Update
+import html
+import secrets
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from services.cliente_supabase import db_client, logger
+from services.cliente_supabase import logger
+from services.consulta_po import consulta_po, MAX_POS_CONSULTA, FUENTES
+from services.indice_busqueda import indice_busqueda
+from services.enrutador import enrutador
+from services.renderizador import renderizador
+
+LIMITE_PAGINA = 3500       # Telegram corta en 4096; se deja aire para el pie de página
+MAX_REPORTES_ABIERTOS = 10
+
+ETIQUETAS = {"orden": "🧾 Orden", "komet": "🛰 Komet", "legado": "📜 Legado"}
+TIPOS_PO = {"po", "po_komet", "awb", "hawb", "invoice"}
+
+def _quisiste_decir(faltantes: list) -> str:
+    """'¿Quisiste decir?' desde el índice en memoria (vacío si no está cargado o no hay parecidos)."""
+    lineas = []
+    for pedida in faltantes[:5]:
+        candidatos = indice_busqueda.buscar(pedida, limite=3, tipos=TIPOS_PO) or []
+        opciones = []
+        for c in candidatos:
+            destino = c["po"] or c["valor"]
+            if destino.upper() == pedida:
+                continue
+            origen = "" if c["tipo"] in ("po", "po_komet") else f"{c['tipo'].upper()} {html.escape(c['valor'])} → "
+            opciones.append(f"{origen}<code>/po {html.escape(destino)}</code>")
+        if opciones:
+            lineas.append(f"🤔 <b>{html.escape(pedida)}</b>: ¿quisiste decir " + " · ".join(dict.fromkeys(opciones)) + "?")
+    return "\n".join(lineas)
+
+def _bloques_po(po_number: str, entrada: dict) -> list:
+    """Cabecera + un bloque por ítem: la paginación nunca parte un ítem por la mitad."""
+    cab = entrada["cabecera"]
+    lineas = entrada["lineas"]
+    fuentes = " · ".join(ETIQUETAS[f] for f in entrada["fuentes"])
+    encabezado = (
+        f"📦 <b>REPORTE DE ORDEN {html.escape(po_number)}</b>\n"
+        f"🔖 {fuentes}\n"
+        f"━━━━━━━━━━━━━━━━━━━━━━\n"
+        f"📅 <b>Fecha:</b> {cab.get('ship_date')}\n"
+        f"🏭 <b>Vendor:</b> {html.escape(str(cab.get('vendor')))}\n"
+    )
+    if entrada["fuente_cabecera"] == "orden":
+        encabezado += (
+            f"📍 <b>Origen:</b> {html.escape(str(cab.get('origin')))}\n"
+            f"📊 <b>Total Cajas:</b> {cab.get('total_boxes')}\n"
+            f"💰 <b>Total Valor:</b> ${float(cab.get('total_value') or 0):.2f}\n"
+        )
+    else:
+        encabezado += f"🚦 <b>Estado:</b> {html.escape(str(lineas[0].get('estado') if lineas else None))}\n"
+    encabezado += f"━━━━━━━━━━━━━━━━━━━━━━\n📋 <b>Detalle de Ítems ({len(lineas)}):</b>\n\n"
+    bloques = [encabezado]
+
+    if not lineas:
+        bloques.append("⚠️ <i>La orden existe pero no tiene ítems asociados.</i>\n\n")
+    for i, linea in enumerate(lineas, 1):
+        cliente = html.escape(str(linea.get('cliente') or 'N/A'))
+        producto = html.escape(str(linea.get('producto') or 'Producto Desconocido'))
+        tipo = linea.get('tipo') or 'QB'
+        precio = linea.get('precio') or 0
+        vista_en = "" if len(entrada["fuentes"]) == 1 else "   └ 🔖 " + ", ".join(linea["fuentes"]) + "\n"
+        bloques.append(
+            f"<b>{i}. {cliente}</b>\n"
+            f"   └ 🌺 {producto}\n"
+            f"   └ 📦 {linea['cajas']} {tipo}  | 💲${precio}\n"
+            f"{vista_en}\n"
+        )
+    return bloques
+
+def _paginar(bloques: list) -> list:
+    paginas, actual = [], ""
+    for bloque in bloques:
+        if actual and len(actual) + len(bloque) > LIMITE_PAGINA:
+            paginas.append(actual)
+            actual = ""
+        actual += bloque
+    if actual:
+        paginas.append(actual)
+    return paginas
+
+def _teclado(token: str, pagina: int, total: int):
+    if total <= 1:
+        return None
+    fila = []
+    if pagina > 0:
+        fila.append(InlineKeyboardButton("⬅️", callback_data=enrutador.datos("pp", token, pagina - 1)))
+    fila.append(InlineKeyboardButton(f"{pagina + 1}/{total}", callback_data=enrutador.datos("pp", token, pagina)))
+    if pagina < total - 1:
+        fila.append(InlineKeyboardButton("➡️", callback_data=enrutador.datos("pp", token, pagina + 1)))
+    return InlineKeyboardMarkup([fila])
 
 async def handle_lookup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Busca una PO en la estructura relacional (Sales Orders + Items).
-    Uso: /po P083638
+    Busca una o varias POs en sales_orders, staging_komet y confirm_po a la vez.
+    Uso: /po P083638 [P083639 ...]
     """
     if len(context.args) == 0:
         await update.message.reply_text(
-            "⚠️ Necesito el número de PO.\nEjemplo: <code>/po P083638</code>",
+            "⚠️ Necesito el número de PO.\nEjemplo: <code>/po P083638 P083639</code>",
             parse_mode="HTML"
         )
         return
 
-    po_number = context.args[0].strip().upper()
-    await update.message.reply_text(f"🔍 Buscando <b>{po_number}</b> en la base relacional...", parse_mode="HTML")
-
-    try:
-        # 1. CONSULTA DE CABECERA (La Nave)
-        res_head = db_client.table("sales_orders").select("*").eq("po_number", po_number).execute()
-
-        if not res_head.data:
-            # Fallback opcional: Podrías buscar en la tabla vieja 'confirm_po' aquí si quisieras
-            await update.message.reply_text(f"❌ No encontré la PO <b>{po_number}</b> en la tabla de órdenes.", parse_mode="HTML")
-            return
-
-        orden = res_head.data[0]
-        order_id = orden['id']
+    pedidas = list(dict.fromkeys(a.strip().upper() for a in context.args if a.strip()))
+    etiqueta = html.escape(", ".join(pedidas[:5]) + ("..." if len(pedidas) > 5 else ""))
+    msg = await update.message.reply_text(f"🔍 Buscando <b>{etiqueta}</b> en órdenes, Komet y la tabla heredada...", parse_mode="HTML")
 
-        # 2. CONSULTA DE DETALLES (La Carga)
-        res_items = db_client.table("sales_items").select("*").eq("order_id", order_id).execute()
-        items = res_items.data or []
+    token = secrets.token_hex(3)
+    reportes = context.user_data.setdefault('reportes_po', {})
+    while len(reportes) >= MAX_REPORTES_ABIERTOS:
+        reportes.pop(next(iter(reportes)))
 
-        # 3. CONSTRUCCIÓN DEL REPORTE
-        # Encabezado
-        mensaje = (
-            f"📦 <b>REPORTE DE ORDEN {po_number}</b>\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"📅 <b>Fecha:</b> {orden.get('ship_date')}\n"
-            f"🏭 <b>Vendor:</b> {orden.get('vendor')}\n"
-            f"📍 <b>Origen:</b> {orden.get('origin')}\n"
-            f"📊 <b>Total Cajas:</b> {orden.get('total_boxes')}\n"
-            f"💰 <b>Total Valor:</b> ${orden.get('total_value', 0):.2f}\n"
-            f"━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"📋 <b>Detalle de Ítems ({len(items)}):</b>\n\n"
-        )
+    fusion, fallidas = {}, set()
+    try:
+        # Cada fuente que contesta repinta el mismo mensaje: la primera respuesta ya es útil
+        async for _, fusion, pendientes, fallidas in consulta_po.federar(pedidas):
+            if not fusion:
+                continue
+            paginas = _paginar(_bloques_reporte(pedidas, fusion, pendientes, fallidas))
+            reportes[token] = paginas
+            await renderizador.editar_mensaje(
+                context.bot, msg.chat_id, msg.message_id, paginas[0],
+                reply_markup=_teclado(token, 0, len(paginas)), parse_mode="HTML"
+            )
+    except Exception as e:
+        logger.error(f"Error buscando POs {pedidas}: {e}")
+        await update.message.reply_text(f"💥 Error técnico buscando la orden: {e}")
+        return
 
-        # Iteración de ítems
-        if items:
-            for i, item in enumerate(items, 1):
-                cliente = item.get('customer_code', 'N/A')
-                producto = item.get('product_name', 'Producto Desconocido')
-                cajas = item.get('boxes', 0)
-                tipo = item.get('box_type', 'QB')
-                precio = item.get('unit_price', 0)
-                
-                mensaje += (
-                    f"<b>{i}. {cliente}</b>\n"
-                    f"   └ 🌺 {producto}\n"
-                    f"   └ 📦 {cajas} {tipo}  | 💲${precio}\n\n"
-                )
+    if not fusion:
+        if fallidas == set(FUENTES):
+            # Ninguna fuente contestó: no es que la PO no exista
+            texto = f"💥 No pude consultar <b>{etiqueta}</b>: {_sin_respuesta(fallidas)}. Intenta de nuevo en un momento."
         else:
-            mensaje += "⚠️ <i>La orden existe pero no tiene ítems asociados.</i>"
+            texto = "\n\n".join(filter(None, [
+                f"❌ No encontré <b>{etiqueta}</b> en órdenes, Komet ni en la tabla heredada.",
+                f"⚠️ <i>{_sin_respuesta(fallidas)}</i>" if fallidas else "",
+                _quisiste_decir(pedidas[:MAX_POS_CONSULTA]),
+            ]))
+        await renderizador.editar_mensaje(context.bot, msg.chat_id, msg.message_id, texto, parse_mode="HTML")
 
-        await update.message.reply_text(mensaje, parse_mode="HTML")
+def _sin_respuesta(fallidas: set) -> str:
+    nombres = ", ".join(ETIQUETAS[f] for f in sorted(fallidas))
+    return f"fuente {nombres} no respondió" if len(fallidas) == 1 else f"fuentes {nombres} no respondieron"
 
-    except Exception as e:
-        logger.error(f"Error buscando PO {po_number}: {e}")
-        await update.message.reply_text(f"💥 Error técnico buscando la orden: {e}")
+def _bloques_reporte(pedidas: list, fusion: dict, pendientes: set, fallidas: set = frozenset()) -> list:
+    bloques = []
+    if fallidas:
+        bloques.append(f"⚠️ <i>{_sin_respuesta(fallidas)}; el reporte puede estar incompleto.</i>\n\n")
+    faltantes = [p for p in pedidas[:MAX_POS_CONSULTA] if p not in fusion]
+    if pendientes:
+        bloques.append(f"⏳ <i>Consultando aún: {', '.join(ETIQUETAS[f] for f in sorted(pendientes))}</i>\n\n")
+    elif faltantes:
+        bloques.append(f"❌ <i>No encontradas: {html.escape(', '.join(faltantes))}</i>\n")
+        sugerencias = _quisiste_decir(faltantes)
+        bloques.append(f"{sugerencias}\n\n" if sugerencias else "\n")
+    if len(pedidas) > MAX_POS_CONSULTA:
+        bloques.append(f"✂️ <i>Solo se consultan las primeras {MAX_POS_CONSULTA} POs.</i>\n\n")
+    for po_number in pedidas:
+        if po_number in fusion:
+            bloques.extend(_bloques_po(po_number, fusion[po_number]))
+    return bloques
+
+@enrutador.ruta("pp")
+async def ruta_pagina_po(update: Update, context: ContextTypes.DEFAULT_TYPE, token: str, pagina: str):
+    paginas = context.user_data.get('reportes_po', {}).get(token)
+    if not paginas:
+        await renderizador.responder(update.callback_query, "⌛ Reporte caducado. Vuelve a ejecutar /po.", show_alert=True)
+        return
+    pagina = min(max(int(pagina), 0), len(paginas) - 1)
+    await renderizador.editar(update.callback_query, paginas[pagina], reply_markup=_teclado(token, pagina, len(paginas)), parse_mode="HTML")
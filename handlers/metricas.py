@@ -0,0 +1,28 @@
+from telegram import Update
+from telegram.ext import ContextTypes
+from services.renderizador import renderizador
+from services.enrutador import enrutador
+
+async def comando_metricas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Comando: /metricas
+    Muestra cuánto tráfico hacia Telegram nos estamos ahorrando y cuánto tarda cada botón.
+    """
+    m = renderizador.metricas()
+
+    texto = (
+        f"📈 <b>Métricas de Render</b>\n"
+        f"━━━━━━━━━━━━━━━━━━━━━━\n"
+        f"✏️ Ediciones enviadas: {m['enviadas']}\n"
+        f"🟰 Ediciones omitidas: {m['omitidas']}\n"
+        f"💸 Ahorro: {m['ahorro_pct']:.1f}%\n"
+        f"🧠 Mensajes en memoria: {m['mensajes_en_memoria']}\n"
+    )
+
+    rutas = enrutador.metricas()
+    if rutas:
+        texto += "\n⏱️ <b>Latencia por Ruta</b>\n"
+        for prefijo, r in sorted(rutas.items(), key=lambda kv: kv[1]['prom_ms'], reverse=True):
+            texto += f"<code>{prefijo}</code> x{r['llamadas']} | prom {r['prom_ms']:.0f}ms | máx {r['max_ms']:.0f}ms\n"
+
+    await update.message.reply_text(texto, parse_mode="HTML")
@@ -1,7 +1,16 @@
+import os
+import time
+import asyncio
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from services.supabase_client import supabase
+from services.renderizador import renderizador
+from services.enrutador import enrutador, comprimir_id, expandir_id
+from services.buffer_escritura import buffer_panel, WRITE_BEHIND_ACTIVO
+from services.vigia_komet import vigia_komet
+from services.secuenciador import secuenciador, ErrorSecuencia
+from services.eventos import emitir, IDENTIFICADORES_REGISTRADOS
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
@@ -9,6 +18,13 @@ logger = logging.getLogger(__name__)
 ITEMS_PER_PAGE = 5
 TABLE_NAME = "staging_komet" 
 
+# Vigía en vivo: cada cuánto se mira staging_komet y cuánto vive un panel sin tocarse
+PANEL_POLL_SEG = int(os.getenv("PANEL_POLL_SEG", "30"))
+PANEL_TTL_SEG = 30 * 60
+
+# chat_id -> {"message_id", "vista": "lista"|"detalle", "page", "order_id", "ids", "visto"}
+PANELES_ABIERTOS = {}
+
 # --- 1. COMANDO PRINCIPAL ---
 async def comando_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['current_page'] = 0
@@ -16,53 +32,55 @@ async def comando_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['current_editing_id'] = None
     await show_orders_page(update, context)
 
-# --- 2. ROUTER DEL PANEL ---
-async def router_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer() 
-    data = query.data
-    
-    # A. Navegación
-    if "page_" in data:
-        current_page = context.user_data.get('current_page', 0)
-        if "next" in data:
-            context.user_data['current_page'] = current_page + 1
-        elif "prev" in data and current_page > 0:
-            context.user_data['current_page'] = current_page - 1
-        await show_orders_page(update, context)
-        
-    elif data in ["panel_refresh", "panel_back"]:
-        context.user_data['estado_panel'] = None
-        await show_orders_page(update, context)
-
-    # B. Ver Detalle (El Manifiesto Completo)
-    elif data.startswith("view_order_"):
-        order_id = data.split("_")[-1]
-        context.user_data['current_editing_id'] = order_id
-        await show_order_detail(update, context, order_id)
+# --- 2. RUTAS DEL PANEL ---
+# Cada botón viaja como '<ruta>:<args>' y el enrutador global lo entrega aquí sin escanear strings.
 
-    # C. Submenús
-    elif data.startswith("menu_"):
-        await show_submenu(update, context, data)
-
-    # D. Edición
-    elif data.startswith("edit_"):
-        parts = data.split("_")
-        field = parts[1]
-        order_id = parts[2]
-        context.user_data['estado_panel'] = f"editing_{field}"
-        context.user_data['editing_id'] = order_id
-        
-        txt = f"✍️ *Editando {field.upper()}*\n\nEscribe el nuevo valor:"
-        await query.edit_message_text(txt, parse_mode='Markdown')
+# A. Navegación
+@enrutador.ruta("pn")
+async def ruta_navegar(update: Update, context: ContextTypes.DEFAULT_TYPE, direccion: str):
+    current_page = context.user_data.get('current_page', 0)
+    if direccion == "next":
+        context.user_data['current_page'] = current_page + 1
+    elif direccion == "prev" and current_page > 0:
+        context.user_data['current_page'] = current_page - 1
+    await show_orders_page(update, context)
+
+@enrutador.ruta("pr")
+async def ruta_refrescar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data['estado_panel'] = None
+    await show_orders_page(update, context)
 
-    # E. Acciones
-    elif data.startswith("action_"):
-        await execute_action(update, context, data)
+# B. Ver Detalle (El Manifiesto Completo)
+@enrutador.ruta("vo")
+async def ruta_ver_orden(update: Update, context: ContextTypes.DEFAULT_TYPE, token_id: str):
+    order_id = expandir_id(token_id)
+    context.user_data['current_editing_id'] = order_id
+    await show_order_detail(update, context, order_id)
 
-    # F. Creación Manual
-    elif data == "create_manual":
-        await create_manual_order(update, context)
+# C. Submenús
+@enrutador.ruta("mn")
+async def ruta_submenu(update: Update, context: ContextTypes.DEFAULT_TYPE, menu_type: str, token_id: str):
+    await show_submenu(update, context, menu_type, expandir_id(token_id))
+
+# D. Edición
+@enrutador.ruta("ed")
+async def ruta_editar(update: Update, context: ContextTypes.DEFAULT_TYPE, field: str, token_id: str):
+    context.user_data['estado_panel'] = f"editing_{field}"
+    context.user_data['editing_id'] = expandir_id(token_id)
+
+    txt = f"✍️ *Editando {field.upper()}*\n\nEscribe el nuevo valor:"
+    _cerrar_panel(update.callback_query.message)
+    await renderizador.editar(update.callback_query, txt, parse_mode='Markdown')
+
+# E. Acciones
+@enrutador.ruta("ac")
+async def ruta_accion(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, token_id: str):
+    await execute_action(update, context, action, expandir_id(token_id))
+
+# F. Creación Manual
+@enrutador.ruta("cm")
+async def ruta_crear_manual(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await create_manual_order(update, context)
 
 # --- 3. PROCESADOR DE INPUT (El Escriba Universal) ---
 async def procesar_input_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -100,8 +118,17 @@ async def procesar_input_panel(update: Update, context: ContextTypes.DEFAULT_TYP
     }
     
     db_col = col_map.get(field_alias)
-    
-    if db_col and order_id:
+
+    # AWB, HAWB, PO e invoice editados a mano también se pueden buscar al instante
+    tipos_busqueda = {'awb': 'awb', 'hawb': 'hawb', 'po_consecutive': 'po', 'invoice_number': 'invoice'}
+    if db_col in tipos_busqueda and order_id:
+        emitir(IDENTIFICADORES_REGISTRADOS, pares=[(tipos_busqueda[db_col], text, None)])
+
+    if db_col and order_id and WRITE_BEHIND_ACTIVO:
+        # Confirmación optimista: la DB recibe el cambio agrupado en unos segundos
+        buffer_panel.encolar(order_id, db_col, text, update.effective_chat.id, context.bot)
+        await update.message.reply_text(f"✅ *{field_alias.upper()}* mutado a: `{text}` _(guardando...)_", parse_mode='Markdown')
+    elif db_col and order_id:
         try:
             supabase.table(TABLE_NAME).update({db_col: text}).eq("id", order_id).execute()
             await update.message.reply_text(f"✅ *{field_alias.upper()}* mutado a: `{text}`", parse_mode='Markdown')
@@ -110,29 +137,19 @@ async def procesar_input_panel(update: Update, context: ContextTypes.DEFAULT_TYP
     
     context.user_data['estado_panel'] = None
     
-    keyboard = [[InlineKeyboardButton("🔙 Volver al Manifiesto", callback_data=f"view_order_{order_id}")]]
+    keyboard = [[InlineKeyboardButton("🔙 Volver al Manifiesto", callback_data=enrutador.datos("vo", comprimir_id(order_id)))]]
     await update.message.reply_text("¿Siguiente movimiento?", reply_markup=InlineKeyboardMarkup(keyboard))
 
 # --- VISTAS ---
 
-async def show_orders_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    page = context.user_data.get('current_page', 0)
-    
-    try:
-        response = supabase.table(TABLE_NAME)\
-            .select("id, customer_code, po_komet, fly_date, ship_date, status, product_name")\
-            .order("created_at", desc=True)\
-            .range(page * ITEMS_PER_PAGE, (page + 1) * ITEMS_PER_PAGE - 1)\
-            .execute()
-        orders = response.data
-    except Exception as e:
-        logger.error(f"Error Supabase: {e}")
-        msg = f"🔥 Error crítico leyendo {TABLE_NAME}:\n{str(e)}"
-        if update.callback_query:
-            await update.callback_query.edit_message_text(msg)
-        else:
-            await update.message.reply_text(msg)
-        return
+def _pintar_lista(page: int):
+    """Consulta la página y construye (texto, teclado, ids_visibles). Lanza si la DB falla."""
+    response = supabase.table(TABLE_NAME)\
+        .select("id, customer_code, po_komet, fly_date, ship_date, status, product_name")\
+        .order("created_at", desc=True)\
+        .range(page * ITEMS_PER_PAGE, (page + 1) * ITEMS_PER_PAGE - 1)\
+        .execute()
+    orders = response.data
 
     header = f"📋 *PANEL DE CONTROL (Pág {page})*\n\n"
     keyboard = []
@@ -149,29 +166,45 @@ async def show_orders_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
             icon = "🟢" if status == 'Ready' else "🔴" if 'Pending' in status else "⚠️"
             
             btn_txt = f"{icon} {cust} | {po} | {fecha}"
-            keyboard.append([InlineKeyboardButton(btn_txt, callback_data=f"view_order_{o['id']}")])
+            keyboard.append([InlineKeyboardButton(btn_txt, callback_data=enrutador.datos("vo", comprimir_id(o['id'])))])
 
     nav = []
-    if page > 0: nav.append(InlineKeyboardButton("⬅️", callback_data="page_prev"))
-    nav.append(InlineKeyboardButton("➕ Manual", callback_data="create_manual"))
-    nav.append(InlineKeyboardButton("🔄", callback_data="panel_refresh"))
-    nav.append(InlineKeyboardButton("➡️", callback_data="page_next"))
+    if page > 0: nav.append(InlineKeyboardButton("⬅️", callback_data=enrutador.datos("pn", "prev")))
+    nav.append(InlineKeyboardButton("➕ Manual", callback_data=enrutador.datos("cm")))
+    nav.append(InlineKeyboardButton("🔄", callback_data=enrutador.datos("pr")))
+    nav.append(InlineKeyboardButton("➡️", callback_data=enrutador.datos("pn", "next")))
     keyboard.append(nav)
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    if update.callback_query:
-        await update.callback_query.edit_message_text(header, reply_markup=reply_markup, parse_mode='Markdown')
-    else:
-        await update.message.reply_text(header, reply_markup=reply_markup, parse_mode='Markdown')
+    return header, InlineKeyboardMarkup(keyboard), [str(o['id']) for o in orders or []]
 
-async def show_order_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id: str):
+async def show_orders_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    page = context.user_data.get('current_page', 0)
+    
     try:
-        data = supabase.table(TABLE_NAME).select("*").eq("id", order_id).execute().data[0]
+        header, reply_markup, ids = _pintar_lista(page)
     except Exception as e:
-        await update.callback_query.edit_message_text(f"❌ La orden se ha disuelto en la nada: {e}")
+        logger.error(f"Error Supabase: {e}")
+        msg = f"🔥 Error crítico leyendo {TABLE_NAME}:\n{str(e)}"
+        if update.callback_query:
+            await renderizador.editar(update.callback_query, msg)
+        else:
+            await update.message.reply_text(msg)
         return
 
+    if update.callback_query:
+        await renderizador.editar(update.callback_query, header, reply_markup=reply_markup, parse_mode='Markdown')
+        mensaje = update.callback_query.message
+    else:
+        mensaje = await renderizador.enviar(update.message, header, reply_markup=reply_markup, parse_mode='Markdown')
+
+    _registrar_panel(mensaje, vista="lista", page=page, ids=ids)
+
+def _pintar_detalle(order_id: str):
+    """Consulta la orden y construye (texto, teclado) del manifiesto. Lanza si la DB falla."""
+    data = supabase.table(TABLE_NAME).select("*").eq("id", order_id).execute().data[0]
+    # Ediciones que aún viajan en el buffer: mostramos lo último que escribió el usuario
+    data.update(buffer_panel.pendiente(order_id))
+
     # --- EXTRACCIÓN DE LA VERDAD ---
     def g(key, default="---"): return str(data.get(key) or default)
     def money(key): return str(data.get(key) or 0)
@@ -219,75 +252,98 @@ async def show_order_detail(update: Update, context: ContextTypes.DEFAULT_TYPE,
         f"Notas: _{g('notes')}_"
     )
 
+    oid = comprimir_id(order_id)
     keyboard = [
         [
-            InlineKeyboardButton("✈️ Logística", callback_data=f"menu_log_{order_id}"),
-            InlineKeyboardButton("💰 Finanzas", callback_data=f"menu_fin_{order_id}")
+            InlineKeyboardButton("✈️ Logística", callback_data=enrutador.datos("mn", "log", oid)),
+            InlineKeyboardButton("💰 Finanzas", callback_data=enrutador.datos("mn", "fin", oid))
         ],
         [
-            InlineKeyboardButton("📄 Documentos", callback_data=f"menu_docs_{order_id}"),
-            InlineKeyboardButton("🔙 Volver", callback_data="panel_back")
+            InlineKeyboardButton("📄 Documentos", callback_data=enrutador.datos("mn", "docs", oid)),
+            InlineKeyboardButton("🔙 Volver", callback_data=enrutador.datos("pr"))
         ]
     ]
-    await update.callback_query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    return txt, InlineKeyboardMarkup(keyboard)
 
-async def show_submenu(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
-    parts = data.split("_")
-    menu_type = parts[1]
-    order_id = parts[2]
-    
+async def show_order_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id: str):
+    try:
+        txt, reply_markup = _pintar_detalle(order_id)
+    except Exception as e:
+        await renderizador.editar(update.callback_query, f"❌ La orden se ha disuelto en la nada: {e}")
+        return
+
+    await renderizador.editar(update.callback_query, txt, reply_markup=reply_markup, parse_mode='Markdown')
+    _registrar_panel(update.callback_query.message, vista="detalle", order_id=str(order_id))
+
+
+async def show_submenu(update: Update, context: ContextTypes.DEFAULT_TYPE, menu_type: str, order_id: str):
+    _cerrar_panel(update.callback_query.message)
+    oid = comprimir_id(order_id)
     txt = f"⚙️ *Ajuste de Tuercas: {menu_type.upper()}*"
     keyboard = []
     
     if menu_type == "log":
         keyboard = [
-            [InlineKeyboardButton("✏️ AWB", callback_data=f"edit_awb_{order_id}"), 
-             InlineKeyboardButton("✏️ HAWB", callback_data=f"edit_hawb_{order_id}")],
-            [InlineKeyboardButton("✏️ Fly Date", callback_data=f"edit_fly_{order_id}"),
-             InlineKeyboardButton("✏️ Ship Date", callback_data=f"edit_ship_{order_id}")],
-            [InlineKeyboardButton("✏️ Tipo Caja", callback_data=f"edit_box_{order_id}"),
-             InlineKeyboardButton("✏️ Marca", callback_data=f"edit_mark_{order_id}")]
+            [InlineKeyboardButton("✏️ AWB", callback_data=enrutador.datos("ed", "awb", oid)), 
+             InlineKeyboardButton("✏️ HAWB", callback_data=enrutador.datos("ed", "hawb", oid))],
+            [InlineKeyboardButton("✏️ Fly Date", callback_data=enrutador.datos("ed", "fly", oid)),
+             InlineKeyboardButton("✏️ Ship Date", callback_data=enrutador.datos("ed", "ship", oid))],
+            [InlineKeyboardButton("✏️ Tipo Caja", callback_data=enrutador.datos("ed", "box", oid)),
+             InlineKeyboardButton("✏️ Marca", callback_data=enrutador.datos("ed", "mark", oid))]
         ]
     elif menu_type == "fin":
         keyboard = [
-            [InlineKeyboardButton("✏️ Precio Venta", callback_data=f"edit_price_{order_id}"),
-             InlineKeyboardButton("✏️ PR (Costo)", callback_data=f"edit_pr_{order_id}")],
-            [InlineKeyboardButton("✏️ PCUC", callback_data=f"edit_pcuc_{order_id}"),
-             InlineKeyboardButton("✏️ VC", callback_data=f"edit_vc_{order_id}")],
-            [InlineKeyboardButton("✏️ Créditos", callback_data=f"edit_credits_{order_id}"),
-             InlineKeyboardButton("✏️ Factor 1.25", callback_data=f"edit_factor_{order_id}")]
+            [InlineKeyboardButton("✏️ Precio Venta", callback_data=enrutador.datos("ed", "price", oid)),
+             InlineKeyboardButton("✏️ PR (Costo)", callback_data=enrutador.datos("ed", "pr", oid))],
+            [InlineKeyboardButton("✏️ PCUC", callback_data=enrutador.datos("ed", "pcuc", oid)),
+             InlineKeyboardButton("✏️ VC", callback_data=enrutador.datos("ed", "vc", oid))],
+            [InlineKeyboardButton("✏️ Créditos", callback_data=enrutador.datos("ed", "credits", oid)),
+             InlineKeyboardButton("✏️ Factor 1.25", callback_data=enrutador.datos("ed", "factor", oid))]
         ]
     elif menu_type == "docs":
         keyboard = [
-            [InlineKeyboardButton("🎲 Generar PO#", callback_data=f"action_genpo_{order_id}")],
-            [InlineKeyboardButton("📑 Generar INV#", callback_data=f"action_geninv_{order_id}")]
+            [InlineKeyboardButton("🎲 Generar PO#", callback_data=enrutador.datos("ac", "genpo", oid))],
+            [InlineKeyboardButton("📑 Generar INV#", callback_data=enrutador.datos("ac", "geninv", oid))]
         ]
 
-    keyboard.append([InlineKeyboardButton("🔙 Volver al Manifiesto", callback_data=f"view_order_{order_id}")])
+    keyboard.append([InlineKeyboardButton("🔙 Volver al Manifiesto", callback_data=enrutador.datos("vo", oid))])
     
-    await update.callback_query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await renderizador.editar(update.callback_query, txt, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
-async def execute_action(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
-    action = data.split("_")[1]
-    order_id = data.split("_")[2]
-    
+async def execute_action(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, order_id: str):
     new_val = ""
     col = ""
-    
-    if action == "genpo":
-        # TODO: Conectar con tabla 'system_sequences' real
-        new_val = f"PO-{datetime.now().strftime('%m%d%H%M')}"
-        col = "po_consecutive"
-    elif action == "geninv":
-        new_val = f"INV-{datetime.now().strftime('%m%d')}-001"
-        col = "invoice_number"
-        
+
+    try:
+        if action == "genpo":
+            # El consecutivo lleva el código de la finca (vendor) de la orden
+            res = await asyncio.to_thread(
+                lambda: supabase.table(TABLE_NAME).select("vendor").eq("id", order_id).execute()
+            )
+            finca = (res.data[0].get("vendor") if res.data else None) or "GEN"
+            new_val = await asyncio.to_thread(secuenciador.obtener_siguiente_po, finca)
+            col = "po_consecutive"
+        elif action == "geninv":
+            new_val = await asyncio.to_thread(secuenciador.obtener_siguiente_invoice)
+            col = "invoice_number"
+        else:
+            return
+    except ErrorSecuencia:
+        await renderizador.responder(update.callback_query, "❌ No se pudo reservar el consecutivo. Intenta de nuevo.")
+        return
+    except Exception as e:
+        logger.error(f"Error generando consecutivo: {e}")
+        await renderizador.responder(update.callback_query, "❌ Error en la matrix")
+        return
+
     try:
         supabase.table(TABLE_NAME).update({col: new_val}).eq("id", order_id).execute()
-        await update.callback_query.answer(f"✅ Realidad alterada: {new_val}")
+        emitir(IDENTIFICADORES_REGISTRADOS, pares=[("invoice" if col == "invoice_number" else "po", new_val, None)])
+        await renderizador.responder(update.callback_query, f"✅ Realidad alterada: {new_val}")
         await show_order_detail(update, context, order_id)
     except Exception as e:
-        await update.callback_query.answer("❌ Error en la matrix")
+        logger.error(f"Error guardando consecutivo {new_val}: {e}")
+        await renderizador.responder(update.callback_query, "❌ Error en la matrix")
 
 async def create_manual_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -303,4 +359,66 @@ async def create_manual_order(update: Update, context: ContextTypes.DEFAULT_TYPE
     except Exception as e:
         logger.error(f"Error manual: {e}")
         if update.callback_query:
-            await update.callback_query.answer("❌ Error creando orden.")
+            await renderizador.responder(update.callback_query, "❌ Error creando orden.")
+
+# --- 4. VIGÍA EN VIVO (JobQueue) ---
+def _registrar_panel(mensaje, vista: str, page: int = 0, order_id: str = None, ids=None):
+    if mensaje is None:
+        return
+    PANELES_ABIERTOS[mensaje.chat.id] = {
+        "message_id": mensaje.message_id,
+        "vista": vista,
+        "page": page,
+        "order_id": order_id,
+        "ids": set(ids or []),
+        "visto": time.monotonic(),
+    }
+
+def _cerrar_panel(mensaje):
+    # Submenús y edición no se repintan solos: el usuario está en medio de algo
+    if mensaje is not None:
+        PANELES_ABIERTOS.pop(mensaje.chat.id, None)
+
+async def vigilar_cambios_panel(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Job periódico: pregunta a staging_komet qué se movió desde el último cursor,
+    avisa 'N nuevas / M modificadas' a quien tenga el panel abierto y
+    repinta solo las vistas afectadas (la lista si cambió su página, el detalle si cambió su orden).
+    """
+    ahora = time.monotonic()
+    for chat_id in [c for c, p in PANELES_ABIERTOS.items() if ahora - p["visto"] > PANEL_TTL_SEG]:
+        PANELES_ABIERTOS.pop(chat_id, None)
+
+    try:
+        nuevos, modificados = await asyncio.to_thread(vigia_komet.revisar)
+    except Exception as e:
+        logger.error(f"Vigía staging_komet: {e}")
+        return
+
+    if not (nuevos or modificados) or not PANELES_ABIERTOS:
+        return
+
+    tocados = {str(i) for i in modificados}
+    aviso = f"🔔 {len(nuevos)} nuevas / {len(modificados)} modificadas en el panel."
+
+    for chat_id, panel in list(PANELES_ABIERTOS.items()):
+        try:
+            if panel["vista"] == "lista":
+                # Las nuevas entran por arriba (orden created_at desc) y empujan todas las páginas
+                afectada = bool(nuevos) or bool(panel["ids"] & tocados)
+                if afectada:
+                    texto, teclado, ids = await asyncio.to_thread(_pintar_lista, panel["page"])
+                    await renderizador.editar_mensaje(
+                        context.bot, chat_id, panel["message_id"], texto, reply_markup=teclado, parse_mode='Markdown'
+                    )
+                    panel["ids"] = set(ids)
+            elif panel["vista"] == "detalle" and panel["order_id"] in tocados:
+                texto, teclado = await asyncio.to_thread(_pintar_detalle, panel["order_id"])
+                await renderizador.editar_mensaje(
+                    context.bot, chat_id, panel["message_id"], texto, reply_markup=teclado, parse_mode='Markdown'
+                )
+
+            await context.bot.send_message(chat_id, aviso, disable_notification=True)
+        except Exception as e:
+            logger.error(f"Vigía no pudo refrescar el panel de {chat_id}: {e}")
+            PANELES_ABIERTOS.pop(chat_id, None)
@@ -0,0 +1,35 @@
+import asyncio
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ContextTypes
+from services.orquestador import orquestador
+from services.renderizador import renderizador
+from services.enrutador import enrutador
+
+def _teclado(pagina: int, total_paginas: int):
+    if total_paginas <= 1:
+        return None
+    fila = []
+    if pagina > 0:
+        fila.append(InlineKeyboardButton("⬅️", callback_data=enrutador.datos("pd", pagina - 1)))
+    fila.append(InlineKeyboardButton(f"{pagina + 1}/{total_paginas}", callback_data=enrutador.datos("pd", pagina)))
+    if pagina < total_paginas - 1:
+        fila.append(InlineKeyboardButton("➡️", callback_data=enrutador.datos("pd", pagina + 1)))
+    return InlineKeyboardMarkup([fila])
+
+async def comando_pendientes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Comando: /pendientes
+    Órdenes confirmadas sin factura, agrupadas por cliente (la DB agrupa; aquí solo se pagina).
+    """
+    texto, _, total_paginas = await asyncio.to_thread(orquestador.obtener_resumen_pendientes, 0)
+    await update.message.reply_text(texto, reply_markup=_teclado(0, total_paginas), parse_mode="HTML")
+
+@enrutador.ruta("pd")
+async def ruta_pendientes_pagina(update: Update, context: ContextTypes.DEFAULT_TYPE, pagina: str):
+    pagina = max(int(pagina), 0)
+    texto, _, total_paginas = await asyncio.to_thread(orquestador.obtener_resumen_pendientes, pagina)
+    if total_paginas and pagina >= total_paginas:
+        # Se facturó mientras tanto y la página ya no existe: última disponible
+        pagina = total_paginas - 1
+        texto, _, total_paginas = await asyncio.to_thread(orquestador.obtener_resumen_pendientes, pagina)
+    await renderizador.editar(update.callback_query, texto, reply_markup=_teclado(pagina, total_paginas), parse_mode="HTML")
@@ -0,0 +1,51 @@
+from telegram import Update
+from telegram.ext import ContextTypes
+from services.motor_rfm import motor_rfm
+
+MAX_RANKING = 50
+
+async def comando_rfm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Comando: /rfm [N]      -> Top N clientes por puntaje RFM (default 20)
+             /rfm CODIGO   -> Perfil RFM de un cliente
+    Todo sale del motor en memoria: cero consultas a la DB.
+    """
+    if not motor_rfm.listo:
+        await update.message.reply_text("⏳ El motor RFM aún está cargando el historial. Intenta en un momento.")
+        return
+
+    arg = context.args[0].strip() if context.args else ""
+
+    if arg and not arg.isdigit():
+        codigo = arg.upper()
+        p = motor_rfm.perfil(codigo)
+        if not p:
+            await update.message.reply_text(f"🤷‍♂️ Sin historial de ventas para <b>{codigo}</b>.", parse_mode="HTML")
+            return
+        dias = p['days_since_last_order']
+        await update.message.reply_text(
+            f"📊 <b>RFM {codigo}</b>\n"
+            f"━━━━━━━━━━━━━━━━━━━━━━\n"
+            f"🕒 Última compra: hace {dias if dias is not None else '?'} días\n"
+            f"🔁 Órdenes: {p['lifetime_orders']}\n"
+            f"💰 Total: ${p['lifetime_value']:,.2f}\n"
+            f"🎫 Ticket promedio: ${p['avg_order_value']:,.2f}",
+            parse_mode="HTML"
+        )
+        return
+
+    limite = min(int(arg), MAX_RANKING) if arg else 20
+    ranking = motor_rfm.ranking(limite)
+    if not ranking:
+        await update.message.reply_text("📭 No hay historial de ventas cargado.")
+        return
+
+    texto = f"🏆 <b>Top {len(ranking)} Clientes (RFM)</b>\n━━━━━━━━━━━━━━━━━━━━━━\n"
+    for i, c in enumerate(ranking, 1):
+        dias = f"{c['dias']}d" if c['dias'] is not None else "?"
+        texto += (
+            f"{i}. <code>{c['cliente']}</code> ⭐{c['puntaje']} "
+            f"(R{c['r']} F{c['f']} M{c['m']}) | {dias} | {c['ordenes']} órd | ${c['monto']:,.0f}\n"
+        )
+
+    await update.message.reply_text(texto, parse_mode="HTML")
@@ -1,57 +1,128 @@
+import os
+import time
+import asyncio
 from telegram import Update
 from telegram.ext import ContextTypes
-from services.cliente_supabase import db_client, logger
+from services.cliente_supabase import logger
+from services.exportador_tablas import (
+    exportador_tablas, interpretar_argumentos, ErrorConsultaTabla, LIMITE_DOCUMENTO_MB
+)
 from tabulate import tabulate
 
+INTERVALO_PROGRESO = 2.0   # Segundos mínimos entre ediciones del mensaje de progreso
+
+USO = (
+    "⚠️ *Error de Sintaxis*\nPor favor indica la tabla.\n"
+    "Ejemplo: `/tablageneral customers`\n\n"
+    "Opciones:\n"
+    "• Columnas: `cols=code,name`\n"
+    "• Filtros: `country=EC` `total>100` `fecha>=2025-01-01` `name~flor` `invoice_id=null`\n"
+    "• Orden y filas: `orden=-ship_date` `limite=30`\n"
+    "• Exportar todo: `csv` (comprimido) o `parquet`"
+)
+
+
+def _tabla_texto(datos: list, total: int) -> str:
+    # Obtenemos las columnas dinámicamente del primer registro
+    headers = list(datos[0].keys())
+    filas = [[fila.get(col, "") for col in headers] for fila in datos]
+
+    # Control de Límites de Telegram (4096 caracteres): se quitan filas enteras, no se corta a mitad
+    while filas:
+        # Usamos 'simple' para ahorrar caracteres
+        tabla_formateada = tabulate(filas, headers, tablefmt="simple")
+        pie = f"\n{len(filas)} de {total} filas" + (" · usa `csv` para todas" if total > len(filas) else "")
+        mensaje_final = f"```\n{tabla_formateada}\n```{pie}"
+        if len(mensaje_final) <= 4000 or len(filas) == 1:
+            return mensaje_final[:4000]
+        filas = filas[:-1]
+
+
 async def tablageneral(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handler para consultar contenido crudo de cualquier tabla.
     Refactorizado para usar API REST (Supabase-py) en lugar de SQL directo.
+    Con `csv`/`parquet` exporta la tabla completa (filtrada) como documento.
     """
-    args = context.args
-    
-    if not args:
-        await update.message.reply_text(
-            "⚠️ *Error de Sintaxis*\nPor favor indica la tabla.\nEjemplo: `/tablageneral customers`",
-            parse_mode="Markdown"
-        )
+    if not context.args:
+        await update.message.reply_text(USO, parse_mode="Markdown")
+        return
+
+    # Se relee el texto completo para respetar comillas: name~"playa blanca"
+    partes = update.message.text.split(maxsplit=1)
+    try:
+        consulta = interpretar_argumentos(partes[1] if len(partes) > 1 else "")
+    except ErrorConsultaTabla as e:
+        await update.message.reply_text(f"⚠️ `{e}`\n\n{USO}", parse_mode="Markdown")
+        return
+
+    nombre_tabla = consulta["tabla"]
+    if consulta["formato"]:
+        await _exportar(update, consulta)
         return
 
-    nombre_tabla = args[0]
     # Feedback inmediato al usuario
     await update.message.reply_text(f"🔍 Consultando `{nombre_tabla}` via API...", parse_mode="Markdown")
 
     try:
-        # 1. Consulta vía Cliente Oficial (Estable, puerto 443 HTTPS)
-        # Limitamos a 15 para no saturar el chat
-        response = db_client.table(nombre_tabla).select("*").limit(15).execute()
-        
-        datos = response.data
+        # Consulta vía Cliente Oficial (Estable, puerto 443 HTTPS)
+        datos, total = await asyncio.to_thread(exportador_tablas.vista_previa, consulta)
 
         if not datos:
-            await update.message.reply_text(f"📭 La tabla `{nombre_tabla}` está vacía o no existe.", parse_mode="Markdown")
+            await update.message.reply_text(f"📭 La tabla `{nombre_tabla}` está vacía o no existe (o nada cumple los filtros).", parse_mode="Markdown")
             return
 
-        # 2. Procesamiento para Tabulate
-        # Obtenemos las columnas dinámicamente del primer registro
-        headers = list(datos[0].keys())
-        
-        # Convertimos la lista de diccionarios a lista de listas
-        filas = [[fila.get(col, "") for col in headers] for fila in datos]
-
-        # 3. Formateo Visual
-        # Usamos 'simple' o 'plain' para ahorrar caracteres
-        tabla_formateada = tabulate(filas, headers, tablefmt="simple")
-
-        mensaje_final = f"```\n{tabla_formateada}\n```"
-        
-        # 4. Control de Límites de Telegram (4096 caracteres)
-        if len(mensaje_final) > 4000:
-            mensaje_final = mensaje_final[:3950] + "\n\n... [Truncado por límite de Telegram] ```"
-            
-        await update.message.reply_text(mensaje_final, parse_mode="Markdown")
+        await update.message.reply_text(_tabla_texto(datos, total), parse_mode="Markdown")
 
     except Exception as e:
         logger.error(f"Error en tablageneral: {e}")
         # Mensaje de error amigable pero técnico
         await update.message.reply_text(f"❌ Error de Consulta:\n`{str(e)}`", parse_mode="Markdown")
+
+
+async def _exportar(update: Update, consulta: dict):
+    """Exporta en un hilo; el progreso se pinta editando un solo mensaje."""
+    msg = await update.message.reply_text(f"📤 Exportando `{consulta['tabla']}` ({consulta['formato']})...", parse_mode="Markdown")
+    loop = asyncio.get_running_loop()
+    ultimo = [0.0]
+
+    def al_avanzar(hechas, total):
+        if hechas < total and time.monotonic() - ultimo[0] < INTERVALO_PROGRESO:
+            return
+        ultimo[0] = time.monotonic()
+        asyncio.run_coroutine_threadsafe(_editar(msg, f"📤 Exportando `{consulta['tabla']}`... {hechas:,}/{total:,} filas"), loop)
+
+    ruta = None
+    try:
+        ruta, nombre, filas = await asyncio.to_thread(exportador_tablas.exportar, consulta, al_avanzar)
+        if not filas:
+            await _editar(msg, f"📭 `{consulta['tabla']}` no tiene filas que cumplan los filtros.")
+            return
+
+        tamano_mb = os.path.getsize(ruta) / (1024 * 1024)
+        if tamano_mb > LIMITE_DOCUMENTO_MB:
+            await _editar(msg, f"⚠️ El archivo pesa {tamano_mb:.1f} MB (Telegram admite {LIMITE_DOCUMENTO_MB} MB). Usa `cols=` o filtros para achicarlo.")
+            return
+
+        with open(ruta, "rb") as archivo:
+            await update.message.reply_document(
+                document=archivo, filename=nombre,
+                caption=f"📄 {consulta['tabla']}: {filas:,} filas ({tamano_mb:.1f} MB)"
+            )
+        await _editar(msg, f"✅ Exportadas {filas:,} filas de `{consulta['tabla']}`.")
+
+    except ErrorConsultaTabla as e:
+        await _editar(msg, f"⚠️ `{e}`")
+    except Exception as e:
+        logger.error(f"Error exportando {consulta['tabla']}: {e}")
+        await _editar(msg, f"❌ Error de Exportación:\n`{str(e)}`")
+    finally:
+        if ruta and os.path.exists(ruta):
+            os.remove(ruta)
+
+
+async def _editar(msg, texto: str):
+    try:
+        await msg.edit_text(texto, parse_mode="Markdown")
+    except Exception:
+        pass   # Un 'message is not modified' o un límite de Telegram no detiene la exportación
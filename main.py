@@ -1,5 +1,7 @@
 import os
+import asyncio
 import logging
+from datetime import time as dtime
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import (
@@ -20,23 +22,40 @@ from handlers.help import handle_help
 from handlers.archivos import handle_file
 from handlers.tabla import set_tabla
 from handlers.tablageneral import tablageneral
+from handlers.metricas import comando_metricas
+from handlers.rfm import comando_rfm
+from handlers.backtest import comando_backtest
+from handlers.pendientes import comando_pendientes
+from handlers.buscar import comando_buscar
 
 # --- CEREBRO COMERCIAL ---
 from handlers.gestion_pedidos import (
     comando_sugerir_pedido, 
-    procesar_callback_pedido, 
     recibir_ajuste_precio, 
-    comando_rutina_diaria
+    recibir_linea_carrito,
+    comando_rutina_diaria,
+    preparar_cronograma
 )
-from handlers.facturacion import comando_generar_factura
+from services.motor_ventas import ZONA_NEGOCIO
+from handlers.facturacion import comando_generar_factura, comando_facturar_lote
 
 # --- EL NUEVO ORDEN: PANEL DE CONTROL ---
-from handlers.panel_control import comando_panel, router_panel, procesar_input_panel
+from handlers.panel_control import comando_panel, procesar_input_panel, vigilar_cambios_panel, PANEL_POLL_SEG
+from services.enrutador import enrutador
+from services.buffer_escritura import buffer_panel
+from services.motor_rfm import motor_rfm
+from services.precios_historicos import almacen_precios
+from services.indice_empaque import indice_empaque
+from services.config_cajas import config_cajas
+from services.facturacion_lote import facturador_lote
+from services.indice_busqueda import indice_busqueda
+from services.buscador_productos import buscador_productos
 
 # Configuración
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 N8N_WEBHOOK_URL = os.getenv("N8N_WEBHOOK_URL")
+RUTINA_HORA = int(os.getenv("RUTINA_HORA", "6"))
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -55,29 +74,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="HTML"
     )
 
-# --- 1. ROUTER GLOBAL DE BOTONES (El Guardián Corregido) ---
+# --- 1. ROUTER GLOBAL DE BOTONES (Despacho por prefijo exacto) ---
 async def global_callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    data = str(query.data)
-
-    # LISTA DE INVITADOS ACTUALIZADA:
-    # Agregué: 'menu_', 'page_', 'action_', 'create_' que faltaban.
-    patrones_panel = [
-        "panel_", "view_", "menu_", "page_", "action_", 
-        "create_", "edit_", "gest_", "cat_", "approve_"
-    ]
-
-    # Si el botón contiene CUALQUIERA de las llaves del panel:
-    if any(key in data for key in patrones_panel):
-        await router_panel(update, context)
-    
-    else:
-        # Si no, va al flujo antiguo (Sugerencias/Pedidos)
-        await procesar_callback_pedido(update, context)
+    # Las rutas se registran al importar los handlers (panel_control, gestion_pedidos).
+    # callback_data = '<ruta>:<args>' -> una búsqueda en diccionario, sin escaneos de substrings.
+    await enrutador.despachar(update, context)
 
 # --- 2. ROUTER GLOBAL DE TEXTO ---
 async def handle_message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
+    # A0: Usuario agregando PRODUCTO al carrito (/sugerir)
+    if context.user_data.get('carrito_esperando'):
+        await recibir_linea_carrito(update, context)
+        return
+
     # A: Usuario editando PRECIO (/sugerir)
     if context.user_data.get('prediccion_activa_id'):
         await recibir_ajuste_precio(update, context)
@@ -119,8 +129,30 @@ async def handle_message_n8n(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except Exception as e:
         await update.message.reply_text(f"💥 Error: {e}")
 
+# --- 4. ARRANQUE: MOTORES EN MEMORIA ---
+async def _cargar_motor(nombre: str, cargar):
+    try:
+        await asyncio.to_thread(cargar)
+    except Exception as e:
+        logging.error(f"No se pudo cargar {nombre} (se usará el cálculo anterior): {e}")
+
+async def al_iniciar(application):
+    # En segundo plano: el bot responde mientras se lee el historial
+    asyncio.create_task(_cargar_motor("el motor RFM", motor_rfm.cargar))
+    asyncio.create_task(_cargar_motor("el almacén de precios", almacen_precios.cargar))
+    asyncio.create_task(_cargar_motor("el índice de empaque", indice_empaque.cargar))
+    asyncio.create_task(_cargar_motor("la configuración de cajas", config_cajas.cargar))
+    asyncio.create_task(_cargar_motor("el índice de búsqueda", indice_busqueda.cargar))
+    asyncio.create_task(_cargar_motor("el buscador de productos", buscador_productos.cargar))
+
+# --- 5. APAGADO LIMPIO ---
+async def al_apagar(application):
+    # Lo que quede en el buffer del panel no se puede perder en un reinicio
+    await buffer_panel.vaciar()
+    facturador_lote.cerrar()
+
 if __name__ == "__main__":
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(al_iniciar).post_shutdown(al_apagar).build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", handle_help))
@@ -133,12 +165,27 @@ if __name__ == "__main__":
     app.add_handler(CommandHandler("sugerir", comando_sugerir_pedido))
     app.add_handler(CommandHandler("rutina", comando_rutina_diaria))
     app.add_handler(CommandHandler("factura", comando_generar_factura))
+    # /facturar y los atajos /facturar_<CLIENTE> que imprime /pendientes
+    app.add_handler(MessageHandler(filters.Regex(r"^/facturar(_\S+)?(@\w+)?(\s|$)"), comando_facturar_lote))
     app.add_handler(CommandHandler("panel", comando_panel)) 
+    app.add_handler(CommandHandler("metricas", comando_metricas))
+    app.add_handler(CommandHandler("rfm", comando_rfm))
+    app.add_handler(CommandHandler("backtest", comando_backtest))
+    app.add_handler(CommandHandler("pendientes", comando_pendientes))
+    app.add_handler(CommandHandler("buscar", comando_buscar))
 
     app.add_handler(MessageHandler(filters.Document.ALL, handle_file))
 
     app.add_handler(CallbackQueryHandler(global_callback_router))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message_router))
 
+    # Vigía del /panel (requiere python-telegram-bot[job-queue])
+    # y cronograma matutino del /rutina
+    if app.job_queue:
+        app.job_queue.run_repeating(vigilar_cambios_panel, interval=PANEL_POLL_SEG, first=PANEL_POLL_SEG)
+        app.job_queue.run_daily(preparar_cronograma, time=dtime(hour=RUTINA_HORA, tzinfo=ZONA_NEGOCIO))
+    else:
+        logging.warning("JobQueue no disponible: el /panel no se refrescará solo y /rutina se calculará al vuelo.")
+
     print("🤖 J&G Bot Operativo y Corregido.")
     app.run_polling()
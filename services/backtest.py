@@ -0,0 +1,191 @@
+import io
+import csv
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+from services.cliente_supabase import db_client
+
+logger = logging.getLogger(__name__)
+
+TAMANO_PAGINA = 1000
+ESTRATEGIAS = ("PROSPECCION", "REACTIVACION", "MANTENIMIENTO")
+TOLERANCIA_ACIERTO = 0.05   # Sugerencia "acertada" si queda a ±5% del precio de cierre
+
+# Proyección mínima: solo las llaves del JSON que el backtest necesita
+COLUMNAS = (
+    "id, "
+    "estrategia:bot_suggestion->>estrategia_aplicada, "
+    "sugerido:bot_suggestion->>precio_unitario, "
+    "real:user_correction->>precio_cierre, "
+    "ticket:input_context->>promedio_historico, "
+    "ultimo:input_context->>precio_ultimo, "
+    "mediana:input_context->>precio_mediana"
+)
+
+
+def _num(valor) -> float:
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+# --- REGLAS DE PRECIO A REPRODUCIR ---
+# Cada regla recibe el historial en arreglos y devuelve un arreglo de precios (vectorizado).
+# Donde una regla no tiene dato (p.ej. sugerencias previas al almacén de precios) cae a lo sugerido.
+
+def _regla_registrada(h):
+    return h["sugerido"]
+
+def _regla_ticket(h):
+    """La regla original: ticket promedio, -8% en reactivación."""
+    factor = np.where(h["estrategia"] == ESTRATEGIAS.index("REACTIVACION"), 0.92, 1.0)
+    return np.where(h["estrategia"] == ESTRATEGIAS.index("PROSPECCION"), 0.0, h["ticket"] * factor)
+
+def _regla_ultimo(h):
+    return np.where(np.isnan(h["ultimo"]), h["sugerido"], h["ultimo"])
+
+def _regla_mediana(h):
+    return np.where(np.isnan(h["mediana"]), h["sugerido"], h["mediana"])
+
+def _regla_mediana_retorno(h):
+    factor = np.where(h["estrategia"] == ESTRATEGIAS.index("REACTIVACION"), 0.92, 1.0)
+    return _regla_mediana(h) * factor
+
+def _regla_mezcla(h):
+    """Mitad último precio, mitad mediana: amortigua picos sin perder la tendencia."""
+    return (_regla_ultimo(h) + _regla_mediana(h)) / 2
+
+REGLAS = {
+    "registrada": _regla_registrada,
+    "ticket_promedio": _regla_ticket,
+    "ultimo_precio": _regla_ultimo,
+    "mediana": _regla_mediana,
+    "mediana_retorno_92": _regla_mediana_retorno,
+    "mezcla_ultimo_mediana": _regla_mezcla,
+}
+
+
+class Backtester:
+    """
+    El Juez de Precios.
+    Compara lo que sugirió el bot contra el precio de cierre que puso el usuario
+    (prediction_history.user_correction) y reproduce reglas alternativas sobre
+    la misma historia, sin tocar producción.
+    """
+
+    def __init__(self):
+        self.db = db_client
+
+    # --- LECTURA ---
+    def _pagina(self, inicio: int, contar: bool = False):
+        return self.db.table("prediction_history")\
+            .select(COLUMNAS, count="exact" if contar else None)\
+            .not_.is_("user_correction", "null")\
+            .order("id")\
+            .range(inicio, inicio + TAMANO_PAGINA - 1)\
+            .execute()
+
+    def cargar_historial(self) -> dict:
+        """Lee todo lo corregido en páginas (la primera trae el conteo, el resto va en paralelo)."""
+        primera = self._pagina(0, contar=True)
+        filas = list(primera.data or [])
+        total = primera.count or len(filas)
+
+        inicios = range(TAMANO_PAGINA, total, TAMANO_PAGINA)
+        if inicios:
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                for res in pool.map(self._pagina, inicios):
+                    filas.extend(res.data or [])
+
+        codigo = {e: i for i, e in enumerate(ESTRATEGIAS)}
+        historial = {
+            "estrategia": np.array([codigo.get(f.get("estrategia"), -1) for f in filas], dtype=np.int64),
+            **{
+                campo: np.array([_num(f.get(campo)) for f in filas], dtype=np.float64)
+                for campo in ("sugerido", "real", "ticket", "ultimo", "mediana")
+            },
+        }
+        validos = (historial["estrategia"] >= 0) & (historial["real"] > 0) & ~np.isnan(historial["sugerido"])
+        return {k: v[validos] for k, v in historial.items()}
+
+    # --- MÉTRICAS ---
+    @staticmethod
+    def metricas(estrategia: np.ndarray, prediccion: np.ndarray, real: np.ndarray) -> dict:
+        """Error por estrategia con bincount: n, MAE, MAPE, sesgo, RMSE y % de aciertos."""
+        k = len(ESTRATEGIAS)
+        error = np.nan_to_num(prediccion, nan=0.0) - real
+        n = np.bincount(estrategia, minlength=k)
+        suma = lambda pesos: np.bincount(estrategia, weights=pesos, minlength=k)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mae = suma(np.abs(error)) / n
+            mape = suma(np.abs(error) / real) / n * 100
+            sesgo = suma(error) / n
+            rmse = np.sqrt(suma(error ** 2) / n)
+            acierto = suma((np.abs(error) <= TOLERANCIA_ACIERTO * real).astype(np.float64)) / n * 100
+
+        return {
+            nombre: {
+                "n": int(n[i]),
+                "mae": float(mae[i]), "mape": float(mape[i]), "sesgo": float(sesgo[i]),
+                "rmse": float(rmse[i]), "acierto_pct": float(acierto[i]),
+            }
+            for i, nombre in enumerate(ESTRATEGIAS) if n[i]
+        }
+
+    def ejecutar(self, historial: dict, reglas: dict = None) -> dict:
+        """{regla: {estrategia: métricas}} — cada regla se reproduce en su propio hilo."""
+        reglas = reglas or REGLAS
+
+        def evaluar(item):
+            nombre, regla = item
+            return nombre, self.metricas(historial["estrategia"], regla(historial), historial["real"])
+
+        with ThreadPoolExecutor(max_workers=len(reglas)) as pool:
+            return dict(pool.map(evaluar, reglas.items()))
+
+    # --- REPORTE ---
+    def generar_reporte(self):
+        """
+        Retorna (archivo_csv: BytesIO | None, resumen: str).
+        El resumen dice qué regla gana en cada estrategia (menor MAPE).
+        """
+        historial = self.cargar_historial()
+        total = len(historial["real"])
+        if total == 0:
+            return None, "📭 No hay sugerencias con precio de cierre registrado todavía."
+
+        resultados = self.ejecutar(historial)
+
+        texto = io.StringIO()
+        escritor = csv.writer(texto)
+        escritor.writerow(["regla", "estrategia", "n", "mae", "mape_pct", "sesgo", "rmse", "acierto_pct"])
+        for regla, por_estrategia in resultados.items():
+            for estrategia, m in por_estrategia.items():
+                escritor.writerow([
+                    regla, estrategia, m["n"], f"{m['mae']:.4f}", f"{m['mape']:.2f}",
+                    f"{m['sesgo']:.4f}", f"{m['rmse']:.4f}", f"{m['acierto_pct']:.1f}"
+                ])
+
+        archivo = io.BytesIO(texto.getvalue().encode("utf-8"))
+        archivo.name = f"backtest_precios_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
+
+        resumen = f"🧪 <b>Backtest de Precios</b> ({total} correcciones)\n━━━━━━━━━━━━━━━━━━━━━━\n"
+        actual = resultados["registrada"]
+        for estrategia in ESTRATEGIAS:
+            # En empate gana la regla actual: no vale la pena cambiar por nada
+            candidatos = [(r[estrategia]["mape"], nombre != "registrada", nombre) for nombre, r in resultados.items() if estrategia in r]
+            if not candidatos:
+                continue
+            mape_ganador, _, ganador = min(candidatos)
+            resumen += (
+                f"<b>{estrategia}</b> (n={actual[estrategia]['n']})\n"
+                f"   Actual: MAPE {actual[estrategia]['mape']:.1f}% | ±5%: {actual[estrategia]['acierto_pct']:.0f}%\n"
+                f"   Mejor: <code>{ganador}</code> MAPE {mape_ganador:.1f}%\n"
+            )
+        return archivo, resumen
+
+
+# Instancia singleton
+backtester = Backtester()
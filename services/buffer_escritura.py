@@ -0,0 +1,100 @@
+import os
+import asyncio
+import logging
+from services.supabase_client import supabase
+
+logger = logging.getLogger(__name__)
+
+# Interruptor y ventana de coalescencia (segundos). Apagado = escritura síncrona de siempre.
+WRITE_BEHIND_ACTIVO = os.getenv("PANEL_WRITE_BEHIND", "0").lower() in ("1", "true", "si", "yes")
+VENTANA_SEGUNDOS = float(os.getenv("PANEL_WRITE_BEHIND_SEG", "2.0"))
+
+
+class BufferEscritura:
+    """
+    El Escriba Diferido.
+    Acumula las ediciones del panel durante una ventana corta y las funde:
+    N ediciones sobre la misma fila = 1 PATCH; M filas con el mismo parche = 1 PATCH con 'in'.
+    El usuario recibe confirmación optimista al instante; si la DB falla, se le avisa después.
+    """
+
+    def __init__(self, tabla: str, ventana: float = VENTANA_SEGUNDOS):
+        self.tabla = tabla
+        self.ventana = ventana
+        self._pendientes = {}   # row_id -> {columna: valor}
+        self._avisar = {}       # row_id -> {chat_id}
+        self._en_vuelo = {}     # lo que se está enviando en este momento
+        self._bot = None
+        self._tarea = None
+        # Un vaciado a la vez: el de fondo y el del apagado no se pisan ni reordenan escrituras
+        self._lock = asyncio.Lock()
+
+    def encolar(self, row_id: str, columna: str, valor, chat_id: int, bot):
+        """Registra la edición y agenda el vaciado si no hay uno en camino."""
+        self._pendientes.setdefault(row_id, {})[columna] = valor
+        self._avisar.setdefault(row_id, set()).add(chat_id)
+        self._bot = bot
+
+        if self._tarea is None or self._tarea.done():
+            self._tarea = asyncio.create_task(self._vaciar_tras_ventana())
+
+    def pendiente(self, row_id: str) -> dict:
+        """Lo que aún no llegó a la DB para esa fila (para que las vistas lean lo último)."""
+        return {**self._en_vuelo.get(row_id, {}), **self._pendientes.get(row_id, {})}
+
+    async def _vaciar_tras_ventana(self):
+        while self._pendientes:
+            await asyncio.sleep(self.ventana)
+            await self.vaciar()
+
+    async def vaciar(self):
+        """Envía todo lo acumulado. Se puede llamar a mano (p.ej. al apagar el bot)."""
+        async with self._lock:
+            if not self._pendientes:
+                return
+
+            lote, self._pendientes = self._pendientes, {}
+            avisar, self._avisar = self._avisar, {}
+            self._en_vuelo = lote
+
+            # Agrupamos filas que recibieron exactamente el mismo parche
+            grupos = {}
+            for row_id, parche in lote.items():
+                grupos.setdefault(tuple(sorted(parche.items())), []).append(row_id)
+
+            try:
+                for clave, ids in grupos.items():
+                    parche = dict(clave)
+                    try:
+                        await asyncio.to_thread(self._aplicar, parche, ids)
+                    except Exception as e:
+                        logger.error(f"Write-behind falló en {self.tabla} {ids}: {e}")
+                        await self._reportar_fallo(parche, ids, avisar, e)
+            finally:
+                self._en_vuelo = {}
+
+    def _aplicar(self, parche: dict, ids: list):
+        query = supabase.table(self.tabla).update(parche)
+        if len(ids) == 1:
+            query = query.eq("id", ids[0])
+        else:
+            query = query.in_("id", ids)
+        query.execute()
+
+    async def _reportar_fallo(self, parche: dict, ids: list, avisar: dict, error: Exception):
+        if not self._bot:
+            return
+        campos = ", ".join(f"{k}={v}" for k, v in parche.items())
+        chats = set().union(*(avisar.get(i, set()) for i in ids))
+        for chat_id in chats:
+            try:
+                await self._bot.send_message(
+                    chat_id,
+                    f"❌ No se guardó ({campos}) en {len(ids)} orden(es).\nError DB: {error}\nVuelve a editar el campo."
+                )
+            except Exception as e:
+                logger.error(f"No pude avisar el fallo al chat {chat_id}: {e}")
+
+
+# Instancia singleton para el panel (staging_komet)
+buffer_panel = BufferEscritura("staging_komet")
@@ -0,0 +1,283 @@
+import os
+import re
+import math
+import time
+import bisect
+import logging
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from services.cliente_supabase import db_client
+from services.indice_empaque import tokenizar
+from services.eventos import (
+    suscribir, ORDENES_REGISTRADAS, REGLAS_EMPAQUE_ACTUALIZADAS, FILAS_KOMET_IMPORTADAS
+)
+
+logger = logging.getLogger(__name__)
+
+TAMANO_PAGINA = 1000
+TTL_SEGUNDOS = float(os.getenv("BUSCADOR_TTL_SEG", "3600"))
+MAX_ORDENES_PRODUCTO = 20     # Solo las más recientes: un producto popular no infla la memoria
+MAX_EXPANSION_PREFIJO = 50    # 'mon' -> a lo sumo 50 palabras del vocabulario
+
+COLUMNAS_ITEMS = "order_id, customer_code, product_name, unit_price, sales_price, sales_orders(po_number, ship_date)"
+COLUMNAS_KOMET = "id, po_komet, customer_code, product_name, ship_date, unit_price_purchase"
+COLUMNAS_REGLAS = "id, customer_code, product_name"
+
+
+@lru_cache(maxsize=50000)   # Miles de filas repiten el mismo product_name
+def palabras_producto(texto) -> tuple:
+    """'Freedom 50CM' -> ('freedom', '50', 'cm'): la medida pegada se separa para que '50' la encuentre."""
+    return tuple(p for t in tokenizar(texto) for p in re.findall(r"[0-9]+|[a-z]+", t))
+
+
+def _fecha(valor) -> str:
+    return str(valor or "")[:10]
+
+
+class BuscadorProductos:
+    """
+    El Catálogo Vivo.
+    Índice invertido palabra -> producto sobre los product_name de sales_items,
+    staging_komet y customer_packing_rules. Cada producto guarda sus órdenes más
+    recientes, el último precio por cliente y qué clientes tienen regla de empaque.
+    """
+
+    def __init__(self, ttl: float = TTL_SEGUNDOS):
+        self.ttl = ttl
+        self.listo = False
+        self._lock = threading.Lock()
+        self._productos = {}      # nombre normalizado -> ficha
+        self._tokens = {}         # palabra -> {nombre normalizado}
+        self._vocabulario = []    # palabras ordenadas (prefijos con bisect)
+        self._cargado_en = 0.0
+        self._recargando = False
+        suscribir(ORDENES_REGISTRADAS, self._al_registrar_ordenes)
+        suscribir(FILAS_KOMET_IMPORTADAS, self._al_importar_komet)
+        suscribir(REGLAS_EMPAQUE_ACTUALIZADAS, self._al_actualizar_reglas)
+
+    # --- CARGA ---
+    @staticmethod
+    def _leer(tabla: str, columnas: str, filtro=None) -> list:
+        """Primera página con conteo; el resto en paralelo."""
+        def pagina(inicio, contar=False):
+            query = db_client.table(tabla).select(columnas, count="exact" if contar else None)
+            if filtro:
+                query = filtro(query)
+            return query.order("id").range(inicio, inicio + TAMANO_PAGINA - 1).execute()
+
+        primera = pagina(0, contar=True)
+        filas = list(primera.data or [])
+        inicios = range(TAMANO_PAGINA, primera.count or len(filas), TAMANO_PAGINA)
+        if inicios:
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                for res in pool.map(pagina, inicios):
+                    filas.extend(res.data or [])
+        return filas
+
+    @staticmethod
+    def _resultado(tabla: str, futuro) -> list:
+        """Una fuente que falla no tumba las demás: se sigue sin sus filas hasta el próximo TTL."""
+        try:
+            return futuro.result()
+        except Exception as e:
+            logger.warning(f"Buscador de productos: no se pudo leer {tabla}: {e}")
+            return []
+
+    def cargar(self):
+        """Lectura completa (arranque y vencimiento del TTL). Una fuente que falla no tumba las demás."""
+        try:
+            with ThreadPoolExecutor(max_workers=3) as pool:
+                items = pool.submit(self._leer, "sales_items", COLUMNAS_ITEMS)
+                komet = pool.submit(self._leer, "staging_komet", COLUMNAS_KOMET)
+                reglas = pool.submit(self._leer, "customer_packing_rules", COLUMNAS_REGLAS)
+
+            productos, tokens = {}, {}
+            self._agregar_items(productos, tokens, self._resultado("sales_items", items))
+            self._agregar_komet(productos, tokens, self._resultado("staging_komet", komet))
+            self._agregar_reglas(productos, tokens, self._resultado("customer_packing_rules", reglas))
+
+            with self._lock:
+                self._productos, self._tokens = productos, tokens
+                self._vocabulario = sorted(tokens)
+                self._cargado_en = time.monotonic()
+                self.listo = True
+            logger.info(f"🔤 Buscador de productos cargado: {len(productos)} productos, {len(tokens)} palabras.")
+        finally:
+            self._recargando = False
+
+    # --- ARMADO DE FICHAS ---
+    @staticmethod
+    def _ficha(productos: dict, tokens: dict, nombre) -> dict:
+        palabras = palabras_producto(nombre)
+        if not palabras:
+            return None
+        clave = " ".join(palabras)
+        ficha = productos.get(clave)
+        if ficha is None:
+            ficha = productos[clave] = {
+                "nombre": " ".join(str(nombre).split()),
+                "fuentes": set(),
+                "ordenes": [],        # [(fecha, po, cliente, fuente)] más recientes primero
+                "precios": {},        # cliente -> (fecha, precio, po)
+                "reglas": set(),      # clientes con regla de empaque para este producto
+            }
+            for p in set(palabras):
+                tokens.setdefault(p, set()).add(clave)
+        return ficha
+
+    @staticmethod
+    def _anotar_orden(ficha: dict, fecha: str, po, cliente, fuente: str):
+        entrada = (fecha, str(po or ""), cliente, fuente)
+        ordenes = ficha["ordenes"]
+        if len(ordenes) >= MAX_ORDENES_PRODUCTO and fecha < ordenes[-1][0]:
+            return     # Más vieja que todas las guardadas: no entra
+        ordenes = [o for o in ficha["ordenes"] if o[1] != entrada[1] or o[3] != fuente]
+        ordenes.append(entrada)
+        ordenes.sort(key=lambda o: o[0], reverse=True)
+        ficha["ordenes"] = ordenes[:MAX_ORDENES_PRODUCTO]
+
+    @staticmethod
+    def _anotar_precio(ficha: dict, cliente: str, fecha: str, precio, po):
+        try:
+            precio = float(precio or 0)
+        except (TypeError, ValueError):
+            return
+        if cliente and precio > 0 and fecha >= ficha["precios"].get(cliente, ("",))[0]:
+            ficha["precios"][cliente] = (fecha, precio, str(po or ""))
+
+    def _agregar_items(self, productos, tokens, filas):
+        for f in filas:
+            ficha = self._ficha(productos, tokens, f.get("product_name"))
+            if ficha is None:
+                continue
+            orden = f.get("sales_orders") or {}
+            cliente = str(f.get("customer_code") or "").strip()
+            fecha = _fecha(orden.get("ship_date") or f.get("fecha"))
+            po = orden.get("po_number") or f.get("po_number")
+            ficha["fuentes"].add("ventas")
+            self._anotar_orden(ficha, fecha, po, cliente, "ventas")
+            self._anotar_precio(ficha, cliente, fecha, f.get("unit_price") or f.get("sales_price"), po)
+
+    def _agregar_komet(self, productos, tokens, filas):
+        for f in filas:
+            ficha = self._ficha(productos, tokens, f.get("product_name"))
+            if ficha is None:
+                continue
+            ficha["fuentes"].add("komet")
+            self._anotar_orden(ficha, _fecha(f.get("ship_date")), f.get("po_komet"),
+                               str(f.get("customer_code") or "").strip(), "komet")
+
+    def _agregar_reglas(self, productos, tokens, filas):
+        for f in filas:
+            ficha = self._ficha(productos, tokens, f.get("product_name"))
+            cliente = str(f.get("customer_code") or "").strip()
+            if ficha is not None and cliente:
+                ficha["fuentes"].add("reglas")
+                ficha["reglas"].add(cliente)
+
+    # --- ACTUALIZACIÓN INCREMENTAL ---
+    def _incorporar(self, agregar, filas):
+        if not self.listo or not filas:
+            return
+        with self._lock:
+            nuevas = set(self._tokens)
+            agregar(self._productos, self._tokens, filas)
+            for palabra in self._tokens.keys() - nuevas:
+                bisect.insort(self._vocabulario, palabra)
+
+    def _al_registrar_ordenes(self, ordenes: list, **_):
+        self._incorporar(self._agregar_items, [
+            {"product_name": o.get("nombre"), "customer_code": o.get("customer_code"),
+             "fecha": o.get("fecha"), "po_number": o.get("po_number"), "unit_price": o.get("precio")}
+            for o in ordenes
+        ])
+
+    def _al_importar_komet(self, filas: list, **_):
+        self._incorporar(self._agregar_komet, filas)
+
+    def _al_actualizar_reglas(self, clientes=None, **_):
+        if not self.listo or not clientes:
+            return
+        try:
+            filas = self._leer("customer_packing_rules", COLUMNAS_REGLAS,
+                               filtro=lambda q: q.in_("customer_code", list(clientes)))
+        except Exception as e:
+            logger.error(f"No se pudieron releer reglas para el buscador: {e}")
+            return
+        self._incorporar(self._agregar_reglas, filas)
+
+    def _vigilar_ttl(self):
+        """Si venció, se recarga en otro hilo; mientras tanto se sirve lo que hay."""
+        if self._recargando or time.monotonic() - self._cargado_en < self.ttl:
+            return
+        self._recargando = True
+
+        def recargar():
+            try:
+                self.cargar()
+            except Exception as e:
+                logger.error(f"Recarga del buscador de productos falló: {e}")
+
+        threading.Thread(target=recargar, name="buscador_productos", daemon=True).start()
+
+    # --- CONSULTAS ---
+    def _expandir(self, palabra: str) -> list:
+        """La palabra y las del vocabulario que empiezan por ella ('mond' -> 'mondial')."""
+        i = bisect.bisect_left(self._vocabulario, palabra)
+        encontradas = []
+        while i < len(self._vocabulario) and len(encontradas) < MAX_EXPANSION_PREFIJO \
+                and self._vocabulario[i].startswith(palabra):
+            encontradas.append(self._vocabulario[i])
+            i += 1
+        return encontradas
+
+    def buscar(self, texto: str, limite: int = 5) -> list:
+        """
+        Fichas ordenadas por relevancia (None si no está cargado).
+        Primero las que contienen TODAS las palabras (o un prefijo de ellas); puntaje = Σ idf.
+        """
+        if not self.listo:
+            return None
+        self._vigilar_ttl()
+        palabras = list(dict.fromkeys(palabras_producto(texto)))
+        if not palabras:
+            return []
+
+        with self._lock:
+            total = max(len(self._productos), 1)
+            puntajes, coincidencias = {}, {}
+            for palabra in palabras:
+                vistos = set()
+                for variante in self._expandir(palabra):
+                    claves = self._tokens[variante]
+                    idf = math.log(1 + total / len(claves))
+                    # Coincidencia por prefijo vale un poco menos que la exacta
+                    peso = idf if variante == palabra else idf * 0.8
+                    for clave in claves:
+                        if clave in vistos:
+                            continue
+                        vistos.add(clave)
+                        puntajes[clave] = puntajes.get(clave, 0.0) + peso
+                        coincidencias[clave] = coincidencias.get(clave, 0) + 1
+
+            orden = sorted(
+                puntajes,
+                key=lambda c: (-coincidencias[c], -puntajes[c], -len(self._productos[c]["ordenes"]), c)
+            )[:limite]
+            return [
+                {
+                    **self._productos[c],
+                    "fuentes": sorted(self._productos[c]["fuentes"]),
+                    "reglas": sorted(self._productos[c]["reglas"]),
+                    "precios": dict(self._productos[c]["precios"]),
+                    "ordenes": list(self._productos[c]["ordenes"]),
+                    "puntaje": round(puntajes[c], 3),
+                    "completa": coincidencias[c] == len(palabras),
+                }
+                for c in orden
+            ]
+
+
+# Instancia singleton: se carga al arrancar el bot (main.py)
+buscador_productos = BuscadorProductos()
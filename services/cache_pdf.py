@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from services.generador_pdf import VERSION_PLANTILLA
+
+logger = logging.getLogger(__name__)
+
+DIRECTORIO_CACHE = os.getenv("PDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), "jg_pdf_cache"))
+MAX_MB_CACHE = float(os.getenv("PDF_CACHE_MB", "200"))
+
+
+class CachePDF:
+    """
+    El Archivo de Copias.
+    PDFs ya dibujados en disco, con nombre = hash del contenido (cabecera + items + cliente
+    + versión de plantilla). Si la orden no cambió, el hash es el mismo y se reenvía la copia;
+    cualquier edición cambia el hash y obliga a redibujar. Tope de tamaño con desalojo LRU.
+    """
+
+    def __init__(self, directorio: str = DIRECTORIO_CACHE, max_bytes: int = int(MAX_MB_CACHE * 1024 * 1024)):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._archivos = None     # nombre -> bytes, del menos al más recientemente usado
+        self._total = 0
+
+    @staticmethod
+    def clave(paquete) -> str:
+        """Hash estable de (orden, items, cliente): el orden de llaves no afecta."""
+        contenido = json.dumps(
+            {"plantilla": VERSION_PLANTILLA, "paquete": paquete},
+            sort_keys=True, default=str, separators=(",", ":")
+        )
+        return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+    def _indice(self):
+        """Se arma al primer uso leyendo el directorio (los más viejos por mtime, primero)."""
+        if self._archivos is None:
+            os.makedirs(self.directorio, exist_ok=True)
+            entradas = []
+            for nombre in os.listdir(self.directorio):
+                if nombre.endswith(".pdf"):
+                    st = os.stat(os.path.join(self.directorio, nombre))
+                    entradas.append((st.st_mtime, nombre, st.st_size))
+            self._archivos = OrderedDict((n, t) for _, n, t in sorted(entradas))
+            self._total = sum(self._archivos.values())
+        return self._archivos
+
+    def _ruta(self, clave: str, tipo: str) -> str:
+        return os.path.join(self.directorio, f"{clave}_{tipo}.pdf")
+
+    def obtener(self, clave: str, tipo: str):
+        """bytes del PDF guardado o None."""
+        nombre = f"{clave}_{tipo}.pdf"
+        with self._lock:
+            archivos = self._indice()
+            if nombre not in archivos:
+                return None
+            ruta = self._ruta(clave, tipo)
+            try:
+                with open(ruta, "rb") as f:
+                    datos = f.read()
+                os.utime(ruta)          # Usado ahora: sobrevive al próximo desalojo
+            except OSError:
+                self._total -= archivos.pop(nombre)
+                return None
+            archivos.move_to_end(nombre)
+            return datos
+
+    def guardar(self, clave: str, tipo: str, datos: bytes):
+        nombre = f"{clave}_{tipo}.pdf"
+        with self._lock:
+            archivos = self._indice()
+            ruta = self._ruta(clave, tipo)
+            try:
+                # Escritura atómica: otro proceso nunca lee un PDF a medias
+                fd, temporal = tempfile.mkstemp(dir=self.directorio, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(datos)
+                os.replace(temporal, ruta)
+            except OSError as e:
+                logger.warning(f"No se pudo guardar {nombre} en la caché de PDFs: {e}")
+                return
+
+            self._total += len(datos) - archivos.pop(nombre, 0)
+            archivos[nombre] = len(datos)
+            while self._total > self.max_bytes and len(archivos) > 1:
+                viejo, tamano = archivos.popitem(last=False)
+                self._total -= tamano
+                try:
+                    os.remove(os.path.join(self.directorio, viejo))
+                except OSError:
+                    pass
+
+
+# Instancia singleton
+cache_pdf = CachePDF()
@@ -0,0 +1,59 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class CacheTTL:
+    """
+    Memoria de corto plazo.
+    Diccionario con caducidad por entrada y tope de tamaño (descarta la menos usada).
+    Seguro entre hilos: los servicios lo consultan desde asyncio.to_thread y pools.
+    """
+
+    _VACIO = object()
+
+    def __init__(self, ttl_segundos: float, max_items: int = 1000):
+        self.ttl = ttl_segundos
+        self.max_items = max_items
+        self._datos = OrderedDict()  # clave -> (expira, valor)
+        self._lock = threading.Lock()
+
+    def get(self, clave, default=None):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return default
+            expira, valor = entrada
+            if expira < time.monotonic():
+                del self._datos[clave]
+                return default
+            self._datos.move_to_end(clave)
+            return valor
+
+    def set(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + self.ttl, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+
+    def obtener_o_calcular(self, clave, calcular):
+        """Devuelve lo cacheado o ejecuta calcular() y lo guarda (None no se cachea)."""
+        valor = self.get(clave, self._VACIO)
+        if valor is not self._VACIO:
+            return valor
+        valor = calcular()
+        if valor is not None:
+            self.set(clave, valor)
+        return valor
+
+    def invalidar(self, clave=_VACIO):
+        """Sin argumentos vacía todo; con clave, solo esa entrada."""
+        with self._lock:
+            if clave is self._VACIO:
+                self._datos.clear()
+            else:
+                self._datos.pop(clave, None)
+
+    def __len__(self):
+        return len(self._datos)
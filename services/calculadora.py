@@ -1,6 +1,8 @@
 # services/calculadora.py
 from decimal import Decimal, ROUND_HALF_UP
 import logging
+import numpy as np
+from services.config_cajas import config_cajas
 
 logger = logging.getLogger(__name__)
 
@@ -12,16 +14,47 @@ class CalculadoraFloral:
     """
 
     # Constantes de Factores de Empaque (Heurística basada en tu Excel)
-    # Si estos cambian por finca, deberían venir de la base de datos.
-    # Por ahora, estandarizamos la realidad.
+    # Lo que cambie por finca/flor vive en box_configs (services/config_cajas.py);
+    # esta tabla es el respaldo cuando no hay configuración para la combinación.
+    # Fracción de una caja Full (su inverso = cajas por Full).
     FACTORES_CAJA = {
         "EB": 0.125, # Eighth Box (Octavo)
         "QB": 0.25,  # Quarter Box (Cuarto)
         "HB": 0.50,  # Half Box (Media)
         "FB": 1.0    # Full Box (Tabaco/Grande)
     }
+    FACTOR_DEFECTO = 0.25  # Default a QB si no se sabe
 
-    def calcular_linea_pedido(self, cantidad_cajas: int, tipo_caja: str, tallos_por_ramo: int, ramos_por_caja_full: int, precio_unitario: float):
+    # Precios en millonésimas de dólar: enteros exactos para precios de hasta 6 decimales
+    ESCALA_PRECIO = 1_000_000
+    _MICROS_POR_CENTAVO = ESCALA_PRECIO // 100
+
+    # Hasta cuántos ramos por caja física se exige que la ida a Full y la vuelta den lo mismo
+    MAX_RAMOS_VERIFICADOS = 200
+
+    def factor(self, tipo_caja: str, finca: str = None, flor: str = None) -> float:
+        configurado = config_cajas.factor(tipo_caja, finca, flor)
+        if configurado is not None:
+            return configurado
+        return self.FACTORES_CAJA.get(str(tipo_caja or "").upper(), self.FACTOR_DEFECTO)
+
+    def ramos_caja_full(self, tipo_caja: str, ramos_por_caja: int, finca: str = None, flor: str = None) -> int:
+        """Ramos de una caja física -> ramos de la Full teórica (QB de 10 ramos = Full de 40)."""
+        return int(round(ramos_por_caja / self.factor(tipo_caja, finca, flor)))
+
+    @classmethod
+    def ida_y_vuelta_ok(cls, factor: float) -> bool:
+        """
+        True si todo ramo físico 1..MAX_RAMOS_VERIFICADOS sobrevive a Full y de vuelta
+        (redondeando en ambos sentidos). Con factor 0.3: 10 -> 33 -> 9.9 -> 10.
+        """
+        if not factor or factor <= 0:
+            return False
+        ramos = np.arange(1, cls.MAX_RAMOS_VERIFICADOS + 1)
+        full = np.rint(ramos / factor)
+        return bool(np.array_equal(np.rint(full * factor), ramos))
+
+    def calcular_linea_pedido(self, cantidad_cajas: int, tipo_caja: str, tallos_por_ramo: int, ramos_por_caja_full: int, precio_unitario: float, finca: str = None, flor: str = None):
         """
         Realiza la transmutación matemática de la orden.
         
@@ -31,6 +64,7 @@ class CalculadoraFloral:
             tallos_por_ramo: Generalmente 20 o 25 (Carnation vs Rose).
             ramos_por_caja_full: Cuántos ramos caben en una caja FULL teórica (Tabaco).
             precio_unitario: Precio por tallo (o por ramo, depende de tu negocio, asumo tallo).
+            finca / flor: Opcionales, para usar el factor configurado de esa finca (box_configs).
         
         Returns:
             Diccionario con la verdad matemática desglosada.
@@ -40,12 +74,13 @@ class CalculadoraFloral:
             precio = Decimal(str(precio_unitario))
             
             # 2. Determinar el factor de volumen de la caja
-            factor = self.FACTORES_CAJA.get(tipo_caja.upper(), 0.25) # Default a QB si no se sabe
+            factor = self.factor(tipo_caja, finca, flor)
             
             # 3. Calcular Ramos Reales por esa caja específica
             # En tu Excel: Qty/Box (Column K en ORDENAA)
             # Si una Full hace 80 ramos, una QB hace 20.
-            ramos_por_caja_fisica = int(ramos_por_caja_full * factor)
+            # Se redondea (no trunca): ramos_caja_full redondeó a la ida y 33 * 0.3 = 9.9 son 10 ramos
+            ramos_por_caja_fisica = int(round(ramos_por_caja_full * factor))
             
             # 4. Calcular Total de Tallos (La Masa)
             # Fórmula Excel: Quantity * Qty/Box * Stems/Bunch
@@ -68,5 +103,53 @@ class CalculadoraFloral:
             logger.error(f"Error matemático: {e}")
             return None
 
+    # --- MODO LOTE (vectorizado) ---
+    def factores(self, tipos_caja, fincas=None, flores=None) -> np.ndarray:
+        """Arreglo de tipos de caja (+ fincas/flores opcionales) -> arreglo de factores."""
+        tipos = np.asarray([str(t or "").upper() for t in tipos_caja], dtype=object)
+        if len(tipos) == 0:
+            return np.zeros(0, dtype=np.float64)
+        # 1. Lo configurado por finca/flor (NaN donde no hay fila)
+        factores = config_cajas.factores(tipos, fincas, flores)
+        # 2. El resto, con la tabla de la casa (una búsqueda por tipo distinto)
+        faltan = np.isnan(factores)
+        if faltan.any():
+            unicos, inverso = np.unique(tipos[faltan], return_inverse=True)
+            respaldo = np.array([self.FACTORES_CAJA.get(t, self.FACTOR_DEFECTO) for t in unicos], dtype=np.float64)
+            factores[faltan] = respaldo[inverso]
+        return factores
+
+    def calcular_lote(self, cantidad_cajas, tipos_caja, tallos_por_ramo, ramos_por_caja_full, precios_unitarios, fincas=None, flores=None) -> dict:
+        """
+        Misma matemática que calcular_linea_pedido para N líneas en una sola pasada de NumPy.
+        El dinero se hace en enteros (millonésimas -> centavos) con redondeo HALF_UP,
+        así el total de cada línea coincide centavo a centavo con la versión Decimal.
+
+        Retorna arreglos: total_tallos, total_ramos, ramos_por_caja, valor_centavos, valor_total.
+        """
+        cajas = np.asarray(cantidad_cajas, dtype=np.int64)
+        tallos_ramo = np.asarray(tallos_por_ramo, dtype=np.int64)
+        ramos_full = np.asarray(ramos_por_caja_full, dtype=np.float64)
+        precios = np.asarray(precios_unitarios, dtype=np.float64)
+
+        # Redondeo, igual que calcular_linea_pedido: truncar pierde un ramo con factores no binarios (0.3, 0.6)
+        ramos_por_caja = np.rint(ramos_full * self.factores(tipos_caja, fincas, flores)).astype(np.int64)
+        total_ramos = cajas * ramos_por_caja
+        total_tallos = total_ramos * tallos_ramo
+
+        # tallos * precio en millonésimas (exacto) y luego HALF_UP a centavos (lejos de cero en empates)
+        precio_micros = np.rint(precios * self.ESCALA_PRECIO).astype(np.int64)
+        valor_micros = total_tallos * precio_micros
+        signo = np.sign(valor_micros)
+        valor_centavos = signo * ((np.abs(valor_micros) + self._MICROS_POR_CENTAVO // 2) // self._MICROS_POR_CENTAVO)
+
+        return {
+            "total_tallos": total_tallos,
+            "total_ramos": total_ramos,
+            "ramos_por_caja": ramos_por_caja,
+            "valor_centavos": valor_centavos,
+            "valor_total": valor_centavos / 100,
+        }
+
 # Instancia singleton para usar en todo el bot
 calculadora = CalculadoraFloral()
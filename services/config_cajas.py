@@ -0,0 +1,147 @@
+import os
+import time
+import logging
+import threading
+import numpy as np
+from services.cliente_supabase import db_client
+
+logger = logging.getLogger(__name__)
+
+TTL_SEGUNDOS = float(os.getenv("CAJAS_TTL_SEG", "3600"))
+COMODIN = "*"
+
+
+def _norm(valor) -> str:
+    texto = str(valor or "").strip().upper()
+    return texto if texto and texto != "NAN" else COMODIN
+
+
+class ConfigCajas:
+    """
+    El Manual de Cajas.
+    Factores y empaque por defecto por (finca, tipo de caja, tipo de flor), leídos de
+    box_configs (sql/004). Una tabla diminuta: se guarda entera en un diccionario de
+    tuplas y se refresca por TTL en segundo plano. Consultar nunca toca la DB.
+    Sin datos (o sin migración) responde None y la calculadora usa sus constantes.
+    """
+
+    def __init__(self, ttl: float = TTL_SEGUNDOS):
+        self.ttl = ttl
+        self.listo = False
+        self._tabla = {}            # (finca, caja, flor) -> (factor, ramos, tallos)
+        self._cargado_en = 0.0
+        self._recargando = False
+
+    def cargar(self):
+        try:
+            filas = db_client.table("box_configs")\
+                .select("farm_code, box_type, flower_type, factor, bunches_per_box, stems_per_bunch")\
+                .execute().data or []
+            # Import tardío: la calculadora importa este módulo
+            from services.calculadora import CalculadoraFloral
+
+            tabla = {}
+            for f in filas:
+                if not f.get("factor"):
+                    continue
+                clave = (_norm(f.get("farm_code")), _norm(f.get("box_type")), _norm(f.get("flower_type")))
+                factor = float(f["factor"])
+                # Un factor que no devuelve los mismos ramos físicos al volver de Full cambia tallos y dinero
+                if not CalculadoraFloral.ida_y_vuelta_ok(factor):
+                    logger.warning(f"⚠️ box_configs {clave}: factor {factor} no conserva los ramos físicos; se ignora.")
+                    continue
+                tabla[clave] = (
+                    factor,
+                    int(f["bunches_per_box"]) if f.get("bunches_per_box") else None,
+                    int(f["stems_per_bunch"]) if f.get("stems_per_bunch") else None,
+                )
+            self._tabla = tabla
+            self._cargado_en = time.monotonic()
+            self.listo = True
+            logger.info(f"📐 Configuración de cajas cargada: {len(self._tabla)} combinaciones.")
+        finally:
+            self._recargando = False
+
+    def _vigilar_ttl(self):
+        if self._recargando or time.monotonic() - self._cargado_en < self.ttl:
+            return
+        self._recargando = True
+
+        def recargar():
+            try:
+                self.cargar()
+            except Exception as e:
+                logger.error(f"Recarga de box_configs falló: {e}")
+                self._cargado_en = time.monotonic()   # Reintento en el próximo TTL, no en cada consulta
+
+        threading.Thread(target=recargar, name="config_cajas", daemon=True).start()
+
+    def _buscar(self, finca, tipo_caja, flor):
+        """La fila más específica: finca+flor, finca, flor, o la general de esa caja."""
+        caja = _norm(tipo_caja)
+        finca, flor = _norm(finca), _norm(flor)
+        for clave in ((finca, caja, flor), (finca, caja, COMODIN), (COMODIN, caja, flor), (COMODIN, caja, COMODIN)):
+            fila = self._tabla.get(clave)
+            if fila:
+                return fila
+        return None
+
+    # --- CONSULTAS ---
+    def factor(self, tipo_caja: str, finca: str = None, flor: str = None):
+        """Fracción de Full para esa caja (None si no hay configuración)."""
+        if not self.listo:
+            return None
+        self._vigilar_ttl()
+        fila = self._buscar(finca, tipo_caja, flor)
+        return fila[0] if fila else None
+
+    def empaque(self, tipo_caja: str, finca: str = None, flor: str = None) -> dict:
+        """Ramos por caja y tallos por ramo por defecto ({} si no hay configuración)."""
+        if not self.listo:
+            return {}
+        self._vigilar_ttl()
+        fila = self._buscar(finca, tipo_caja, flor)
+        if not fila:
+            return {}
+        return {k: v for k, v in (("bunches_per_box", fila[1]), ("stems_per_bunch", fila[2])) if v}
+
+    def factores(self, tipos_caja, fincas=None, flores=None, defecto=np.nan) -> np.ndarray:
+        """Versión en lote: resuelve cada combinación distinta una sola vez."""
+        n = len(tipos_caja)
+        if not self.listo:
+            return np.full(n, defecto, dtype=np.float64)
+        fincas = fincas if fincas is not None else [None] * n
+        flores = flores if flores is not None else [None] * n
+        claves = np.array(
+            [f"{_norm(a)}\x1f{_norm(b)}\x1f{_norm(c)}" for a, b, c in zip(fincas, tipos_caja, flores)], dtype=object
+        )
+        if n == 0:
+            return np.zeros(0, dtype=np.float64)
+        unicas, inverso = np.unique(claves, return_inverse=True)
+        valores = []
+        for clave in unicas:
+            finca, caja, flor = clave.split("\x1f")
+            f = self.factor(caja, finca, flor)
+            valores.append(defecto if f is None else f)
+        return np.array(valores, dtype=np.float64)[inverso]
+
+    def empaques(self, tipos_caja, fincas=None, flores=None):
+        """(ramos_por_caja, tallos_por_ramo) por defecto en lote; 0 donde no hay configuración."""
+        n = len(tipos_caja)
+        ramos = np.zeros(n, dtype=np.float64)
+        tallos = np.zeros(n, dtype=np.float64)
+        if not self.listo or n == 0:
+            return ramos, tallos
+        fincas = fincas if fincas is not None else [None] * n
+        flores = flores if flores is not None else [None] * n
+        vistos = {}
+        for i, clave in enumerate(zip(fincas, tipos_caja, flores)):
+            if clave not in vistos:
+                vistos[clave] = self.empaque(clave[1], clave[0], clave[2])
+            ramos[i] = vistos[clave].get("bunches_per_box", 0)
+            tallos[i] = vistos[clave].get("stems_per_bunch", 0)
+        return ramos, tallos
+
+
+# Instancia singleton: se carga al arrancar el bot (main.py)
+config_cajas = ConfigCajas()
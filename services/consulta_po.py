@@ -0,0 +1,186 @@
+import os
+import asyncio
+import logging
+from services.cliente_supabase import db_client
+from services.cache_ttl import CacheTTL
+from services.eventos import suscribir, ORDENES_REGISTRADAS, IDENTIFICADORES_REGISTRADOS
+from services.indice_empaque import tokenizar
+from supabase_client import supabase_select
+
+logger = logging.getLogger(__name__)
+
+PO_TTL_SEG = float(os.getenv("PO_TTL_SEG", "30"))
+MAX_POS_CONSULTA = 50
+FUENTE_TIMEOUT_SEG = float(os.getenv("FUENTE_TIMEOUT_SEG", "10"))
+
+# Etapas de una PO, de la más avanzada a la más vieja: al deduplicar, manda la primera
+FUENTES = ("orden", "komet", "legado")
+COLUMNAS_KOMET = "id, po_komet, vendor, ship_date, customer_code, product_name, quantity_boxes, box_type, unit_price_purchase, status, status_komet"
+
+
+class ConsultaPO:
+    """
+    La Ventanilla de POs.
+    Cabecera + items de varias POs en UNA petición (select embebido + in_),
+    con una memoria corta para las que se consultan varias veces seguidas.
+    """
+
+    def __init__(self):
+        self._cache = CacheTTL(ttl_segundos=PO_TTL_SEG, max_items=500)   # po_number -> orden con 'sales_items'
+        # Re-ingestar o editar una PO la saca de la memoria: /po no muestra la versión vieja
+        suscribir(ORDENES_REGISTRADAS, self._al_registrar_ordenes)
+        suscribir(IDENTIFICADORES_REGISTRADOS, self._al_registrar_identificadores)
+
+    def buscar(self, po_numbers: list) -> dict:
+        """{po_number: orden (con lista 'sales_items')} solo de las que existen."""
+        pedidas = list(dict.fromkeys(p.strip().upper() for p in po_numbers if p and p.strip()))[:MAX_POS_CONSULTA]
+        encontradas, faltantes = {}, []
+        for po in pedidas:
+            orden = self._cache.get(po)
+            if orden is None:
+                faltantes.append(po)
+            else:
+                encontradas[po] = orden
+
+        if faltantes:
+            res = db_client.table("sales_orders")\
+                .select("*, sales_items(*)")\
+                .in_("po_number", faltantes)\
+                .execute()
+            for orden in res.data or []:
+                po = str(orden.get('po_number') or '').upper()
+                if po and po not in encontradas:
+                    orden['sales_items'] = orden.get('sales_items') or []
+                    self._cache.set(po, orden)
+                    encontradas[po] = orden
+
+        return {po: encontradas[po] for po in pedidas if po in encontradas}
+
+    # --- BÚSQUEDA FEDERADA ---
+    # La misma PO puede estar en sales_orders (orden), staging_komet (komet) o en la tabla
+    # heredada confirm_po (legado). Se pregunta a las tres a la vez y se va respondiendo
+    # con lo que llegue primero.
+
+    def _fuente_orden(self, pedidas: list) -> dict:
+        return {
+            po: {
+                "cabecera": {k: v for k, v in orden.items() if k != 'sales_items'},
+                "lineas": [
+                    _linea(i.get('customer_code'), i.get('product_name'), i.get('boxes'),
+                           i.get('box_type'), i.get('unit_price'), orden.get('status'))
+                    for i in orden['sales_items']
+                ],
+            }
+            for po, orden in self.buscar(pedidas).items()
+        }
+
+    @staticmethod
+    def _fuente_komet(pedidas: list) -> dict:
+        res = db_client.table("staging_komet").select(COLUMNAS_KOMET).in_("po_komet", pedidas).execute()
+        return _agrupar(res.data or [], "po_komet", lambda r: _linea(
+            r.get('customer_code'), r.get('product_name'), r.get('quantity_boxes'),
+            r.get('box_type'), r.get('unit_price_purchase'), r.get('status_komet') or r.get('status')
+        ))
+
+    @staticmethod
+    def _fuente_legado(pedidas: list) -> dict:
+        filas = supabase_select("confirm_po", {"po_number": pedidas}, timeout=FUENTE_TIMEOUT_SEG)
+        if filas is None:
+            raise RuntimeError("confirm_po no respondió")
+        return _agrupar(filas, "po_number", lambda r: _linea(
+            r.get('customer_name'), r.get('product'), r.get('boxes'),
+            r.get('box_type'), r.get('cost'), r.get('status')
+        ))
+
+    async def federar(self, po_numbers: list):
+        """
+        Generador async: cada vez que una fuente responde entrega (fuente, fusion, pendientes, fallidas).
+        fusion = fusionar(respuestas hasta ahora); pendientes = fuentes que aún no contestan;
+        fallidas = fuentes que fallaron o se demoraron más de FUENTE_TIMEOUT_SEG (se registran).
+        Así "no está" y "no se pudo preguntar" no se confunden.
+        """
+        pedidas = list(dict.fromkeys(p.strip().upper() for p in po_numbers if p and p.strip()))[:MAX_POS_CONSULTA]
+        consultas = {"orden": self._fuente_orden, "komet": self._fuente_komet, "legado": self._fuente_legado}
+
+        async def preguntar(fuente):
+            try:
+                return fuente, await asyncio.wait_for(asyncio.to_thread(consultas[fuente], pedidas), FUENTE_TIMEOUT_SEG)
+            except Exception as e:
+                logger.warning(f"Fuente '{fuente}' sin respuesta para {pedidas}: {e!r}")
+                return fuente, None
+
+        respuestas = {}
+        pendientes, fallidas = set(FUENTES), set()
+        for tarea in asyncio.as_completed([preguntar(f) for f in FUENTES]):
+            fuente, resultado = await tarea
+            pendientes.discard(fuente)
+            if resultado is None:
+                fallidas.add(fuente)
+            respuestas[fuente] = resultado
+            yield fuente, fusionar(respuestas), set(pendientes), set(fallidas)
+
+    def olvidar(self, po_number: str = None):
+        if po_number is None:
+            self._cache.invalidar()
+        else:
+            self._cache.invalidar(po_number.strip().upper())
+
+    def _al_registrar_ordenes(self, ordenes=None, **_):
+        pos = {o.get("po_number") for o in ordenes or []}
+        for po in pos if None not in pos else [None]:
+            self.olvidar(po)
+
+    def _al_registrar_identificadores(self, pares=None, **_):
+        # Sin PO (ediciones del panel) no se sabe a cuál tocó: se olvidan todas
+        pos = {po for _, _, po in pares or []}
+        for po in pos if None not in pos else [None]:
+            self.olvidar(po)
+
+
+def _linea(cliente, producto, cajas, tipo, precio, estado) -> dict:
+    try:
+        cajas = int(float(cajas or 0))
+    except (TypeError, ValueError):
+        cajas = 0
+    return {"cliente": cliente, "producto": producto, "cajas": cajas, "tipo": tipo, "precio": precio, "estado": estado}
+
+
+def _agrupar(filas: list, columna_po: str, a_linea) -> dict:
+    por_po = {}
+    for fila in filas:
+        po = str(fila.get(columna_po) or '').strip().upper()
+        if po:
+            entrada = por_po.setdefault(po, {"cabecera": fila, "lineas": []})
+            entrada["lineas"].append(a_linea(fila))
+    return por_po
+
+
+def fusionar(respuestas: dict) -> dict:
+    """
+    {fuente: {po: {"cabecera", "lineas"}} | None} -> {po: {"fuentes": [...], "cabecera", "fuente_cabecera", "lineas"}}
+    Una línea que aparece en varias fuentes (mismo producto y cajas) queda una sola vez,
+    con los datos de la etapa más avanzada y la lista de fuentes donde se vio.
+    """
+    fusion = {}
+    for fuente in FUENTES:
+        for po, entrada in (respuestas.get(fuente) or {}).items():
+            destino = fusion.setdefault(po, {"fuentes": [], "cabecera": entrada["cabecera"], "fuente_cabecera": fuente, "lineas": [], "_claves": {}})
+            destino["fuentes"].append(fuente)
+            usadas = {}     # clave -> cuántas líneas previas ya se emparejaron con esta fuente
+            for linea in entrada["lineas"]:
+                clave = (" ".join(tokenizar(linea["producto"])), linea["cajas"])
+                previas = destino["_claves"].setdefault(clave, [])
+                k = usadas.get(clave, 0)
+                if k < len(previas) and fuente not in destino["lineas"][previas[k]]["fuentes"]:
+                    destino["lineas"][previas[k]]["fuentes"].append(fuente)
+                    usadas[clave] = k + 1
+                    continue
+                previas.append(len(destino["lineas"]))
+                destino["lineas"].append({**linea, "fuentes": [fuente]})
+    for entrada in fusion.values():
+        del entrada["_claves"]
+    return fusion
+
+
+# Instancia singleton
+consulta_po = ConsultaPO()
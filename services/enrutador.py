@@ -0,0 +1,103 @@
+import base64
+import logging
+import time
+import uuid
+from services.renderizador import renderizador
+
+logger = logging.getLogger(__name__)
+
+SEPARADOR = ":"
+LIMITE_CALLBACK = 64  # Bytes máximos que Telegram acepta en callback_data
+
+
+# --- CODIFICACIÓN COMPACTA DE IDs ---
+def comprimir_id(valor) -> str:
+    """
+    UUID (36 chars) -> base64url (22 chars). Cualquier otro id viaja tal cual con prefijo '='.
+    El alfabeto base64url no contiene ':' así que nunca rompe el separador.
+    """
+    s = str(valor)
+    try:
+        return base64.urlsafe_b64encode(uuid.UUID(s).bytes).rstrip(b"=").decode("ascii")
+    except ValueError:
+        return f"={s}"
+
+def expandir_id(token: str) -> str:
+    """Operación inversa de comprimir_id."""
+    if token.startswith("="):
+        return token[1:]
+    return str(uuid.UUID(bytes=base64.urlsafe_b64decode(token + "==")))
+
+
+class EnrutadorCallbacks:
+    """
+    El Guardagujas.
+    Formato de callback_data: '<ruta>:<arg1>:<arg2>...'
+    La ruta es una llave exacta de diccionario: enrutar cuesta O(1) y un código de
+    cliente con 'edit_' o 'cat_' dentro ya no puede desviar el tren.
+    """
+
+    def __init__(self):
+        self._rutas = {}
+        self._latencias = {}  # ruta -> [llamadas, segundos_totales, segundos_max]
+
+    def ruta(self, prefijo: str):
+        """Decorador: registra un handler async(update, context, *args) para un prefijo."""
+        if SEPARADOR in prefijo:
+            raise ValueError(f"El prefijo '{prefijo}' no puede contener '{SEPARADOR}'")
+
+        def decorador(handler):
+            if prefijo in self._rutas:
+                raise ValueError(f"Ruta duplicada: '{prefijo}'")
+            self._rutas[prefijo] = handler
+            return handler
+        return decorador
+
+    def datos(self, prefijo: str, *args) -> str:
+        """Construye el callback_data de una ruta, validando el límite de 64 bytes."""
+        data = SEPARADOR.join([prefijo, *[str(a) for a in args]])
+        if len(data.encode("utf-8")) > LIMITE_CALLBACK:
+            raise ValueError(f"callback_data excede {LIMITE_CALLBACK} bytes: {data}")
+        return data
+
+    async def despachar(self, update, context):
+        query = update.callback_query
+        prefijo, _, resto = (query.data or "").partition(SEPARADOR)
+        handler = self._rutas.get(prefijo)
+
+        try:
+            if handler is None:
+                # Botones de versiones anteriores del bot (p.ej. 'view_order_<uuid>')
+                await renderizador.responder(query, "⌛ Botón caducado. Vuelve a abrir el menú.", show_alert=True)
+                return
+
+            args = resto.split(SEPARADOR) if resto else []
+            inicio = time.perf_counter()
+            try:
+                await handler(update, context, *args)
+            finally:
+                self._medir(prefijo, time.perf_counter() - inicio)
+        finally:
+            # Si nadie contestó el callback (toast), lo cerramos en silencio
+            await renderizador.responder(query)
+
+    def _medir(self, prefijo: str, segundos: float):
+        stats = self._latencias.setdefault(prefijo, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += segundos
+        stats[2] = max(stats[2], segundos)
+
+    def metricas(self) -> dict:
+        """Latencia por ruta en milisegundos: {ruta: {llamadas, prom_ms, max_ms}}"""
+        return {
+            prefijo: {
+                "llamadas": n,
+                "prom_ms": total / n * 1000,
+                "max_ms": maximo * 1000,
+            }
+            for prefijo, (n, total, maximo) in self._latencias.items()
+        }
+
+
+# Instancia singleton: cada módulo de handlers registra aquí sus rutas
+enrutador = EnrutadorCallbacks()
@@ -0,0 +1,30 @@
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# --- CATÁLOGO DE EVENTOS ---
+REGLAS_EMPAQUE_ACTUALIZADAS = "reglas_empaque_actualizadas"
+ORDENES_REGISTRADAS = "ordenes_registradas"   # ordenes=[{order_id, po_number, customer_code, fecha, valor, producto, nombre, precio}]
+FACTURAS_EMITIDAS = "facturas_emitidas"       # po_numbers=[...] con factura recién generada (PDF)
+IDENTIFICADORES_REGISTRADOS = "identificadores_registrados"   # pares=[(tipo, valor, po)]: po, awb, invoice...
+FILAS_KOMET_IMPORTADAS = "filas_komet_importadas"   # filas=[...] tal como se insertaron en staging_komet
+
+_suscriptores = defaultdict(list)
+
+
+def suscribir(evento: str, funcion):
+    """Registra una función (síncrona) que se ejecutará cada vez que ocurra el evento."""
+    _suscriptores[evento].append(funcion)
+
+
+def emitir(evento: str, **datos):
+    """
+    El Pregonero.
+    Avisa a todos los interesados; si uno falla, los demás igual se enteran.
+    """
+    for funcion in _suscriptores.get(evento, []):
+        try:
+            funcion(**datos)
+        except Exception as e:
+            logger.error(f"Suscriptor de '{evento}' falló: {e}")
@@ -0,0 +1,251 @@
+import os
+import re
+import csv
+import gzip
+import json
+import shlex
+import tempfile
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from services.cliente_supabase import db_client, logger
+
+TAMANO_PAGINA = 1000          # El máximo que devuelve PostgREST por request (max-rows)
+HILOS_EXPORTACION = int(os.getenv("EXPORT_HILOS", "4"))
+PAGINAS_EN_VUELO = HILOS_EXPORTACION * 2   # Tope de páginas en memoria a la vez
+PAGINAS_POR_GRUPO_PARQUET = 20             # Row groups de ~20k filas
+LIMITE_VISTA_PREVIA = 15
+MAX_VISTA_PREVIA = 50
+LIMITE_DOCUMENTO_MB = 50      # Lo máximo que un bot puede subir a Telegram
+FORMATOS = {"export": "csv", "csv": "csv", "parquet": "parquet"}
+
+_IDENTIFICADOR = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_FILTRO = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)(>=|<=|!=|=|>|<|~)(.*)$")
+_OPERADORES = {"=": "eq", "!=": "neq", ">": "gt", ">=": "gte", "<": "lt", "<=": "lte", "~": "ilike"}
+
+
+class ErrorConsultaTabla(Exception):
+    """Argumentos de /tablageneral que no se pueden traducir a una consulta."""
+
+
+def interpretar_argumentos(texto: str) -> dict:
+    """
+    'customers cols=code,name country=EC name~flor limite=30 csv'
+    -> {"tabla", "columnas", "filtros": [(col, op, valor)], "orden", "limite", "formato"}
+    Valores con espacios van entre comillas: name~"playa blanca".
+    """
+    try:
+        partes = shlex.split(texto or "")
+    except ValueError:
+        partes = (texto or "").split()
+    if not partes:
+        raise ErrorConsultaTabla("Indica la tabla.")
+
+    consulta = {"tabla": partes[0], "columnas": ["*"], "filtros": [], "orden": "id",
+                "limite": LIMITE_VISTA_PREVIA, "formato": None}
+    if not _IDENTIFICADOR.match(consulta["tabla"]):
+        raise ErrorConsultaTabla(f"Nombre de tabla inválido: {consulta['tabla']}")
+
+    for parte in partes[1:]:
+        if parte.lower() in FORMATOS:
+            consulta["formato"] = FORMATOS[parte.lower()]
+            continue
+        m = _FILTRO.match(parte)
+        if not m:
+            raise ErrorConsultaTabla(f"No entiendo «{parte}»")
+        columna, operador, valor = m.groups()
+
+        if operador == "=" and columna == "cols":
+            columnas = [c.strip() for c in valor.split(",") if c.strip()]
+            invalidas = [c for c in columnas if not _IDENTIFICADOR.match(c)]
+            if not columnas or invalidas:
+                raise ErrorConsultaTabla(f"Columnas inválidas: {', '.join(invalidas) or valor}")
+            consulta["columnas"] = columnas
+        elif operador == "=" and columna == "orden":
+            if not _IDENTIFICADOR.match(valor.lstrip("-")):
+                raise ErrorConsultaTabla(f"Columna de orden inválida: {valor}")
+            consulta["orden"] = valor
+        elif operador == "=" and columna == "limite":
+            if not valor.isdigit():
+                raise ErrorConsultaTabla(f"Límite inválido: {valor}")
+            consulta["limite"] = min(max(int(valor), 1), MAX_VISTA_PREVIA)
+        else:
+            consulta["filtros"].append((columna, operador, valor))
+    return consulta
+
+
+def aplicar_filtros(query, filtros: list):
+    for columna, operador, valor in filtros:
+        if valor.lower() == "null" and operador in ("=", "!="):
+            query = query.is_(columna, "null") if operador == "=" else query.not_.is_(columna, "null")
+        elif operador == "~":
+            query = query.ilike(columna, f"%{valor}%")
+        else:
+            query = getattr(query, _OPERADORES[operador])(columna, valor)
+    return query
+
+
+def _celda(valor):
+    if valor is None:
+        return ""
+    if isinstance(valor, (dict, list)):
+        return json.dumps(valor, ensure_ascii=False)
+    return valor
+
+
+def _texto(valor):
+    return None if valor is None else str(_celda(valor))
+
+
+class ExportadorTablas:
+    """
+    El Archivista.
+    Vista previa de cualquier tabla con proyección y filtros, y exportación completa:
+    páginas por 'range' en paralelo (con un tope de páginas en vuelo) escritas en
+    orden a un CSV comprimido o a Parquet en disco. La memoria no crece con la tabla.
+    """
+
+    def __init__(self):
+        self._sin_id = set()      # Tablas sin columna 'id': se paginan sin orden explícito
+
+    def _query(self, consulta: dict, contar: bool = False):
+        query = db_client.table(consulta["tabla"])\
+            .select(",".join(consulta["columnas"]), count="exact" if contar else None)
+        query = aplicar_filtros(query, consulta["filtros"])
+        orden = consulta["orden"]
+        if orden and not (orden == "id" and consulta["tabla"] in self._sin_id):
+            query = query.order(orden.lstrip("-"), desc=orden.startswith("-"))
+        return query
+
+    def _ejecutar(self, consulta: dict, inicio: int, fin: int, contar: bool = False):
+        try:
+            return self._query(consulta, contar).range(inicio, fin).execute()
+        except Exception as e:
+            # 'id' es solo el orden por defecto: si la tabla no lo tiene, se pide sin orden
+            if consulta["orden"] != "id" or "42703" not in str(e) or consulta["tabla"] in self._sin_id:
+                raise
+            logger.warning(f"⚠️ {consulta['tabla']} no tiene columna id; se pagina sin orden explícito.")
+            self._sin_id.add(consulta["tabla"])
+            return self._query(consulta, contar).range(inicio, fin).execute()
+
+    def vista_previa(self, consulta: dict):
+        """(filas, total de filas que cumplen los filtros)"""
+        res = self._ejecutar(consulta, 0, consulta["limite"] - 1, contar=True)
+        filas = res.data or []
+        return filas, res.count if res.count is not None else len(filas)
+
+    def _paginas(self, consulta: dict):
+        """
+        Genera (filas, hechas, total) en orden. La primera página trae el conteo;
+        las demás se piden en paralelo, nunca más de PAGINAS_EN_VUELO a la vez.
+        """
+        primera = self._ejecutar(consulta, 0, TAMANO_PAGINA - 1, contar=True)
+        filas = primera.data or []
+        total = max(primera.count or 0, len(filas))
+        yield filas, len(filas), total
+
+        inicios = iter(range(TAMANO_PAGINA, total, TAMANO_PAGINA))
+        hechas = len(filas)
+        with ThreadPoolExecutor(max_workers=HILOS_EXPORTACION) as pool:
+            en_vuelo = []
+            for inicio in inicios:
+                en_vuelo.append(pool.submit(self._ejecutar, consulta, inicio, inicio + TAMANO_PAGINA - 1))
+                if len(en_vuelo) >= PAGINAS_EN_VUELO:
+                    break
+            while en_vuelo:
+                pagina = en_vuelo.pop(0).result().data or []
+                siguiente = next(inicios, None)
+                if siguiente is not None:
+                    en_vuelo.append(pool.submit(self._ejecutar, consulta, siguiente, siguiente + TAMANO_PAGINA - 1))
+                hechas += len(pagina)
+                yield pagina, hechas, total
+
+    def exportar(self, consulta: dict, al_avanzar=None):
+        """
+        Escribe la tabla completa (con proyección y filtros) en un archivo temporal.
+        Retorna (ruta, nombre_sugerido, filas). El que llama borra la ruta al terminar.
+        al_avanzar(hechas, total) se llama desde este hilo después de cada página.
+        """
+        formato = consulta["formato"] or "csv"
+        sufijo = ".csv.gz" if formato == "csv" else ".parquet"
+        nombre = f"{consulta['tabla']}_{datetime.now().strftime('%Y%m%d_%H%M')}{sufijo}"
+        fd, ruta = tempfile.mkstemp(prefix="export_", suffix=sufijo)
+        os.close(fd)
+
+        try:
+            escribir = self._escribir_csv if formato == "csv" else self._escribir_parquet
+            filas = escribir(ruta, consulta, al_avanzar)
+        except Exception:
+            os.remove(ruta)
+            raise
+        return ruta, nombre, filas
+
+    def _escribir_csv(self, ruta: str, consulta: dict, al_avanzar) -> int:
+        escritas, writer, columnas = 0, None, None
+        with gzip.open(ruta, "wt", newline="", encoding="utf-8") as salida:
+            for pagina, hechas, total in self._paginas(consulta):
+                if writer is None:
+                    columnas = list(pagina[0].keys()) if pagina else [c for c in consulta["columnas"] if c != "*"]
+                    writer = csv.writer(salida)
+                    writer.writerow(columnas)
+                writer.writerows([_celda(f.get(c)) for c in columnas] for f in pagina)
+                escritas += len(pagina)
+                if al_avanzar:
+                    al_avanzar(hechas, total)
+        return escritas
+
+    def _escribir_parquet(self, ruta: str, consulta: dict, al_avanzar) -> int:
+        # pyarrow solo hace falta para este formato: sin él, CSV sigue funcionando
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ErrorConsultaTabla("Parquet requiere pyarrow (pip install pyarrow); usa csv.") from e
+
+        escritas, writer, esquema, grupo = 0, None, None, []
+
+        def volcar():
+            datos = {c.name: [_texto(f.get(c.name)) if pa.types.is_string(c.type) else f.get(c.name) for f in grupo]
+                     for c in esquema}
+            writer.write_table(pa.table(datos, schema=esquema))
+            grupo.clear()
+
+        try:
+            for pagina, hechas, total in self._paginas(consulta):
+                if esquema is None and pagina:
+                    esquema = self._esquema(pa, pagina)
+                    writer = pq.ParquetWriter(ruta, esquema, compression="zstd")
+                grupo.extend(pagina)
+                escritas += len(pagina)
+                if esquema is not None and len(grupo) >= TAMANO_PAGINA * PAGINAS_POR_GRUPO_PARQUET:
+                    volcar()
+                if al_avanzar:
+                    al_avanzar(hechas, total)
+            if grupo:
+                volcar()
+        finally:
+            if writer is not None:
+                writer.close()
+        return escritas
+
+    @staticmethod
+    def _esquema(pa, muestra: list):
+        """
+        Tipos a partir de la primera página. Los enteros se guardan como float64 porque una
+        columna numeric llega como 10 en una fila y 10.5 en la siguiente; lo que no es
+        número ni booleano (fechas, uuid, JSON, columnas vacías) va como texto.
+        """
+        campos = []
+        for columna in muestra[0].keys():
+            valores = [f.get(columna) for f in muestra if f.get(columna) is not None]
+            if valores and all(isinstance(v, bool) for v in valores):
+                tipo = pa.bool_()
+            elif valores and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in valores):
+                tipo = pa.float64()
+            else:
+                tipo = pa.string()
+            campos.append(pa.field(columna, tipo))
+        return pa.schema(campos)
+
+
+# Instancia singleton
+exportador_tablas = ExportadorTablas()
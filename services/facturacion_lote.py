@@ -0,0 +1,127 @@
+import io
+import os
+import asyncio
+import logging
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from services.generador_pdf import renderizar_paquete, renderizar_factura, renderizar_po_finca
+from services.cache_pdf import cache_pdf
+
+logger = logging.getLogger(__name__)
+
+PROCESOS_PDF = int(os.getenv("PROCESOS_PDF", str(max(1, min(4, (os.cpu_count() or 2) - 1)))))
+
+
+class FacturadorLote:
+    """
+    La Imprenta.
+    Dibuja facturas y POs de finca de muchas órdenes en un pool de procesos
+    (ReportLab es Python puro: con hilos no se gana nada por el GIL).
+    """
+
+    def __init__(self, procesos: int = PROCESOS_PDF):
+        self.procesos = procesos
+        self._pool = None
+
+    def _obtener_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.procesos)
+        return self._pool
+
+    async def renderizar(self, paquetes: list, al_avanzar=None) -> tuple:
+        """
+        paquetes = [(orden, items, cliente)]. Retorna (documentos, errores):
+        documentos = [(po_number, pdf_factura, pdf_po_finca)] en el orden recibido,
+        errores = [(po_number, mensaje)]. al_avanzar(hechos, total) es una corrutina opcional.
+        """
+        loop = asyncio.get_running_loop()
+        pool = self._obtener_pool()
+        copias = await asyncio.to_thread(self._buscar_copias, paquetes)
+
+        def lanzar(paquete, copia):
+            _, factura, po_finca = copia
+            if factura is not None and po_finca is not None:
+                hecho = loop.create_future()
+                hecho.set_result((paquete[0]['po_number'], factura, po_finca))
+                return hecho
+            return loop.run_in_executor(pool, renderizar_paquete, paquete)
+
+        tareas = [lanzar(p, c) for p, c in zip(paquetes, copias)]
+
+        hechos = 0
+        for futuro in asyncio.as_completed(tareas):
+            try:
+                await futuro
+            except Exception:
+                pass   # Se reporta abajo, en orden
+            hechos += 1
+            if al_avanzar:
+                await al_avanzar(hechos, len(tareas))
+
+        documentos, errores, nuevos = [], [], []
+        for paquete, (clave, f_copia, p_copia), tarea in zip(paquetes, copias, tareas):
+            if tarea.exception():
+                logger.error(f"No se pudo dibujar {paquete[0].get('po_number')}: {tarea.exception()}")
+                errores.append((paquete[0].get('po_number'), str(tarea.exception())))
+                continue
+            documentos.append(tarea.result())
+            if f_copia is None or p_copia is None:
+                nuevos.append((clave, *tarea.result()[1:]))
+
+        if nuevos:
+            await asyncio.to_thread(self._guardar_copias, nuevos)
+        return documentos, errores
+
+    async def renderizar_uno(self, paquete) -> tuple:
+        """Factura y PO de finca de un mismo paquete, cada una en su proceso. -> (pdf_factura, pdf_po_finca)"""
+        loop = asyncio.get_running_loop()
+        pool = self._obtener_pool()
+        clave, factura, po_finca = (await asyncio.to_thread(self._buscar_copias, [paquete]))[0]
+        if factura is not None and po_finca is not None:
+            return factura, po_finca
+
+        # Solo se redibuja lo que no está guardado
+        nuevo_factura, nuevo_po = await asyncio.gather(
+            loop.run_in_executor(pool, renderizar_factura, paquete) if factura is None else asyncio.sleep(0),
+            loop.run_in_executor(pool, renderizar_po_finca, paquete) if po_finca is None else asyncio.sleep(0),
+        )
+        factura, po_finca = factura or nuevo_factura, po_finca or nuevo_po
+        await asyncio.to_thread(self._guardar_copias, [(clave, factura, po_finca)])
+        return factura, po_finca
+
+    @staticmethod
+    def _buscar_copias(paquetes: list) -> list:
+        """[(clave, pdf_factura | None, pdf_po_finca | None)] desde la caché en disco."""
+        copias = []
+        for paquete in paquetes:
+            clave = cache_pdf.clave(paquete)
+            copias.append((clave, cache_pdf.obtener(clave, "factura"), cache_pdf.obtener(clave, "po_finca")))
+        return copias
+
+    @staticmethod
+    def _guardar_copias(documentos: list):
+        for clave, factura, po_finca in documentos:
+            cache_pdf.guardar(clave, "factura", factura)
+            cache_pdf.guardar(clave, "po_finca", po_finca)
+
+    @staticmethod
+    def empaquetar_zip(documentos: list, nombre: str) -> io.BytesIO:
+        """Un solo .zip con Factura_<PO>.pdf y PO_Finca_<PO>.pdf por orden."""
+        archivo = io.BytesIO()
+        with zipfile.ZipFile(archivo, "w", compression=zipfile.ZIP_DEFLATED) as z:
+            for po_number, factura, po_finca in documentos:
+                seguro = str(po_number).replace("/", "-")
+                z.writestr(f"Factura_{seguro}.pdf", factura)
+                z.writestr(f"PO_Finca_{seguro}.pdf", po_finca)
+        archivo.seek(0)
+        archivo.name = nombre
+        return archivo
+
+    def cerrar(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+# Instancia singleton: el pool se crea con el primer lote y se cierra al apagar el bot (main.py)
+facturador_lote = FacturadorLote()
@@ -1,43 +1,183 @@
+import io
 import os
 import logging
 from reportlab.lib.pagesizes import LETTER
 from reportlab.pdfgen import canvas
 from reportlab.lib import colors
 from services.cliente_supabase import db_client
+from services.cache_ttl import CacheTTL
+from services.eventos import suscribir, ORDENES_REGISTRADAS, IDENTIFICADORES_REGISTRADOS
 
 logger = logging.getLogger(__name__)
 
+LOTE_IN = 200   # ids por filtro in_ (la URL de PostgREST tiene límite)
+PAQUETE_TTL_SEG = float(os.getenv("PAQUETE_TTL_SEG", "60"))
+
+# Diagramación (puntos, LETTER = 612 x 792)
+VERSION_PLANTILLA = "2"       # Subirla al cambiar el dibujo: invalida los PDFs guardados en disco
+ALTO_FILA = 15
+Y_TABLA_PRIMERA = 580         # Debajo del recuadro de cliente / finca
+Y_TABLA_SIGUIENTES = 685      # Páginas de continuación: solo membrete
+Y_SUBTOTAL = 100
+Y_ULTIMA_FILA = 118
+FILAS_PRIMERA_PAGINA = (Y_TABLA_PRIMERA - 20 - Y_ULTIMA_FILA) // ALTO_FILA + 1
+FILAS_PAGINA = (Y_TABLA_SIGUIENTES - 20 - Y_ULTIMA_FILA) // ALTO_FILA + 1
+
+
+def _num(valor) -> float:
+    try:
+        return float(valor or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
 class GeneradorDocumentos:
     def __init__(self):
         self.width, self.height = LETTER
+        # po_number -> (orden, items, cliente): factura y PO de finca salen de la misma lectura
+        self._paquetes = CacheTTL(ttl_segundos=PAQUETE_TTL_SEG, max_items=200)
+        # Una orden re-ingestada (OPBASE hace upsert) no puede salir con el paquete viejo:
+        # de él sale también la huella del caché de PDFs en disco
+        suscribir(ORDENES_REGISTRADAS, self._al_registrar_ordenes)
+        suscribir(IDENTIFICADORES_REGISTRADOS, self._al_registrar_identificadores)
 
-    def _dibujar_encabezado_base(self, c, titulo, orden):
-        """Dibuja el logo y datos comunes"""
+    def generar_factura_cliente(self, po_number: str, output_path: str):
+        """Genera la FACTURA COMERCIAL (Con Precios de Venta)"""
+        try:
+            datos = self.obtener_paquete(po_number)
+            if not datos: return False, "PO no encontrada"
+            self.dibujar_factura_cliente(datos, output_path)
+            return True, "OK"
+        except Exception as e:
+            return False, str(e)
+
+    def generar_po_finca(self, po_number: str, output_path: str):
+        """Genera la ORDEN DE COMPRA (Para la Finca - Enfocada en Logística)"""
+        try:
+            datos = self.obtener_paquete(po_number)
+            if not datos: return False, "PO no encontrada"
+            self.dibujar_po_finca(datos, output_path)
+            return True, "OK"
+        except Exception as e:
+            return False, str(e)
+
+    # --- PLANTILLAS ---
+    # Lo que no cambia entre páginas (membrete, marco del título, títulos de columna, pie)
+    # se dibuja UNA vez por documento como form XObject y cada página solo lo referencia.
+
+    def _definir_plantillas(self, c, titulo, columnas, pie):
+        c.beginForm("membrete")
         c.setFont("Helvetica-Bold", 14)
         c.drawString(50, 750, "J&G Specialty Crops LLC")
         c.setFont("Helvetica", 9)
         c.drawString(50, 735, "1712 Pioneer Ave, Suite # 1017 - Cheyenne, WY 82001")
         c.drawString(50, 720, "USA - Tel: 573 12 376 9076")
-
         # Caja Titulo
         c.setLineWidth(1)
         c.rect(400, 710, 180, 50)
         c.setFont("Helvetica-Bold", 12)
         c.drawCentredString(490, 745, titulo)
+        c.endForm()
+
+        # Header Gráfico de la tabla (y relativo: se ubica con translate)
+        c.beginForm("cabecera_tabla")
+        c.setFillColor(colors.lightgrey)
+        c.rect(40, 0, 540, 15, fill=1, stroke=0)
+        c.setFillColor(colors.black)
+        c.setFont("Helvetica-Bold", 8)
+        for encabezado, x, _, _ in columnas:
+            c.drawString(x, 4, encabezado)
+        c.endForm()
+
+        c.beginForm("pie")
+        fuente, tamano, y, texto = pie
+        c.setFont(fuente, tamano)
+        c.drawCentredString(300, y, texto)
+        c.endForm()
+
+    def _abrir_pagina(self, c, orden, pagina, total_paginas, y_tabla):
+        c.doForm("membrete")
+        c.doForm("pie")
         c.setFont("Helvetica", 10)
         c.drawString(410, 725, f"No. {orden['po_number']}")
         c.drawString(410, 713, f"Fecha: {orden['ship_date']}")
+        c.setFont("Helvetica", 7)
+        c.drawRightString(580, 700, f"Página {pagina}/{total_paginas}")
+        c.saveState()
+        c.translate(0, y_tabla)
+        c.doForm("cabecera_tabla")
+        c.restoreState()
 
-    def generar_factura_cliente(self, po_number: str, output_path: str):
-        """Genera la FACTURA COMERCIAL (Con Precios de Venta)"""
-        try:
-            datos = self._obtener_datos(po_number)
-            if not datos: return False, "PO no encontrada"
-            orden, items, cliente = datos
+    @staticmethod
+    def _paginar(n_items):
+        """[(inicio, fin)] de filas por página: la primera comparte espacio con el recuadro de datos."""
+        paginas, inicio, capacidad = [], 0, FILAS_PRIMERA_PAGINA
+        while True:
+            fin = min(inicio + capacidad, n_items)
+            paginas.append((inicio, fin))
+            if fin >= n_items:
+                return paginas
+            inicio, capacidad = fin, FILAS_PAGINA
+
+    def _dibujar_documento(self, output, titulo, orden, items, columnas, pie, recuadro, acumular, formatear_subtotal, cierre):
+        """
+        Motor común de factura y PO de finca.
+        columnas = [(encabezado, x, fuente, celda(item) -> str)]
+        acumular(item) -> tupla sumable por página; formatear_subtotal(pagina, acumulado) -> str
+        recuadro(c) dibuja los datos de la primera página; cierre(c, y, acumulado) los totales finales.
+        """
+        c = canvas.Canvas(output, pagesize=LETTER, pageCompression=1)
+        self._definir_plantillas(c, titulo, columnas, pie)
+
+        paginas = self._paginar(len(items))
+        acumulado = None
+        for n, (inicio, fin) in enumerate(paginas, 1):
+            primera = n == 1
+            y_tabla = Y_TABLA_PRIMERA if primera else Y_TABLA_SIGUIENTES
+            self._abrir_pagina(c, orden, n, len(paginas), y_tabla)
+            if primera:
+                recuadro(c)
+
+            # Filas: un solo objeto de texto por página (mucho más liviano que un drawString por celda)
+            texto = c.beginText()
+            y = y_tabla - 20
+            subtotal = None
+            fuente_actual = None
+            for item in items[inicio:fin]:
+                texto.setTextOrigin(columnas[0][1], y)
+                x_previa = columnas[0][1]
+                for _, x, fuente, celda in columnas:
+                    if fuente != fuente_actual:
+                        texto.setFont(fuente, 9)
+                        fuente_actual = fuente
+                    if x != x_previa:
+                        texto.moveCursor(x - x_previa, 0)   # Desplazamiento relativo: operadores cortos
+                        x_previa = x
+                    texto.textOut(celda(item))
+                aporte = acumular(item)
+                subtotal = aporte if subtotal is None else tuple(a + b for a, b in zip(subtotal, aporte))
+                y -= ALTO_FILA
+            c.drawText(texto)
+
+            if subtotal is not None:
+                acumulado = subtotal if acumulado is None else tuple(a + b for a, b in zip(acumulado, subtotal))
 
-            c = canvas.Canvas(output_path, pagesize=LETTER)
-            self._dibujar_encabezado_base(c, "COMMERCIAL INVOICE", orden)
+            if n < len(paginas):
+                # Subtotal corrido al pie de cada página que continúa
+                c.setLineWidth(0.5)
+                c.line(40, Y_SUBTOTAL + 12, 580, Y_SUBTOTAL + 12)
+                c.setFont("Helvetica-Oblique", 8)
+                c.drawRightString(580, Y_SUBTOTAL, formatear_subtotal(subtotal, acumulado) + "  (continúa)")
+                c.showPage()
+            else:
+                cierre(c, y, acumulado)
+        c.save()
+
+    def dibujar_factura_cliente(self, datos, output):
+        """Dibuja la factura de un paquete (orden, items, cliente) ya leído. output: ruta o archivo."""
+        orden, items, cliente = datos
 
+        def recuadro(c):
             # Info Cliente
             c.rect(50, 630, 300, 60)
             c.setFont("Helvetica-Bold", 9)
@@ -47,35 +187,35 @@ class GeneradorDocumentos:
             c.drawString(55, 645, str(cliente.get('address', '')))
             c.drawString(55, 630, f"{cliente.get('city','')}, {cliente.get('country','')}")
 
-            # Tabla (CON PRECIOS)
-            y = 580
-            headers = ["Box", "Qty", "Description", "Mark Code", "Stems", "Unit Price", "Total"]
-            x_pos = [50, 90, 130, 280, 380, 450, 520]
-            
-            self._dibujar_tabla(c, headers, x_pos, y, items, mostrar_precio=True)
-            
-            # Totales y Pie
+        def cierre(c, y, acumulado):
+            # Totales
             c.setFont("Helvetica-Bold", 10)
-            c.drawString(450, 150, f"TOTAL USD: ${orden.get('total_value', 0):.2f}")
-            
-            c.setFont("Helvetica", 8)
-            c.drawCentredString(300, 30, "PLEASE WIRE PAYMENT TO: HELM BANK USA")
-            
-            c.save()
-            return True, "OK"
-        except Exception as e:
-            return False, str(e)
+            c.drawString(450, min(150, y - 5), f"TOTAL USD: ${_num(orden.get('total_value')):.2f}")
 
-    def generar_po_finca(self, po_number: str, output_path: str):
-        """Genera la ORDEN DE COMPRA (Para la Finca - Enfocada en Logística)"""
-        try:
-            datos = self._obtener_datos(po_number)
-            if not datos: return False, "PO no encontrada"
-            orden, items, cliente = datos
+        # Tabla (CON PRECIOS)
+        columnas = [
+            ("Box", 50, "Helvetica", lambda i: str(i.get('box_type', ''))),
+            ("Qty", 90, "Helvetica", lambda i: str(i.get('boxes', 0))),
+            ("Description", 130, "Helvetica", lambda i: str(i.get('product_name', ''))[:35]),
+            ("Mark Code", 280, "Helvetica", lambda i: str(i.get('mark_code', ''))[:15]),
+            ("Stems", 380, "Helvetica", lambda i: str(i.get('total_units', 0))),
+            ("Unit Price", 450, "Helvetica", lambda i: f"${_num(i.get('unit_price')):.2f}"),
+            ("Total", 520, "Helvetica", lambda i: f"${_num(i.get('total_line_value')):.2f}"),
+        ]
+        self._dibujar_documento(
+            output, "COMMERCIAL INVOICE", orden, items, columnas,
+            pie=("Helvetica", 8, 30, "PLEASE WIRE PAYMENT TO: HELM BANK USA"),
+            recuadro=recuadro,
+            acumular=lambda i: (_num(i.get('total_line_value')),),
+            formatear_subtotal=lambda sub, acum: f"Subtotal página: ${sub[0]:,.2f}   Acumulado: ${acum[0]:,.2f}",
+            cierre=cierre,
+        )
 
-            c = canvas.Canvas(output_path, pagesize=LETTER)
-            self._dibujar_encabezado_base(c, "PURCHASE ORDER (FINCA)", orden)
+    def dibujar_po_finca(self, datos, output):
+        """Dibuja la PO de finca de un paquete (orden, items, cliente) ya leído. output: ruta o archivo."""
+        orden, items, cliente = datos
 
+        def recuadro(c):
             # Info Proveedor (Vendor)
             c.rect(50, 630, 300, 60)
             c.setFont("Helvetica-Bold", 9)
@@ -93,22 +233,50 @@ class GeneradorDocumentos:
             c.drawString(365, 645, "• Usar capuchón y comida según especif.")
             c.drawString(365, 630, "• Confirmar recepción.")
 
-            # Tabla (SIN PRECIOS DE VENTA - Solo Logística)
-            y = 580
-            # Nota: Quitamos Precio y Total. Agregamos más espacio a Descripción y Marca.
-            headers = ["Caja", "Cant", "Producto / Variedad", "MARCACIÓN (Mark Code)", "Total Tallos"]
-            x_pos = [50, 90, 130, 350, 500]
-            
-            self._dibujar_tabla(c, headers, x_pos, y, items, mostrar_precio=False)
-            
-            # Pie de Finca
-            c.setFont("Helvetica-Bold", 10)
-            c.drawCentredString(300, 50, "*** FAVOR CONFIRMAR DESPACHO ANTES DE LAS 10 AM ***")
-            
-            c.save()
-            return True, "OK"
-        except Exception as e:
-            return False, str(e)
+        def cierre(c, y, acumulado):
+            cajas, tallos = acumulado or (0, 0)
+            c.setFont("Helvetica-Bold", 9)
+            c.drawRightString(580, min(150, y - 5), f"TOTAL: {cajas:,.0f} cajas | {tallos:,.0f} tallos")
+
+        # Tabla (SIN PRECIOS DE VENTA - Solo Logística)
+        # Nota: Quitamos Precio y Total. Agregamos más espacio a Descripción y Marca.
+        # La Marcación va en negrita para que el operario la vea bien.
+        columnas = [
+            ("Caja", 50, "Helvetica", lambda i: str(i.get('box_type', ''))),
+            ("Cant", 90, "Helvetica", lambda i: str(i.get('boxes', 0))),
+            ("Producto / Variedad", 130, "Helvetica", lambda i: str(i.get('product_name', ''))[:35]),
+            ("MARCACIÓN (Mark Code)", 350, "Helvetica-Bold", lambda i: str(i.get('mark_code', 'NO MARK'))),
+            ("Total Tallos", 500, "Helvetica", lambda i: str(i.get('total_units', 0))),
+        ]
+        self._dibujar_documento(
+            output, "PURCHASE ORDER (FINCA)", orden, items, columnas,
+            pie=("Helvetica-Bold", 10, 50, "*** FAVOR CONFIRMAR DESPACHO ANTES DE LAS 10 AM ***"),
+            recuadro=recuadro,
+            acumular=lambda i: (_num(i.get('boxes')), _num(i.get('total_units'))),
+            formatear_subtotal=lambda sub, acum: f"Cajas página: {sub[0]:,.0f} | Tallos: {sub[1]:,.0f}   Acumulado: {acum[0]:,.0f} cajas | {acum[1]:,.0f} tallos",
+            cierre=cierre,
+        )
+
+    def obtener_paquete(self, po_number: str):
+        """(orden, items, cliente) de una PO, leído una sola vez por ventana de TTL (None si no existe)."""
+        return self._paquetes.obtener_o_calcular(po_number, lambda: self._obtener_datos(po_number))
+
+    def olvidar_paquete(self, po_number: str = None):
+        """Tras editar una orden: la próxima lectura va a la DB (sin argumento, olvida todas)."""
+        if po_number is None:
+            self._paquetes.invalidar()
+        else:
+            self._paquetes.invalidar(po_number)
+
+    def _al_registrar_ordenes(self, ordenes=None, **_):
+        pos = {o.get("po_number") for o in ordenes or []}
+        for po in pos if None not in pos else [None]:
+            self.olvidar_paquete(po)
+
+    def _al_registrar_identificadores(self, pares=None, **_):
+        pos = {po for _, _, po in pares or []}
+        for po in pos if None not in pos else [None]:
+            self.olvidar_paquete(po)
 
     def _obtener_datos(self, po_number):
         res_head = db_client.table("sales_orders").select("*").eq("po_number", po_number).execute()
@@ -127,40 +295,60 @@ class GeneradorDocumentos:
         
         return orden, items, cliente_info
 
-    def _dibujar_tabla(self, c, headers, x_pos, y_start, items, mostrar_precio=True):
-        # Header Gráfico
-        c.setFillColor(colors.lightgrey)
-        c.rect(40, y_start, 540, 15, fill=1)
-        c.setFillColor(colors.black)
-        c.setFont("Helvetica-Bold", 8)
-        
-        for i, h in enumerate(headers):
-            c.drawString(x_pos[i], y_start+4, h)
-        
-        y = y_start - 20
-        c.setFont("Helvetica", 9)
+    def obtener_datos_lote(self, ordenes: list) -> list:
+        """
+        Paquetes (orden, items, cliente) de muchas órdenes con 2 consultas + 1 por bloque de items,
+        en vez de 3 por PO. 'ordenes' son filas completas de sales_orders.
+        """
+        if not ordenes:
+            return []
+        items_por_orden = {}
+        ids = [o['id'] for o in ordenes]
+        for i in range(0, len(ids), LOTE_IN):
+            res = db_client.table("sales_items").select("*").in_("order_id", ids[i:i + LOTE_IN]).execute()
+            for item in res.data or []:
+                items_por_orden.setdefault(item['order_id'], []).append(item)
 
-        for item in items:
-            c.drawString(x_pos[0], y, str(item.get('box_type', '')))
-            c.drawString(x_pos[1], y, str(item.get('boxes', 0)))
-            c.drawString(x_pos[2], y, str(item.get('product_name', ''))[:35])
-            
-            # Lógica especial para Finca vs Cliente
-            if mostrar_precio:
-                c.drawString(x_pos[3], y, str(item.get('mark_code', ''))[:15])
-                c.drawString(x_pos[4], y, str(item.get('total_units', 0)))
-                c.drawString(x_pos[5], y, f"${item.get('unit_price', 0):.2f}")
-                c.drawString(x_pos[6], y, f"${item.get('total_line_value', 0):.2f}")
-            else:
-                # En PO Finca, damos más espacio a la Marcación que es vital
-                c.setFont("Helvetica-Bold", 9) # Negrita para que el operario lo vea bien
-                c.drawString(x_pos[3], y, str(item.get('mark_code', 'NO MARK')))
-                c.setFont("Helvetica", 9)
-                c.drawString(x_pos[4], y, str(item.get('total_units', 0)))
-
-            y -= 15
-            if y < 100: # Salto de página simple
-                c.showPage()
-                y = 700
+        codigos = sorted({
+            str(items[0].get('customer_code'))
+            for items in items_por_orden.values() if items and items[0].get('customer_code')
+        })
+        clientes = {}
+        for i in range(0, len(codigos), LOTE_IN):
+            bloque = ",".join(f'"{c}"' for c in codigos[i:i + LOTE_IN])
+            res = db_client.table("customers").select("*").or_(f"code.in.({bloque}),customer_code.in.({bloque})").execute()
+            for c in res.data or []:
+                for llave in (c.get('code'), c.get('customer_code')):
+                    if llave:
+                        clientes.setdefault(str(llave), c)
+
+        paquetes = []
+        for orden in ordenes:
+            items = items_por_orden.get(orden['id'], [])
+            cliente_info = {}
+            if items:
+                cust_code = items[0].get('customer_code')
+                cliente_info = clientes.get(str(cust_code)) or {"name": cust_code}
+            paquetes.append((orden, items, cliente_info))
+        return paquetes
 
 generador_documentos = GeneradorDocumentos()
+
+
+# --- Funciones de módulo: un ProcessPoolExecutor las puede despachar ---
+def renderizar_factura(datos) -> bytes:
+    salida = io.BytesIO()
+    generador_documentos.dibujar_factura_cliente(datos, salida)
+    return salida.getvalue()
+
+
+def renderizar_po_finca(datos) -> bytes:
+    salida = io.BytesIO()
+    generador_documentos.dibujar_po_finca(datos, salida)
+    return salida.getvalue()
+
+
+def renderizar_paquete(datos):
+    """(orden, items, cliente) -> (po_number, pdf_factura: bytes, pdf_po_finca: bytes)."""
+    return datos[0]['po_number'], renderizar_factura(datos), renderizar_po_finca(datos)
+
@@ -0,0 +1,219 @@
+import os
+import re
+import time
+import bisect
+import logging
+import threading
+from collections import Counter
+from services.cliente_supabase import db_client
+from services.eventos import suscribir, IDENTIFICADORES_REGISTRADOS
+
+logger = logging.getLogger(__name__)
+
+TAMANO_PAGINA = 1000
+TTL_SEGUNDOS = float(os.getenv("IDENTIFICADORES_TTL_SEG", "3600"))
+SIMILITUD_MINIMA = 0.3
+MAX_POSTING = 5000     # Un trigrama presente en más claves que esto no discrimina ('000'): se ignora
+PRESUPUESTO_CONTEO = 6000   # Claves a contar por consulta como máximo: se usan primero los trigramas más raros
+
+# (tabla, columna -> tipo, columna con la PO a la que apunta)
+FUENTES = (
+    ("sales_orders", {"po_number": "po", "invoice_number": "invoice", "awb": "awb", "hawb": "hawb"}, "po_number"),
+    ("staging_komet", {"po_komet": "po_komet", "po_consecutive": "po", "invoice_number": "invoice",
+                       "awb": "awb", "hawb": "hawb", "customer_code": "cliente"}, "po_komet"),
+    ("customers", {"code": "cliente", "customer_code": "cliente"}, None),
+)
+
+
+def normalizar(texto) -> str:
+    """'p-083 638' -> 'P083638'"""
+    return re.sub(r"[^A-Z0-9]", "", str(texto or "").upper())
+
+
+def _nucleo(clave: str) -> str:
+    """'P083638' -> '83638': sin prefijo de letras ni ceros (así lo dictan por teléfono)."""
+    nucleo = clave.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ").lstrip("0")
+    return nucleo if len(nucleo) >= 3 and nucleo != clave else ""
+
+
+def _trigramas(clave: str) -> set:
+    marcada = f"^{clave}"     # El inicio cuenta: favorece coincidencias al comienzo
+    return {marcada[i:i + 3] for i in range(len(marcada) - 2)}
+
+
+class IndiceIdentificadores:
+    """
+    El Buscador de Números.
+    POs, po_komet, AWB/HAWB, facturas y códigos de cliente en memoria:
+    una lista ordenada para prefijos (bisect) + trigramas para lo mal tecleado.
+    Responde "¿quisiste decir...?" sin tocar la DB.
+    """
+
+    def __init__(self, ttl: float = TTL_SEGUNDOS):
+        self.ttl = ttl
+        self.listo = False
+        self._lock = threading.Lock()
+        self._claves = []          # claves normalizadas, ordenadas (incluye los núcleos numéricos)
+        self._entradas = {}        # clave -> {(tipo, valor, po)}
+        self._trigramas = {}       # trigrama -> {clave}
+        self._cargado_en = 0.0
+        self._recargando = False
+        suscribir(IDENTIFICADORES_REGISTRADOS, self._al_registrar)
+
+    # --- CARGA ---
+    @staticmethod
+    def _leer(tabla: str, columnas: list) -> list:
+        filas, inicio = [], 0
+        while True:
+            pagina = db_client.table(tabla).select(", ".join(columnas))\
+                .order("id")\
+                .range(inicio, inicio + TAMANO_PAGINA - 1)\
+                .execute().data or []
+            filas.extend(pagina)
+            if len(pagina) < TAMANO_PAGINA:
+                return filas
+            inicio += TAMANO_PAGINA
+
+    @staticmethod
+    def _agregar_en(entradas: dict, tipo: str, valor, po):
+        valor = str(valor or "").strip()
+        clave = normalizar(valor)
+        if len(clave) < 2 or valor.lower() in ("nan", "none"):
+            return
+        # Un cliente no pertenece a una PO: sin esto 'MEXT' cargaría una entrada por cada fila
+        po = str(po).strip() if po and tipo != "cliente" else None
+        entradas.setdefault(clave, set()).add((tipo, valor, po))
+        nucleo = _nucleo(clave)
+        if nucleo:
+            entradas.setdefault(nucleo, set()).add((tipo, valor, po))
+
+    def cargar(self):
+        """Lectura completa (arranque y vencimiento del TTL). Una fuente que falla no tumba las demás."""
+        try:
+            entradas = {}
+            for tabla, columnas, col_po in FUENTES:
+                try:
+                    filas = self._leer(tabla, list(columnas) + ([col_po] if col_po and col_po not in columnas else []))
+                except Exception as e:
+                    logger.warning(f"Índice de búsqueda: no se pudo leer {tabla}: {e}")
+                    continue
+                for fila in filas:
+                    for columna, tipo in columnas.items():
+                        self._agregar_en(entradas, tipo, fila.get(columna), fila.get(col_po) if col_po else None)
+
+            trigramas = {}
+            for clave in entradas:
+                for t in _trigramas(clave):
+                    trigramas.setdefault(t, set()).add(clave)
+
+            with self._lock:
+                self._entradas, self._trigramas = entradas, trigramas
+                self._claves = sorted(entradas)
+                self._cargado_en = time.monotonic()
+                self.listo = True
+            logger.info(f"🔎 Índice de búsqueda cargado: {len(entradas)} claves.")
+        finally:
+            self._recargando = False
+
+    # --- ACTUALIZACIÓN INCREMENTAL ---
+    def registrar(self, pares: list):
+        """pares = [(tipo, valor, po | None)] recién escritos por la ingesta o el panel."""
+        if not self.listo:
+            return
+        nuevas = {}
+        for tipo, valor, po in pares:
+            self._agregar_en(nuevas, tipo, valor, po)
+        with self._lock:
+            for clave, conjunto in nuevas.items():
+                if clave not in self._entradas:
+                    self._entradas[clave] = set()
+                    bisect.insort(self._claves, clave)
+                    for t in _trigramas(clave):
+                        self._trigramas.setdefault(t, set()).add(clave)
+                self._entradas[clave] |= conjunto
+
+    def _al_registrar(self, pares=None, **_):
+        self.registrar(pares or [])
+
+    def _vigilar_ttl(self):
+        """Si venció, se recarga en otro hilo; mientras tanto se sirve lo que hay."""
+        if self._recargando or time.monotonic() - self._cargado_en < self.ttl:
+            return
+        self._recargando = True
+
+        def recargar():
+            try:
+                self.cargar()
+            except Exception as e:
+                logger.error(f"Recarga del índice de búsqueda falló: {e}")
+
+        threading.Thread(target=recargar, name="indice_busqueda", daemon=True).start()
+
+    # --- CONSULTAS ---
+    def _por_prefijo(self, q: str, limite: int) -> list:
+        i = bisect.bisect_left(self._claves, q)
+        claves = []
+        while i < len(self._claves) and len(claves) < limite and self._claves[i].startswith(q):
+            claves.append(self._claves[i])
+            i += 1
+        return claves
+
+    def _por_trigramas(self, q: str, limite: int) -> dict:
+        tris = _trigramas(q)
+        listas = sorted(
+            (c for c in (self._trigramas.get(t) for t in tris) if c and len(c) <= MAX_POSTING),
+            key=len
+        )
+        conteo, contadas = Counter(), 0
+        for i, claves in enumerate(listas):
+            if i >= 2 and contadas + len(claves) > PRESUPUESTO_CONTEO:
+                break
+            conteo.update(claves)       # Conteo en C: el grueso del trabajo no pasa por el intérprete
+            contadas += len(claves)
+
+        similitud = {}
+        # Candidatas = las que más trigramas raros comparten; a ellas sí se les calcula el Jaccard exacto
+        for clave, _ in conteo.most_common(limite * 8):
+            suyos = _trigramas(clave)
+            compartidos = len(tris & suyos)
+            s = compartidos / (len(tris) + len(suyos) - compartidos)
+            if s >= SIMILITUD_MINIMA:
+                similitud[clave] = s
+        return similitud
+
+    def buscar(self, texto: str, limite: int = 5, tipos=None) -> list:
+        """
+        [{"valor", "tipo", "po", "puntaje"}] de mejor a peor (None si el índice no está cargado).
+        puntaje: 3 = exacto, 2..3 = prefijo (más cerca de 3 cuanto más completo), <1 = parecido.
+        """
+        if not self.listo:
+            return None
+        self._vigilar_ttl()
+        q = normalizar(texto)
+        if not q:
+            return []
+
+        puntajes = {}
+        with self._lock:
+            if q in self._entradas:
+                puntajes[q] = 3.0
+            for clave in self._por_prefijo(q, limite * 4):
+                puntajes.setdefault(clave, 2.0 + len(q) / len(clave))
+            if len(q) >= 3 and len(puntajes) < limite:
+                for clave, s in self._por_trigramas(q, limite).items():
+                    puntajes.setdefault(clave, s)
+
+            vistos, resultado = set(), []
+            for clave in sorted(puntajes, key=lambda c: (-puntajes[c], len(c), c)):
+                for tipo, valor, po in sorted(self._entradas.get(clave, ()), key=lambda e: (e[0], e[1])):
+                    if (tipo, valor) in vistos or (tipos and tipo not in tipos):
+                        continue
+                    vistos.add((tipo, valor))
+                    resultado.append({"valor": valor, "tipo": tipo, "po": po, "puntaje": round(puntajes[clave], 3)})
+                if len(resultado) >= limite:
+                    break
+        return resultado[:limite]
+
+
+# Instancia singleton: se carga al arrancar el bot (main.py)
+indice_busqueda = IndiceIdentificadores()
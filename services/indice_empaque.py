@@ -0,0 +1,182 @@
+import os
+import re
+import math
+import time
+import logging
+import threading
+import unicodedata
+from services.cliente_supabase import db_client
+from services.eventos import suscribir, REGLAS_EMPAQUE_ACTUALIZADAS
+
+logger = logging.getLogger(__name__)
+
+TAMANO_PAGINA = 1000
+TTL_SEGUNDOS = float(os.getenv("REGLAS_TTL_SEG", "1800"))
+BONO_CODIGO = 5.0   # Nombrar el código exacto del producto pesa más que cualquier palabra
+_VACIAS = {"de", "del", "la", "el", "los", "las", "y", "con", "x", "the", "of", "and", "with"}
+
+
+def tokenizar(texto) -> list:
+    """'Rosa Roja Freedom 50cm' -> ['rosa', 'roja', 'freedom', '50cm'] (sin tildes ni palabras vacías)."""
+    plano = unicodedata.normalize("NFKD", str(texto or "")).encode("ascii", "ignore").decode("ascii").lower()
+    return [t for t in re.findall(r"[a-z0-9]+", plano) if t not in _VACIAS and (len(t) > 1 or t.isdigit())]
+
+
+class IndiceEmpaque:
+    """
+    El Fichero de Empaque.
+    Todas las reglas de customer_packing_rules en memoria, por cliente, con un índice
+    invertido palabra -> reglas. Elegir la regla de un producto ya no es un 'ilike' ni
+    "la primera palabra": se puntúa cada regla por las palabras que comparte con el
+    producto (las raras pesan más) y, si nada coincide, gana la más reciente.
+    """
+
+    def __init__(self, ttl: float = TTL_SEGUNDOS):
+        self.ttl = ttl
+        self.listo = False
+        self._lock = threading.Lock()
+        self._clientes = {}        # customer_code -> {"reglas": [...desc por last_updated], "tokens": {tok: [pos]}, "codigos": {code: [pos]}}
+        self._cargado_en = 0.0
+        self._recargando = False
+        suscribir(REGLAS_EMPAQUE_ACTUALIZADAS, self._al_actualizar_reglas)
+
+    # --- CARGA ---
+    def _leer(self, clientes: list = None) -> list:
+        filas, inicio = [], 0
+        while True:
+            query = db_client.table("customer_packing_rules").select("*")
+            if clientes is not None:
+                query = query.in_("customer_code", clientes)
+            # 'id' desempata: con solo last_updated (no único) las filas empatadas se saltan o repiten entre páginas
+            pagina = query.order("last_updated", desc=True)\
+                .order("id")\
+                .range(inicio, inicio + TAMANO_PAGINA - 1)\
+                .execute().data or []
+            filas.extend(pagina)
+            if len(pagina) < TAMANO_PAGINA:
+                return filas
+            inicio += TAMANO_PAGINA
+
+    @staticmethod
+    def _indexar(reglas: list) -> dict:
+        tokens, codigos = {}, {}
+        for pos, regla in enumerate(reglas):
+            palabras = set(tokenizar(regla.get("product_name"))) | set(tokenizar(regla.get("product_code")))
+            for t in palabras:
+                tokens.setdefault(t, []).append(pos)
+            codigos.setdefault(str(regla.get("product_code") or "").strip().upper(), []).append(pos)
+        return {"reglas": reglas, "tokens": tokens, "codigos": codigos}
+
+    def _agrupar(self, filas: list) -> dict:
+        por_cliente = {}
+        for r in filas:
+            por_cliente.setdefault(r.get("customer_code"), []).append(r)
+        return {c: self._indexar(reglas) for c, reglas in por_cliente.items() if c}
+
+    def cargar(self):
+        """Lectura completa (arranque y vencimiento del TTL)."""
+        try:
+            nuevos = self._agrupar(self._leer())
+            with self._lock:
+                self._clientes = nuevos
+                self._cargado_en = time.monotonic()
+                self.listo = True
+            logger.info(f"📦 Índice de empaque cargado: {sum(len(c['reglas']) for c in nuevos.values())} reglas, {len(nuevos)} clientes.")
+        finally:
+            self._recargando = False
+
+    def recargar_clientes(self, clientes):
+        """Relee solo los clientes indicados (lo que acaba de subir el Archivo Maestro SO)."""
+        clientes = [c for c in clientes if c]
+        if not self.listo or not clientes:
+            return
+        nuevos = self._agrupar(self._leer(clientes))
+        with self._lock:
+            for c in clientes:
+                if c in nuevos:
+                    self._clientes[c] = nuevos[c]
+                else:
+                    self._clientes.pop(c, None)
+
+    def _al_actualizar_reglas(self, clientes=None, **_):
+        try:
+            if clientes:
+                self.recargar_clientes(list(clientes))
+            else:
+                self.cargar()
+        except Exception as e:
+            logger.error(f"No se pudo refrescar el índice de empaque: {e}")
+            self._cargado_en = 0.0   # Que el TTL lo reintente en la próxima consulta
+
+    def _vigilar_ttl(self):
+        """Si venció, se recarga en otro hilo; mientras tanto se sirve lo que hay."""
+        if self._recargando or time.monotonic() - self._cargado_en < self.ttl:
+            return
+        self._recargando = True
+
+        def recargar():
+            try:
+                self.cargar()
+            except Exception as e:
+                logger.error(f"Recarga del índice de empaque falló: {e}")
+
+        threading.Thread(target=recargar, name="indice_empaque", daemon=True).start()
+
+    # --- CONSULTAS ---
+    def reglas(self, codigo_cliente: str) -> list:
+        """Reglas del cliente, más recientes primero (None si el índice no está cargado)."""
+        if not self.listo:
+            return None
+        self._vigilar_ttl()
+        entrada = self._clientes.get(codigo_cliente)
+        return list(entrada["reglas"]) if entrada else []
+
+    def reglas_del_dia(self, dia: str) -> list:
+        """Reglas con preferred_day == dia (None si el índice no está cargado)."""
+        if not self.listo:
+            return None
+        self._vigilar_ttl()
+        return [r for c in list(self._clientes.values()) for r in c["reglas"] if r.get("preferred_day") == dia]
+
+    def elegir(self, codigo_cliente: str, nombre_producto: str = ""):
+        """
+        Mejor regla del cliente para un producto (la más reciente si nada coincide).
+        None si el índice no está cargado o el cliente no tiene reglas.
+        """
+        return self.buscar(codigo_cliente, nombre_producto)[0]
+
+    def buscar(self, codigo_cliente: str, nombre_producto: str = ""):
+        """
+        (regla, puntaje). puntaje = Σ idf(palabra compartida) (+ bono si coincide el código);
+        empate -> la más reciente. puntaje 0 = ninguna coincidencia (regla más reciente).
+        """
+        if not self.listo:
+            return None, 0.0
+        self._vigilar_ttl()
+        entrada = self._clientes.get(codigo_cliente)
+        if not entrada:
+            return None, 0.0
+
+        reglas, indice = entrada["reglas"], entrada["tokens"]
+        puntajes = {}
+        for t in set(tokenizar(nombre_producto)):
+            posiciones = indice.get(t)
+            if not posiciones:
+                continue
+            idf = math.log(1 + len(reglas) / len(posiciones))
+            for pos in posiciones:
+                puntajes[pos] = puntajes.get(pos, 0.0) + idf
+
+        codigo = str(nombre_producto or "").strip().upper()
+        for pos in entrada["codigos"].get(codigo, []) if codigo else []:
+            puntajes[pos] = puntajes.get(pos, 0.0) + BONO_CODIGO
+
+        if not puntajes:
+            return reglas[0], 0.0
+        # Mayor puntaje; a igualdad, posición menor (= last_updated más reciente)
+        mejor = max(puntajes, key=lambda pos: (puntajes[pos], -pos))
+        return reglas[mejor], puntajes[mejor]
+
+
+# Instancia singleton: se carga al arrancar el bot (main.py)
+indice_empaque = IndiceEmpaque()
@@ -3,6 +3,7 @@ import logging
 import uuid
 from datetime import datetime
 from services.cliente_supabase import db_client
+from services.eventos import emitir, IDENTIFICADORES_REGISTRADOS, FILAS_KOMET_IMPORTADAS
 
 logger = logging.getLogger(__name__)
 
@@ -115,6 +116,12 @@ class IngestorKomet:
             if items_batch:
                 db_client.table("staging_komet").insert(items_batch).execute()
                 registros = len(items_batch)
+                emitir(IDENTIFICADORES_REGISTRADOS, pares=[
+                    (tipo, it.get(col), it["po_komet"])
+                    for it in items_batch
+                    for col, tipo in (("po_komet", "po_komet"), ("customer_code", "cliente"))
+                ])
+                emitir(FILAS_KOMET_IMPORTADAS, filas=items_batch)
 
             return (
                 f"📥 **Komet Importado**\n"
@@ -4,6 +4,9 @@ import logging
 from datetime import datetime
 from services.cliente_supabase import db_client
 from services.ai_helper import analizar_texto_con_ia
+from services.eventos import emitir, ORDENES_REGISTRADAS, IDENTIFICADORES_REGISTRADOS
+from services.calculadora import calculadora
+from services.config_cajas import config_cajas
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +36,41 @@ class IngestorOPBASE:
         except:
             return datetime.now().strftime('%Y-%m-%d')
 
+    def _columna(self, df: pd.DataFrame, posibles: list, defecto=0.0) -> np.ndarray:
+        nombre = next((c for c in posibles if c in df.columns), None)
+        if nombre is None:
+            return np.full(len(df), defecto, dtype=np.float64)
+        return df[nombre].map(self._limpiar_numero).to_numpy(dtype=np.float64)
+
+    def _calcular_lineas(self, df: pd.DataFrame, mapeo: dict) -> pd.DataFrame:
+        """
+        Tallos y venta de TODAS las filas del archivo en una sola llamada a la calculadora.
+        Sirve para completar 'total tallos' / 'venta total' cuando el Excel los trae vacíos.
+        """
+        cajas = np.rint(self._columna(df, mapeo["boxes"])).astype(np.int64)
+        col_uom = next((c for c in mapeo["box_type"] if c in df.columns), None)
+        tipos = df[col_uom].astype(str).to_numpy() if col_uom else np.full(len(df), "QB", dtype=object)
+        col_finca = next((c for c in mapeo["farm_code"] if c in df.columns), None)
+        fincas = df[col_finca].astype(str).to_numpy() if col_finca else None
+        col_flor = next((c for c in df.columns if 'flor' in c.lower()), None)
+        flores = df[col_flor].astype(str).to_numpy() if col_flor else None
+
+        # Ramos/tallos vacíos: el estándar de esa finca y flor (box_configs)
+        ramos = self._columna(df, mapeo["bunches_per_box"])
+        tallos = self._columna(df, mapeo["stems_per_bunch"])
+        ramos_def, tallos_def = config_cajas.empaques(tipos, fincas, flores)
+        ramos = np.where(ramos > 0, ramos, ramos_def)
+        tallos = np.where(tallos > 0, tallos, tallos_def)
+
+        factores = calculadora.factores(tipos, fincas, flores)
+        lote = calculadora.calcular_lote(
+            cajas, tipos, tallos, ramos / factores, self._columna(df, mapeo["sales_price"]), fincas, flores
+        )
+        return pd.DataFrame(
+            {"total_units": lote["total_tallos"], "total_sales_value": lote["valor_total"]},
+            index=df.index
+        )
+
     def procesar_memoria_historica(self, ruta_archivo: str):
         try:
             # 1. LECTURA
@@ -67,6 +105,8 @@ class IngestorOPBASE:
             
             registros_procesados = 0
             errores_log = []
+            ordenes_evento = []
+            identificadores = []
             productos_limpiados_ia = 0
 
             # 4. MAPEO (LIMPIO DE CAMPOS DE CABECERA)
@@ -112,6 +152,8 @@ class IngestorOPBASE:
                 "customer_code": ["Customer", "Cust"]
             }
 
+            calculo = self._calcular_lineas(df, mapeo_columnas)
+
             col_invoice = next((c for c in df.columns if 'invoice' in c.lower()), None)
             if not col_invoice: col_invoice = next((c for c in df.columns if 'po' in c.lower() and '#' in c.lower()), 'PO#')
 
@@ -156,6 +198,10 @@ class IngestorOPBASE:
                     
                     # 1. Crear Cabecera
                     db_client.table("sales_orders").upsert(cabecera, on_conflict="po_number").execute()
+                    identificadores.extend(
+                        (tipo, cabecera[col], po_real)
+                        for col, tipo in (("po_number", "po"), ("invoice_number", "invoice"), ("awb", "awb"), ("hawb", "hawb"))
+                    )
                     
                     # 2. Obtener ID
                     res_search = db_client.table("sales_orders").select("id").eq("po_number", po_real).execute()
@@ -169,7 +215,7 @@ class IngestorOPBASE:
                     col_desc = next((c for c in df.columns if 'desc' in c.lower()), 'Descrip')
                     col_flor = next((c for c in df.columns if 'flor' in c.lower()), 'flor')
 
-                    for _, row in grupo.iterrows():
+                    for idx, row in grupo.iterrows():
                         item = {"order_id": order_id}
                         
                         nombre_prod = str(row.get(col_desc, ''))
@@ -203,6 +249,11 @@ class IngestorOPBASE:
                             if val_final is not None:
                                 item[campo_sql] = val_final
 
+                        # Celdas de totales vacías: las completa la calculadora (ya calculada en lote)
+                        for campo in ("total_units", "total_sales_value"):
+                            if not item.get(campo) and calculo.at[idx, campo] > 0:
+                                item[campo] = calculo.at[idx, campo].item()
+
                         items_batch.append(item)
 
                     # 4. Inserción Items
@@ -210,11 +261,30 @@ class IngestorOPBASE:
                         db_client.table("sales_items").delete().eq("order_id", order_id).execute()
                         db_client.table("sales_items").insert(items_batch).execute()
                         registros_procesados += len(items_batch)
+                        ordenes_evento.extend(
+                            {
+                                "order_id": order_id,
+                                "po_number": po_real,
+                                "customer_code": it.get("customer_code"),
+                                "fecha": cabecera["ship_date"],
+                                "valor": it.get("total_sales_value", 0.0),
+                                "producto": it.get("product_code"),
+                                "nombre": it.get("product_name"),
+                                "precio": it.get("sales_price", 0.0),
+                            }
+                            for it in items_batch
+                        )
 
                 except Exception as e:
                     errores_log.append(f"Fallo Invoice {invoice_num}: {str(e)}")
                     continue
 
+            # Avisamos a los motores en memoria (RFM, precios) de la historia recién llegada
+            if ordenes_evento:
+                emitir(ORDENES_REGISTRADAS, ordenes=ordenes_evento)
+            if identificadores:
+                emitir(IDENTIFICADORES_REGISTRADOS, pares=identificadores)
+
             msg_error = ""
             if errores_log:
                 msg_error =f"\n⚠️ Último error: {errores_log[-1]}"
@@ -3,6 +3,9 @@ import numpy as np
 import logging
 from datetime import datetime
 from services.cliente_supabase import db_client
+from services.eventos import emitir, REGLAS_EMPAQUE_ACTUALIZADAS
+from services.calculadora import calculadora
+from services.config_cajas import config_cajas
 
 logger = logging.getLogger(__name__)
 
@@ -120,6 +123,7 @@ class IngestorSO:
                     lista_final, 
                     on_conflict="customer_code,product_code,box_type"
                 ).execute()
+                emitir(REGLAS_EMPAQUE_ACTUALIZADAS, clientes={r["customer_code"] for r in lista_final})
                 return f"🧠 **Conocimiento Logístico Adquirido:**\n📚 Reglas de Empaque Procesadas: {len(lista_final)}"
             except Exception as e:
                 logger.error(f"Error guardando reglas: {e}")
@@ -127,50 +131,65 @@ class IngestorSO:
 
         return "⚠️ Alerta: No encontré reglas válidas."
 
+    def _numeros(self, df: pd.DataFrame, columna) -> np.ndarray:
+        """Columna de Excel -> float64 (misma limpieza que _get_safe_float, en bloque)."""
+        if not columna or columna not in df.columns:
+            return np.zeros(len(df), dtype=np.float64)
+        texto = df[columna].astype(str).str.strip().str.replace(r"[,$ ]", "", regex=True)
+        return pd.to_numeric(texto, errors="coerce").fillna(0.0).to_numpy(dtype=np.float64)
+
     def _analisis_financiero_avanzado(self, df: pd.DataFrame):
-        ventas_validas = []
-        costos_validos = []
-        ventas_sin_costo = []
-        filas_totales = 0
-        
         col_qty = next((c for c in df.columns if c.lower() == 'quantity'), None)
         col_ramos_caja = next((c for c in df.columns if 'ramos' in c.lower()), None)
         col_tallos_ramo = next((c for c in df.columns if 'tallos' in c.lower() and 'total' not in c.lower()), 'tallos')
         col_precio_venta = next((c for c in df.columns if c.strip().lower() == 'precio'), None)
         col_precio_compra = next((c for c in df.columns if 'compra' in c.lower()), None)
+        col_total_t = next((c for c in df.columns if 'total tallos' in c.lower()), None)
+        col_uom = next((c for c in df.columns if 'uom' in c.lower()), None)
+        col_finca = next((c for c in df.columns if 'finca' in c.lower() and 'fact' not in c.lower()), None)
 
         if not (col_qty and col_precio_venta): return "⚠️ Error de columnas."
 
-        for idx, row in df.iterrows():
-            try:
-                qty = self._get_safe_float(row.get(col_qty))
-                if qty <= 0: continue
-                ramos = self._get_safe_float(row.get(col_ramos_caja)) or 1
-                tallos = self._get_safe_float(row.get(col_tallos_ramo)) or 1
-                p_venta = self._get_safe_float(row.get(col_precio_venta))
-                p_compra = self._get_safe_float(row.get(col_precio_compra))
-                total_tallos = qty * ramos * tallos
-                col_total_t = next((c for c in df.columns if 'total tallos' in c.lower()), None)
-                if col_total_t:
-                    val_excel = self._get_safe_float(row.get(col_total_t))
-                    if val_excel > total_tallos: total_tallos = val_excel
-                venta = total_tallos * p_venta
-                costo = total_tallos * p_compra
-                if venta > 0:
-                    filas_totales += 1
-                    if costo > 0:
-                        ventas_validas.append(venta)
-                        costos_validos.append(costo)
-                    else:
-                        ventas_sin_costo.append(venta)
-            except: continue
-
-        sum_v = sum(ventas_validas)
-        sum_c = sum(costos_validos)
+        # Todas las líneas del SO en una sola pasada de la calculadora (venta y costo)
+        qty = np.rint(self._numeros(df, col_qty)).astype(np.int64)
+        filas = qty > 0
+        tipos = df[col_uom].astype(str).to_numpy()[filas] if col_uom else np.full(filas.sum(), "QB", dtype=object)
+        fincas = df[col_finca].astype(str).to_numpy()[filas] if col_finca else None
+
+        # Ramos/tallos vacíos: estándar de la finca (box_configs) y, si no hay, 1 como siempre
+        ramos_def, tallos_def = config_cajas.empaques(tipos, fincas)
+        ramos = self._numeros(df, col_ramos_caja)[filas]
+        ramos = np.where(ramos > 0, ramos, np.where(ramos_def > 0, ramos_def, 1))
+        tallos = self._numeros(df, col_tallos_ramo)[filas]
+        tallos = np.where(tallos > 0, tallos, np.where(tallos_def > 0, tallos_def, 1))
+        # La calculadora trabaja con ramos de la Full teórica: ramos_fisicos / factor
+        ramos_full = ramos / calculadora.factores(tipos, fincas)
+
+        venta = calculadora.calcular_lote(qty[filas], tipos, tallos, ramos_full, self._numeros(df, col_precio_venta)[filas], fincas)
+        costo = calculadora.calcular_lote(qty[filas], tipos, tallos, ramos_full, self._numeros(df, col_precio_compra)[filas], fincas)
+
+        # Si el Excel trae más tallos que la fórmula, manda el Excel
+        if col_total_t:
+            tallos_excel = self._numeros(df, col_total_t)[filas]
+            mayor = tallos_excel > venta['total_tallos']
+            precio_v = self._numeros(df, col_precio_venta)[filas]
+            precio_c = self._numeros(df, col_precio_compra)[filas]
+            venta['valor_total'] = np.where(mayor, tallos_excel * precio_v, venta['valor_total'])
+            costo['valor_total'] = np.where(mayor, tallos_excel * precio_c, costo['valor_total'])
+
+        ventas, costos = venta['valor_total'], costo['valor_total']
+        con_venta = ventas > 0
+        filas_totales = int(con_venta.sum())
+        ventas_validas = ventas[con_venta & (costos > 0)]
+        costos_validos = costos[con_venta & (costos > 0)]
+        ventas_sin_costo = ventas[con_venta & (costos <= 0)]
+
+        sum_v = float(ventas_validas.sum())
+        sum_c = float(costos_validos.sum())
         margen_pct = 0.20 
         if sum_v > 0: margen_pct = (sum_v - sum_c) / sum_v
-        costo_proyectado = sum(ventas_sin_costo) * (1 - margen_pct)
-        gran_total_ventas = sum_v + sum(ventas_sin_costo)
+        costo_proyectado = float(ventas_sin_costo.sum()) * (1 - margen_pct)
+        gran_total_ventas = sum_v + float(ventas_sin_costo.sum())
         gran_total_costos = sum_c + costo_proyectado
         gran_margen = gran_total_ventas - gran_total_costos
         margen_final_pct = (gran_margen / gran_total_ventas * 100) if gran_total_ventas > 0 else 0
@@ -0,0 +1,210 @@
+import logging
+import threading
+from datetime import date, datetime
+import numpy as np
+from services.cliente_supabase import db_client
+from services.eventos import suscribir, ORDENES_REGISTRADAS
+
+logger = logging.getLogger(__name__)
+
+TAMANO_PAGINA = 1000
+_EPOCA = date(1970, 1, 1)
+
+
+def _a_dia(fecha) -> int:
+    """'2025-11-26' / date / datetime -> días desde 1970 (int)."""
+    if not fecha:
+        return -1
+    if isinstance(fecha, datetime):
+        fecha = fecha.date()
+    if not isinstance(fecha, date):
+        try:
+            fecha = date.fromisoformat(str(fecha)[:10])
+        except ValueError:
+            return -1
+    return (fecha - _EPOCA).days
+
+
+def _quintil(valores: np.ndarray) -> np.ndarray:
+    """Puntaje 1..5 por ranking (5 = mejor). Vectorizado."""
+    n = len(valores)
+    if n == 0:
+        return np.zeros(0, dtype=np.int8)
+    rangos = np.empty(n, dtype=np.int64)
+    rangos[np.argsort(valores, kind="stable")] = np.arange(n)
+    return (rangos * 5 // n + 1).astype(np.int8)
+
+
+class MotorRFM:
+    """
+    El Contador de Lealtades.
+    Carga el historial de ventas una vez en arreglos columnares (un slot por cliente)
+    y calcula Recencia / Frecuencia / Monto en una sola pasada de NumPy.
+    Luego se mantiene al día con cada orden nueva sin volver a leer la historia.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.listo = False
+        self._indice = {}                             # customer_code -> slot
+        self._codigos = []                            # slot -> customer_code
+        self._frecuencia = np.zeros(0, dtype=np.int64)
+        self._monto = np.zeros(0, dtype=np.float64)
+        self._ultimo_dia = np.zeros(0, dtype=np.int64)
+        self._ordenes = {}                            # order_id -> [(slot, dia, valor)]
+        suscribir(ORDENES_REGISTRADAS, self._al_registrar_ordenes)
+
+    # --- CARGA INICIAL ---
+    def cargar(self):
+        """Lee sales_items (+ fecha de su orden) paginado y arma los arreglos."""
+        filas = []
+        inicio = 0
+        while True:
+            res = db_client.table("sales_items")\
+                .select("order_id, customer_code, total_line_value, total_sales_value, sales_orders(ship_date)")\
+                .range(inicio, inicio + TAMANO_PAGINA - 1)\
+                .execute()
+            pagina = res.data or []
+            filas.extend(pagina)
+            if len(pagina) < TAMANO_PAGINA:
+                break
+            inicio += TAMANO_PAGINA
+
+        codigos = np.array([str(f.get('customer_code') or '').strip() for f in filas], dtype=object)
+        ordenes = np.array([str(f.get('order_id')) for f in filas], dtype=object)
+        dias = np.array([_a_dia((f.get('sales_orders') or {}).get('ship_date')) for f in filas], dtype=np.int64)
+        valores = np.array(
+            [float(f.get('total_line_value') or f.get('total_sales_value') or 0.0) for f in filas],
+            dtype=np.float64
+        )
+        self._construir(codigos, ordenes, dias, valores)
+        logger.info(f"📊 Motor RFM cargado: {len(self._codigos)} clientes, {len(self._ordenes)} órdenes.")
+
+    def _construir(self, codigos, ordenes, dias, valores):
+        validos = codigos != ''
+        codigos, ordenes, dias, valores = codigos[validos], ordenes[validos], dias[validos], valores[validos]
+
+        lista_codigos, slot = np.unique(codigos, return_inverse=True)
+        n = len(lista_codigos)
+
+        # Frecuencia = órdenes distintas por cliente (pares únicos cliente-orden)
+        _, ord_idx = np.unique(ordenes, return_inverse=True)
+        pares = np.unique(np.stack([slot, ord_idx], axis=1).astype(np.int64), axis=0)
+        frecuencia = np.bincount(pares[:, 0], minlength=n).astype(np.int64)
+
+        monto = np.bincount(slot, weights=valores, minlength=n)
+        ultimo = np.full(n, -1, dtype=np.int64)
+        np.maximum.at(ultimo, slot, dias)
+
+        por_orden = {}
+        for s_, o_, d_, v_ in zip(slot.tolist(), ordenes.tolist(), dias.tolist(), valores.tolist()):
+            por_orden.setdefault(o_, []).append((s_, d_, v_))
+
+        with self._lock:
+            self._codigos = list(lista_codigos)
+            self._indice = {c: i for i, c in enumerate(self._codigos)}
+            self._frecuencia, self._monto, self._ultimo_dia = frecuencia, monto, ultimo
+            self._ordenes = por_orden
+            self.listo = True
+
+    # --- ACTUALIZACIÓN INCREMENTAL ---
+    def _slot(self, codigo: str) -> int:
+        slot = self._indice.get(codigo)
+        if slot is None:
+            slot = len(self._codigos)
+            self._codigos.append(codigo)
+            self._indice[codigo] = slot
+            self._frecuencia = np.append(self._frecuencia, 0)
+            self._monto = np.append(self._monto, 0.0)
+            self._ultimo_dia = np.append(self._ultimo_dia, -1)
+        return slot
+
+    def registrar_ordenes(self, ordenes: list):
+        """
+        ordenes = [{"order_id", "customer_code", "fecha", "valor"}] (una entrada por línea o por orden).
+        Si la orden ya existía (re-importación OPBASE) se reemplaza su aporte.
+        """
+        if not self.listo:
+            return
+        nuevas = {}
+        for o in ordenes:
+            codigo = str(o.get('customer_code') or '').strip()
+            if codigo:
+                nuevas.setdefault(str(o['order_id']), []).append((codigo, _a_dia(o.get('fecha')), float(o.get('valor') or 0.0)))
+
+        with self._lock:
+            for order_id, lineas in nuevas.items():
+                previas = self._ordenes.pop(order_id, [])
+                for slot in {s for s, _, _ in previas}:
+                    self._frecuencia[slot] -= 1
+                for slot, _, valor in previas:
+                    self._monto[slot] -= valor
+
+                aporte = [(self._slot(codigo), dia, valor) for codigo, dia, valor in lineas]
+                self._ordenes[order_id] = aporte
+                for slot in {s for s, _, _ in aporte}:
+                    self._frecuencia[slot] += 1
+                for slot, dia, valor in aporte:
+                    self._monto[slot] += valor
+                    if dia > self._ultimo_dia[slot]:
+                        self._ultimo_dia[slot] = dia
+
+    def _al_registrar_ordenes(self, ordenes: list, **_):
+        self.registrar_ordenes(ordenes)
+
+    # --- CONSULTAS ---
+    def perfil(self, codigo: str):
+        """
+        Mismas llaves que v_customer_rfm (days_since_last_order, avg_order_value, lifetime_orders).
+        None si el motor no está cargado; {} si el cliente no tiene historial.
+        """
+        if not self.listo:
+            return None
+        slot = self._indice.get(codigo)
+        if slot is None or self._frecuencia[slot] <= 0:
+            return {}
+        frecuencia = int(self._frecuencia[slot])
+        monto = float(self._monto[slot])
+        ultimo = int(self._ultimo_dia[slot])
+        return {
+            "days_since_last_order": (_a_dia(date.today()) - ultimo) if ultimo >= 0 else None,
+            "avg_order_value": monto / frecuencia,
+            "lifetime_orders": frecuencia,
+            "lifetime_value": monto,
+        }
+
+    def ranking(self, limite: int = 20) -> list:
+        """Clientes ordenados por puntaje RFM (R+F+M, cada uno en quintiles 1..5) y luego por monto."""
+        with self._lock:
+            activos = np.flatnonzero(self._frecuencia > 0)
+            frecuencia = self._frecuencia[activos]
+            monto = self._monto[activos]
+            ultimo = self._ultimo_dia[activos]
+            codigos = [self._codigos[i] for i in activos]
+
+        if not codigos:
+            return []
+
+        hoy = _a_dia(date.today())
+        recencia = np.where(ultimo >= 0, hoy - ultimo, 10**6)
+        r = _quintil(-recencia)      # Menos días = mejor
+        f = _quintil(frecuencia)
+        m = _quintil(monto)
+        puntaje = r.astype(np.int64) + f + m
+
+        orden = np.lexsort((-monto, -puntaje))[:limite]
+        return [
+            {
+                "cliente": codigos[i],
+                "puntaje": int(puntaje[i]),
+                "r": int(r[i]), "f": int(f[i]), "m": int(m[i]),
+                "dias": int(recencia[i]) if recencia[i] < 10**6 else None,
+                "ordenes": int(frecuencia[i]),
+                "monto": float(monto[i]),
+            }
+            for i in orden
+        ]
+
+
+# Instancia singleton: se carga al arrancar el bot (main.py)
+motor_rfm = MotorRFM()
@@ -1,7 +1,30 @@
+import os
 import uuid
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from zoneinfo import ZoneInfo
 from typing import Optional, Tuple, Dict, Any
 from services.cliente_supabase import db_client, logger
+from services.cache_ttl import CacheTTL
+from services.eventos import suscribir, emitir, REGLAS_EMPAQUE_ACTUALIZADAS, ORDENES_REGISTRADAS, IDENTIFICADORES_REGISTRADOS
+from services.motor_rfm import motor_rfm
+from services.precios_historicos import almacen_precios
+from services.indice_empaque import indice_empaque
+from services.config_cajas import config_cajas
+
+# Hilos para disparar consultas en paralelo y sacar la auditoría del camino crítico
+_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="motor_ventas")
+
+# Zona horaria del negocio: define qué día es "hoy" para el cronograma
+ZONA_NEGOCIO = ZoneInfo(os.getenv("RUTINA_TZ", "America/Bogota"))
+
+# Ramos/tallos por defecto salen de box_configs (services/config_cajas.py); 10 x 25 si no hay
+REGLA_DEFECTO = {"box_type": "QB", "mark_code": "Standard"}
+
+# Un ajuste de precio espera a que su INSERT de auditoría aterrice, pero no para siempre
+AUDITORIA_TIMEOUT_SEG = float(os.getenv("AUDITORIA_TIMEOUT_SEG", "10"))
 
 class GestorPrediccionVentas:
     """
@@ -11,104 +34,220 @@ class GestorPrediccionVentas:
 
     def __init__(self):
         self.db = db_client
+        # El maestro de clientes casi no cambia; el RFM se mueve con cada venta
+        self._cache_clientes = CacheTTL(ttl_segundos=3600, max_items=2000)
+        self._cache_rfm = CacheTTL(ttl_segundos=600, max_items=2000)
+        self._rpc_contexto = True  # Se apaga solo si la función SQL 002 no está instalada
+        self._rpc_orden = True     # Ídem con la 003 (orden multilínea atómica)
+        # prediction_id -> Future del INSERT (True si aterrizó). Acotado: nadie ajusta una propuesta de ayer
+        self._auditorias = CacheTTL(ttl_segundos=6 * 3600, max_items=5000)
+        # Cronograma precalculado: {fecha_iso: [oportunidades]} (solo se guarda el día vigente)
+        self._cronograma = {}
+        self._cronograma_lock = threading.Lock()
+        suscribir(REGLAS_EMPAQUE_ACTUALIZADAS, self._invalidar_cronograma)
 
-    # --- FASE 3: EL CRONOGRAMA MAESTRO (NUEVO) ---
+    # --- FASE 3: EL CRONOGRAMA MAESTRO (Precalculado) ---
     def buscar_oportunidades_del_dia(self) -> list:
         """
         Consulta qué clientes tienen la costumbre de pedir HOY.
-        Retorna una lista de oportunidades para el comando /rutina.
+        Sirve desde memoria; solo reconstruye si cambió el día o las reglas de empaque.
         """
-        try:
-            # 1. ¿Qué día es hoy? (En Inglés: Monday, Tuesday...)
-            dia_actual = datetime.now().strftime('%A')
-            
-            logger.info(f"📅 Buscando oportunidades para: {dia_actual}")
+        hoy = datetime.now(ZONA_NEGOCIO).date().isoformat()
+        lista = self._cronograma.get(hoy)
+        if lista is not None:
+            return lista
+        return self.reconstruir_cronograma()
 
-            # 2. Consulta a la Memoria (Packing Rules)
-            res = self.db.table("customer_packing_rules")\
-                .select("*")\
-                .eq("preferred_day", dia_actual)\
-                .execute()
-            
-            if not res.data:
+    def reconstruir_cronograma(self) -> list:
+        """
+        Arma la lista del día: una oportunidad por cliente con conteo real de productos,
+        caja típica y valor esperado (ticket promedio del RFM). Lo llama el job matutino.
+        """
+        with self._cronograma_lock:
+            ahora = datetime.now(ZONA_NEGOCIO)
+            hoy = ahora.date().isoformat()
+            try:
+                oportunidades = self._calcular_oportunidades(ahora.strftime('%A'))
+            except Exception as e:
+                logger.error(f"Error buscando oportunidades: {e}")
                 return []
-
-            # 3. Refinamiento (Agrupar por cliente)
-            oportunidades = []
-            clientes_vistos = set()
-
-            for regla in res.data:
-                cliente = regla['customer_code']
-                if cliente not in clientes_vistos:
-                    oportunidades.append({
-                        "cliente": cliente,
-                        "producto_ejemplo": regla['product_name'],
-                        "total_productos": 1, 
-                        "caja_tipica": regla['box_type']
-                    })
-                    clientes_vistos.add(cliente)
-            
+            self._cronograma = {hoy: oportunidades}
             return oportunidades
 
-        except Exception as e:
-            logger.error(f"Error buscando oportunidades: {e}")
+    def _invalidar_cronograma(self, **_):
+        # Llegaron reglas nuevas (Archivo Maestro SO): el próximo /rutina recalcula
+        self._cronograma = {}
+
+    def _calcular_oportunidades(self, dia_actual: str) -> list:
+        logger.info(f"📅 Construyendo cronograma para: {dia_actual}")
+
+        # 1. Reglas del día: del índice en memoria, o de la DB (solo las columnas que usamos)
+        reglas_dia = indice_empaque.reglas_del_dia(dia_actual)
+        if reglas_dia is None:
+            reglas_dia = self.db.table("customer_packing_rules")\
+                .select("customer_code, product_code, product_name, box_type")\
+                .eq("preferred_day", dia_actual)\
+                .execute().data
+
+        if not reglas_dia:
             return []
 
+        # 2. Agrupar por cliente
+        grupos = {}
+        for regla in reglas_dia:
+            grupos.setdefault(regla['customer_code'], []).append(regla)
+
+        # 3. Ticket promedio de todos los clientes del día en dos consultas masivas
+        maestro = self.db.table("customers")\
+            .select("id, name, code")\
+            .in_("code", list(grupos.keys()))\
+            .execute().data or []
+        por_codigo = {c['code']: c for c in maestro}
+
+        tickets = {}
+        if maestro:
+            rfm = self.db.table("v_customer_rfm")\
+                .select("customer_id, avg_order_value")\
+                .in_("customer_id", [c['id'] for c in maestro])\
+                .execute().data or []
+            tickets = {r['customer_id']: float(r.get('avg_order_value') or 0.0) for r in rfm}
+
+        # 4. Refinamiento
+        oportunidades = []
+        for cliente, reglas in grupos.items():
+            cajas = Counter(r.get('box_type') or 'QB' for r in reglas)
+            productos = {r.get('product_code') or r.get('product_name') for r in reglas}
+            info = por_codigo.get(cliente, {})
+            oportunidades.append({
+                "cliente": cliente,
+                "nombre": info.get('name', cliente),
+                "producto_ejemplo": reglas[0].get('product_name'),
+                "total_productos": len(productos),
+                "caja_tipica": cajas.most_common(1)[0][0],
+                "tipos_caja": dict(cajas),
+                "valor_esperado": round(tickets.get(info.get('id'), 0.0), 2)
+            })
+
+        # Primero los que más plata suelen dejar
+        oportunidades.sort(key=lambda o: (-o['valor_esperado'], o['cliente']))
+        return oportunidades
+
     # --- MÉTODOS EXISTENTES (Fase 1 y 2) ---
 
-    def _obtener_perfil_cliente(self, codigo_cliente: str):
+    # --- CONTEXTO DEL CLIENTE (Perfil + RFM + Reglas en un solo viaje) ---
+
+    def _obtener_contexto(self, codigo_cliente: str):
+        """
+        Retorna (perfil, reglas_empaque, error).
+        Camino rápido: una sola RPC (sql/002). Si no existe, consultas en paralelo con caché.
+        """
+        if self._rpc_contexto:
+            try:
+                return self._contexto_por_rpc(codigo_cliente)
+            except Exception as e:
+                if "fn_contexto_sugerencia" in str(e) or "PGRST202" in str(e):
+                    logger.warning("RPC fn_contexto_sugerencia no instalada. Usando consultas paralelas.")
+                    self._rpc_contexto = False
+                else:
+                    return None, [], str(e)
         try:
-            res_id = self.db.table("customers")\
-                .select("id, name, code")\
-                .or_(f"code.eq.{codigo_cliente},customer_code.eq.{codigo_cliente}")\
-                .execute()
+            return self._contexto_en_paralelo(codigo_cliente)
+        except Exception as e:
+            return None, [], str(e)
 
-            if not res_id.data:
-                return None, None
+    def _contexto_por_rpc(self, codigo_cliente: str):
+        # Con el motor RFM en memoria listo, la RPC no toca v_customer_rfm
+        res = self.db.rpc("fn_contexto_sugerencia", {
+            "p_codigo": codigo_cliente, "p_con_rfm": not motor_rfm.listo
+        }).execute()
+        datos = res.data or {}
+        cliente = datos.get("cliente")
+        if not cliente:
+            return None, [], None
 
-            cliente_maestro = res_id.data[0]
-            uuid_cliente = cliente_maestro['id']
+        perfil_rfm = self._rfm_local(cliente)
+        if perfil_rfm is None:
+            perfil_rfm = datos.get("rfm") or {}
+        return {**cliente, **perfil_rfm}, datos.get("reglas") or [], None
 
-            res_rfm = self.db.table("v_customer_rfm")\
-                .select("*")\
-                .eq("customer_id", uuid_cliente)\
-                .execute()
-            
-            perfil_rfm = res_rfm.data[0] if res_rfm.data else {}
-            return {**cliente_maestro, **perfil_rfm}, None
+    def _contexto_en_paralelo(self, codigo_cliente: str):
+        # Las reglas solo dependen del código: salen ya, en paralelo con el perfil
+        fut_reglas = _pool.submit(self._consultar_reglas, codigo_cliente)
 
-        except Exception as e:
-            return None, str(e)
+        cliente_maestro = self._cache_clientes.obtener_o_calcular(
+            codigo_cliente, lambda: self._consultar_cliente(codigo_cliente)
+        )
+        if not cliente_maestro:
+            fut_reglas.cancel()
+            return None, [], None
 
-    def _obtener_regla_empaque(self, codigo_cliente: str, nombre_producto: str = ""):
-        try:
-            # 1. Intento Exacto
-            res = self.db.table("customer_packing_rules")\
-                .select("*")\
-                .eq("customer_code", codigo_cliente)\
-                .ilike("product_name", f"%{nombre_producto.split(' ')[0]}%")\
-                .limit(1)\
-                .execute()
-            
-            if res.data: return res.data[0]
+        uuid_cliente = cliente_maestro['id']
+        perfil_rfm = self._rfm_local(cliente_maestro)
+        if perfil_rfm is None:
+            perfil_rfm = self._cache_rfm.obtener_o_calcular(uuid_cliente, lambda: self._consultar_rfm(uuid_cliente))
 
-            # 2. Intento Genérico
-            res_gen = self.db.table("customer_packing_rules")\
-                .select("*")\
-                .eq("customer_code", codigo_cliente)\
-                .order("last_updated", desc=True)\
-                .limit(1)\
-                .execute()
-            
-            if res_gen.data: return res_gen.data[0]
-            
-            return {"box_type": "QB", "bunches_per_box": 10, "stems_per_bunch": 25, "mark_code": "Standard"}
-        except Exception:
-            return {"box_type": "QB", "bunches_per_box": 10, "stems_per_bunch": 25}
+        reglas = fut_reglas.result()
+        if not reglas and cliente_maestro.get('code') and cliente_maestro['code'] != codigo_cliente:
+            # Nos escribieron el alias (customer_code); las reglas viven bajo el code oficial
+            reglas = self._consultar_reglas(cliente_maestro['code'])
+
+        return {**cliente_maestro, **(perfil_rfm or {})}, reglas, None
+
+    def _rfm_local(self, cliente: dict):
+        """RFM desde el motor en memoria (None si aún no cargó: se usa v_customer_rfm)."""
+        if not motor_rfm.listo:
+            return None
+        return motor_rfm.perfil(cliente.get('code')) or {}
+
+    def _consultar_cliente(self, codigo_cliente: str):
+        res_id = self.db.table("customers")\
+            .select("id, name, code")\
+            .or_(f"code.eq.{codigo_cliente},customer_code.eq.{codigo_cliente}")\
+            .execute()
+        return res_id.data[0] if res_id.data else None
+
+    def _consultar_rfm(self, uuid_cliente: str):
+        res_rfm = self.db.table("v_customer_rfm")\
+            .select("*")\
+            .eq("customer_id", uuid_cliente)\
+            .execute()
+        return res_rfm.data[0] if res_rfm.data else {}
+
+    def _consultar_reglas(self, codigo_cliente: str) -> list:
+        reglas = indice_empaque.reglas(codigo_cliente)
+        if reglas is not None:
+            return reglas
+        res = self.db.table("customer_packing_rules")\
+            .select("*")\
+            .eq("customer_code", codigo_cliente)\
+            .order("last_updated", desc=True)\
+            .execute()
+        return res.data or []
+
+    def _elegir_regla_empaque(self, reglas: list, nombre_producto: str = "", codigo_cliente: str = None):
+        """
+        Con el índice cargado: ranking por palabras compartidas (services/indice_empaque).
+        Si no, la lógica de antes (primera palabra, si no la más reciente) sobre las reglas ya traídas.
+        """
+        if codigo_cliente:
+            regla = indice_empaque.elegir(codigo_cliente, nombre_producto)
+            if regla:
+                return regla
+
+        if not reglas:
+            return dict(REGLA_DEFECTO)
+
+        palabra = nombre_producto.split(' ')[0].lower()
+        for regla in reglas:
+            if palabra in str(regla.get('product_name') or '').lower():
+                return regla
+
+        # Las reglas llegan ordenadas por last_updated desc
+        return reglas[0]
 
     def generar_sugerencia_pedido(self, codigo_cliente: str) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
         try:
-            perfil, error = self._obtener_perfil_cliente(codigo_cliente)
+            perfil, reglas, error = self._obtener_contexto(codigo_cliente)
             
             if error:
                 logger.error(f"Error DB: {error}")
@@ -117,132 +256,401 @@ class GestorPrediccionVentas:
             if not perfil:
                 return None, {"error": f"El código '{codigo_cliente}' no existe."}
 
-            dias_inactividad = perfil.get('days_since_last_order')
-            ticket_promedio = float(perfil.get('avg_order_value') or 0.0)
-            lifetime_orders = int(perfil.get('lifetime_orders') or 0)
-
-            if dias_inactividad is None:
-                estrategia = "PROSPECCION"
-                producto = "Mix de Muestras"
-                precio_sugerido = 0.0
-                observacion = "Cliente nuevo sin historial."
-            elif dias_inactividad > 45:
-                estrategia = "REACTIVACION"
+            detalle_sugerencia = self._armar_sugerencia(perfil, reglas)
+            prediction_id = self._registrar_auditoria(perfil.get('id'), detalle_sugerencia)
+            return prediction_id, detalle_sugerencia
+
+        except Exception as e:
+            logger.error(f"Fallo crítico: {e}")
+            return None, {"error": str(e)}
+
+    def generar_sugerencias_lote(self, codigos: list) -> list:
+        """
+        /rutina all: sugerencias para todos los clientes del día.
+        3 consultas masivas para el contexto + 1 INSERT masivo de auditoría (en segundo plano).
+        Retorna [(prediction_id | None, sugerencia | {"error": ...})] en el mismo orden de 'codigos'.
+        """
+        try:
+            contextos = self._contextos_en_lote(codigos)
+        except Exception as e:
+            logger.error(f"Error DB lote: {e}")
+            return [(None, {"error": "Error de conexión.", "codigo_interno": c}) for c in codigos]
+
+        salida, payloads = [], []
+        for codigo in codigos:
+            perfil, reglas = contextos.get(codigo, (None, []))
+            if not perfil:
+                salida.append((None, {"error": f"El código '{codigo}' no existe.", "codigo_interno": codigo}))
+                continue
+            try:
+                detalle = self._armar_sugerencia(perfil, reglas)
+            except Exception as e:
+                salida.append((None, {"error": str(e), "codigo_interno": codigo}))
+                continue
+            payload = self._payload_auditoria(perfil.get('id'), detalle)
+            payloads.append(payload)
+            salida.append((payload["id"], detalle))
+
+        if payloads:
+            futuro = _pool.submit(self._insertar_auditorias, payloads)
+            for p in payloads:
+                self._auditorias.set(p["id"], futuro)
+        return salida
+
+    def _contextos_en_lote(self, codigos: list) -> dict:
+        """{codigo: (perfil, reglas)} para muchos clientes con tres consultas 'in'."""
+        lista = ",".join(f'"{c}"' for c in codigos)
+        maestro = self.db.table("customers")\
+            .select("id, name, code, customer_code")\
+            .or_(f"code.in.({lista}),customer_code.in.({lista})")\
+            .execute().data or []
+
+        buscados = set(codigos)
+        por_codigo = {}
+        for c in maestro:
+            for alias in (c.get('code'), c.get('customer_code')):
+                if alias in buscados and alias not in por_codigo:
+                    por_codigo[alias] = {"id": c['id'], "name": c['name'], "code": c['code']}
+
+        ids = list({c['id'] for c in por_codigo.values()})
+        rfm = {}
+        if ids and not motor_rfm.listo:
+            filas_rfm = self.db.table("v_customer_rfm").select("*").in_("customer_id", ids).execute().data or []
+            rfm = {r['customer_id']: r for r in filas_rfm}
+
+        codigos_reglas = list(set(codigos) | {c['code'] for c in por_codigo.values() if c.get('code')})
+        reglas = {}
+        if indice_empaque.listo:
+            for c in codigos_reglas:
+                reglas[c] = indice_empaque.reglas(c)
+        else:
+            filas_reglas = self.db.table("customer_packing_rules")\
+                .select("*")\
+                .in_("customer_code", codigos_reglas)\
+                .order("last_updated", desc=True)\
+                .execute().data or []
+            for r in filas_reglas:
+                reglas.setdefault(r['customer_code'], []).append(r)
+
+        contextos = {}
+        for codigo in codigos:
+            cliente = por_codigo.get(codigo)
+            if not cliente:
+                continue
+            perfil_rfm = self._rfm_local(cliente)
+            if perfil_rfm is None:
+                perfil_rfm = rfm.get(cliente['id'], {})
+            self._cache_clientes.set(codigo, cliente)
+            self._cache_rfm.set(cliente['id'], perfil_rfm)
+            contextos[codigo] = (
+                {**cliente, **perfil_rfm},
+                reglas.get(codigo) or reglas.get(cliente.get('code')) or []
+            )
+        return contextos
+
+    def _armar_sugerencia(self, perfil: dict, reglas: list) -> dict:
+        dias_inactividad = perfil.get('days_since_last_order')
+        ticket_promedio = float(perfil.get('avg_order_value') or 0.0)
+        lifetime_orders = int(perfil.get('lifetime_orders') or 0)
+        # Precio por tallo del producto que más compra (O(1) desde el almacén en memoria)
+        historial = almacen_precios.favorito(perfil.get('code'))
+
+        if dias_inactividad is None:
+            estrategia = "PROSPECCION"
+            producto = "Mix de Muestras"
+            precio_sugerido = 0.0
+            observacion = "Cliente nuevo sin historial."
+        elif dias_inactividad > 45:
+            estrategia = "REACTIVACION"
+            if historial:
+                producto = historial['nombre']   # Oferta retorno: mismo producto, 8% abajo
+                precio_sugerido = historial['precio_esperado'] * 0.92
+            else:
                 producto = "Freedom Red (Oferta Retorno)"
                 precio_sugerido = ticket_promedio * 0.92 
-                observacion = f"⚠️ ALERTA: Inactivo hace {dias_inactividad} días."
+            observacion = f"⚠️ ALERTA: Inactivo hace {dias_inactividad} días."
+        else:
+            estrategia = "MANTENIMIENTO"
+            if historial:
+                producto = historial['nombre']
+                precio_sugerido = historial['precio_esperado']
             else:
-                estrategia = "MANTENIMIENTO"
                 producto = "Pedido Recurrente"
                 precio_sugerido = ticket_promedio
-                observacion = "Cliente saludable."
-
-            regla_empaque = self._obtener_regla_empaque(perfil.get('code'), producto)
-
-            detalle_sugerencia = {
-                "cliente_nombre": perfil.get('name'),
-                "codigo_interno": perfil.get('code'),
-                "estrategia_aplicada": estrategia,
-                "producto_objetivo": producto,
-                "precio_unitario": round(precio_sugerido, 2),
-                "justificacion_tecnica": observacion,
-                "logistica": {
-                    "tipo_caja": regla_empaque.get("box_type", "QB"),
-                    "ramos_x_caja": regla_empaque.get("bunches_per_box", 10),
-                    "tallos_x_ramo": regla_empaque.get("stems_per_bunch", 25),
-                    "marcacion": regla_empaque.get("mark_code", "Standard"),
-                    "upc": regla_empaque.get("upc_code", "")
-                },
-                "metricas_base": {
-                    "dias_sin_compra": dias_inactividad if dias_inactividad is not None else "N/A",
-                    "promedio_historico": ticket_promedio
-                }
+            observacion = "Cliente saludable."
+
+        if historial and estrategia != "PROSPECCION":
+            observacion += (
+                f" Precio base: último ${historial['ultimo']:.2f} | mediana ${historial['mediana']:.2f}"
+                f" | tendencia {historial['tendencia_mes']:+.3f}/mes | semana x{historial['factor_semana']:.2f}"
+            )
+
+        regla_empaque = self._elegir_regla_empaque(reglas, producto, perfil.get('code'))
+
+        detalle_sugerencia = {
+            "cliente_nombre": perfil.get('name'),
+            "codigo_interno": perfil.get('code'),
+            "estrategia_aplicada": estrategia,
+            "producto_objetivo": producto,
+            "precio_unitario": round(precio_sugerido, 2),
+            "justificacion_tecnica": observacion,
+            "logistica": self._logistica(regla_empaque),
+            "metricas_base": {
+                "dias_sin_compra": dias_inactividad if dias_inactividad is not None else "N/A",
+                "promedio_historico": ticket_promedio,
+                "precio_ultimo": historial['ultimo'] if historial else None,
+                "precio_mediana": historial['mediana'] if historial else None
             }
+        }
+        return detalle_sugerencia
 
-            prediction_id = self._registrar_auditoria(perfil.get('id'), detalle_sugerencia)
-            return prediction_id, detalle_sugerencia
+    def _logistica(self, regla_empaque: dict) -> dict:
+        tipo_caja = regla_empaque.get("box_type") or "QB"
+        # La regla manda; si no trae ramos/tallos (0 en el SO), el estándar configurado de esa caja
+        estandar = config_cajas.empaque(tipo_caja, flor=regla_empaque.get("flower_type"))
+        return {
+            "tipo_caja": tipo_caja,
+            "ramos_x_caja": regla_empaque.get("bunches_per_box") or estandar.get("bunches_per_box", 10),
+            "tallos_x_ramo": regla_empaque.get("stems_per_bunch") or estandar.get("stems_per_bunch", 25),
+            "marcacion": regla_empaque.get("mark_code", "Standard"),
+            "upc": regla_empaque.get("upc_code", "")
+        }
 
-        except Exception as e:
-            logger.error(f"Fallo crítico: {e}")
-            return None, {"error": str(e)}
+    def armar_linea_adicional(self, codigo_cliente: str, producto: str, precio: float = None) -> dict:
+        """
+        Línea extra para el carrito de /sugerir: empaque según las reglas del cliente
+        y precio del historial (si el usuario no lo escribió). Misma forma que una sugerencia.
+        """
+        regla, puntaje = indice_empaque.buscar(codigo_cliente, producto)
+        if regla is None:
+            regla = self._elegir_regla_empaque(self._consultar_reglas(codigo_cliente), producto)
+        # Si la regla realmente coincide, adoptamos su nombre/código (así el precio sí aparece)
+        conocido = regla if puntaje > 0 else {}
+
+        if precio is None:
+            historial = almacen_precios.precio(codigo_cliente, conocido.get("product_code") or producto) \
+                or almacen_precios.precio(codigo_cliente, conocido.get("product_name") or producto)
+            if not historial:
+                return {"error": f"Sin precio histórico para '{producto}'. Escríbelo: <i>{producto}, 2, 0.40</i>"}
+            precio = historial["precio_esperado"]
+        return {
+            "codigo_interno": codigo_cliente,
+            "producto_objetivo": conocido.get("product_name") or producto,
+            "precio_unitario": round(float(precio), 2),
+            "logistica": self._logistica(regla),
+        }
 
     def _registrar_auditoria(self, client_id: str, sugerencia: dict):
-        payload = {
+        """
+        El id se genera aquí y el INSERT viaja en segundo plano:
+        el usuario ve su propuesta sin esperar a la auditoría.
+        """
+        payload = self._payload_auditoria(client_id, sugerencia)
+        self._auditorias.set(payload["id"], _pool.submit(self._insertar_auditoria, payload))
+        return payload["id"]
+
+    def _payload_auditoria(self, client_id: str, sugerencia: dict) -> dict:
+        return {
+            "id": str(uuid.uuid4()),
             "client_id": client_id,
             "input_context": sugerencia["metricas_base"],
             "bot_suggestion": sugerencia,
             "created_at": datetime.utcnow().isoformat()
         }
+
+    def _insertar_auditorias(self, payloads: list) -> bool:
+        """INSERT masivo de auditorías (un solo request). True si las filas quedaron escritas."""
         try:
-            response = self.db.table("prediction_history").insert(payload).execute()
-            if response.data: return response.data[0]['id']
+            self.db.table("prediction_history").insert(payloads).execute()
+            return True
+        except Exception as e:
+            if "23503" in str(e) or "foreign key" in str(e):
+                # Algún cliente no está en la FK: degradamos el lote completo a client_id nulo
+                for p in payloads: p["client_id"] = None
+                try:
+                    self.db.table("prediction_history").insert(payloads).execute()
+                    return True
+                except Exception as e2:
+                    e = e2
+            logger.error(f"Auditoría masiva perdida ({len(payloads)} filas): {e}")
+            return False
+
+    def _insertar_auditoria(self, payload: dict) -> bool:
+        try:
+            self.db.table("prediction_history").insert(payload).execute()
+            return True
         except Exception as e:
             error_msg = str(e)
             if "23503" in error_msg or "foreign key" in error_msg:
                 payload["client_id"] = None
                 try:
-                    response = self.db.table("prediction_history").insert(payload).execute()
-                    if response.data: return response.data[0]['id']
-                except: pass
-            return f"TEMP-{int(datetime.now().timestamp())}"
+                    self.db.table("prediction_history").insert(payload).execute()
+                    return True
+                except Exception as e2:
+                    error_msg = str(e2)
+            logger.error(f"Auditoría perdida {payload['id']}: {error_msg}")
+            return False
 
     def registrar_ajuste_usuario(self, prediction_id: str, precio_real: float) -> bool:
+        """
+        Guarda el precio de cierre sobre la auditoría. Bloquea hasta que el INSERT en
+        segundo plano termine (o AUDITORIA_TIMEOUT_SEG): si no, el UPDATE no encuentra la fila.
+        """
         try:
             if str(prediction_id).startswith("TEMP-"): return False
+            futuro = self._auditorias.get(prediction_id)
+            if futuro is not None and not futuro.result(timeout=AUDITORIA_TIMEOUT_SEG):
+                return False   # El INSERT falló: no hay fila que corregir
             payload = {
                 "user_correction": {
                     "precio_cierre": precio_real,
                     "fecha_ajuste": datetime.utcnow().isoformat()
                 }
             }
-            self.db.table("prediction_history").update(payload).eq("id", prediction_id).execute()
+            res = self.db.table("prediction_history").update(payload).eq("id", prediction_id).execute()
+            if not res.data:
+                logger.warning(f"Ajuste sin fila: la auditoría {prediction_id} no existe.")
+                return False
             return True
         except Exception as e:
-            logger.error(f"Error ajuste: {e}")
+            logger.error(f"Error ajuste {prediction_id}: {e!r}")
             return False
 
     def crear_orden_confirmada(self, datos_orden: dict) -> str:
+        """Orden de una sola línea (se mantiene para los flujos de siempre)."""
+        return self.crear_orden_multilinea([datos_orden])
+
+    def crear_orden_multilinea(self, lineas: list) -> str:
+        """
+        Cabecera + N líneas en un solo viaje (RPC fn_crear_orden, sql/003): todo o nada.
+        Los totales de la cabecera salen de las líneas. Retorna el PO o None.
+        """
+        if not lineas:
+            return None
         try:
             po_number = f"P{int(datetime.now().timestamp())}"
-            
-            cabecera = {
-                "po_number": po_number,
-                "vendor": datos_orden.get("vendor", "BM"),
-                "ship_date": datetime.now().strftime("%Y-%m-%d"),
-                "origin": "BOG",
-                "status": "Confirmed",
-                "source_file": "Bot_Telegram_V2_Smart",
-                "total_boxes": int(datos_orden["cajas"]),
-                "total_value": float(datos_orden["valor_total_pedido"])
-            }
+            cabecera = self._armar_cabecera(po_number, lineas)
+            items = [self._armar_item(None, d) for d in lineas]
 
-            res_head = self.db.table("sales_orders").insert(cabecera).execute()
-            
-            if not res_head.data:
-                logger.error("Fallo al crear cabecera sales_orders")
+            order_uuid = None
+            if self._rpc_orden:
+                try:
+                    res = self.db.rpc("fn_crear_orden", {
+                        "p_cabecera": cabecera,
+                        "p_items": [{k: v for k, v in it.items() if k != "order_id"} for it in items]
+                    }).execute()
+                    order_uuid = (res.data or {}).get("id")
+                except Exception as e:
+                    if "fn_crear_orden" in str(e) or "PGRST202" in str(e):
+                        logger.warning("RPC fn_crear_orden no instalada. Usando inserciones con compensación.")
+                        self._rpc_orden = False
+                    else:
+                        raise
+
+            if not self._rpc_orden:
+                order_uuid = self._crear_orden_compensada(cabecera, items)
+
+            if not order_uuid:
+                logger.error("Fallo al crear la orden (sin id de cabecera)")
                 return None
-            
-            order_uuid = res_head.data[0]['id']
-
-            item = {
-                "order_id": order_uuid,
-                "customer_code": datos_orden["cliente_nombre"], 
-                "product_name": datos_orden["producto_descripcion"],
-                "box_type": datos_orden["tipo_caja"],
-                "boxes": int(datos_orden["cajas"]),
-                "total_units": int(datos_orden["total_tallos"]),
-                "unit_price": float(datos_orden["precio_unitario"]),
-                "total_line_value": float(datos_orden["valor_total_pedido"]),
-                "notes": "Generado vía Bot",
-                "mark_code": datos_orden.get("marcacion", "")
-            }
 
-            self.db.table("sales_items").insert(item).execute()
-            
-            logger.info(f"✅ Orden Relacional Creada: {po_number}")
+            for it in items:
+                it["order_id"] = order_uuid
+            emitir(ORDENES_REGISTRADAS, ordenes=[self._evento_orden(order_uuid, cabecera, it) for it in items])
+            emitir(IDENTIFICADORES_REGISTRADOS, pares=[("po", po_number, po_number)])
+
+            logger.info(f"✅ Orden Relacional Creada: {po_number} ({len(items)} líneas)")
             return po_number
 
         except Exception as e:
-            print(f"🔴 ERROR DB: {e}")
             logger.error(f"Error fatal creando Orden Relacional: {e}")
             return None
+
+    def _crear_orden_compensada(self, cabecera: dict, items: list):
+        """Sin la función SQL: cabecera, items en bloque y, si fallan, se borra la cabecera."""
+        res_head = self.db.table("sales_orders").insert(cabecera).execute()
+        if not res_head.data:
+            return None
+        order_uuid = res_head.data[0]['id']
+        try:
+            self.db.table("sales_items").insert([{**it, "order_id": order_uuid} for it in items]).execute()
+        except Exception:
+            self.db.table("sales_orders").delete().eq("id", order_uuid).execute()
+            raise
+        return order_uuid
+
+    def crear_ordenes_lote(self, lista_datos: list) -> list:
+        """
+        Materializa muchas órdenes con dos requests: todas las cabeceras y luego todos los items.
+        Si los items fallan, se borran las cabeceras recién creadas (sin huérfanas).
+        Retorna la lista de POs (o None por orden) en el mismo orden recibido.
+        """
+        if not lista_datos:
+            return []
+        try:
+            base = int(datetime.now().timestamp())
+            pos = [f"P{base}-{i + 1}" for i in range(len(lista_datos))]
+            cabeceras = [self._armar_cabecera(po, [d]) for po, d in zip(pos, lista_datos)]
+
+            res_head = self.db.table("sales_orders").insert(cabeceras).execute()
+            ids_por_po = {r['po_number']: r['id'] for r in (res_head.data or [])}
+            if len(ids_por_po) != len(pos):
+                logger.error("Fallo al crear cabeceras sales_orders en lote")
+                if ids_por_po:
+                    self.db.table("sales_orders").delete().in_("id", list(ids_por_po.values())).execute()
+                return [None] * len(pos)
+
+            items = [self._armar_item(ids_por_po[po], d) for po, d in zip(pos, lista_datos)]
+            try:
+                self.db.table("sales_items").insert(items).execute()
+            except Exception:
+                self.db.table("sales_orders").delete().in_("id", list(ids_por_po.values())).execute()
+                raise
+
+            emitir(ORDENES_REGISTRADAS, ordenes=[
+                self._evento_orden(it["order_id"], cab, it) for cab, it in zip(cabeceras, items)
+            ])
+            emitir(IDENTIFICADORES_REGISTRADOS, pares=[("po", po, po) for po in pos])
+            logger.info(f"✅ {len(pos)} Órdenes Relacionales Creadas en lote")
+            return pos
+
+        except Exception as e:
+            logger.error(f"Error fatal creando órdenes en lote: {e}")
+            return [None] * len(lista_datos)
+
+    def _evento_orden(self, order_uuid: str, cabecera: dict, item: dict) -> dict:
+        return {
+            "order_id": order_uuid,
+            "po_number": cabecera["po_number"],
+            "customer_code": item["customer_code"],
+            "fecha": cabecera["ship_date"],
+            "valor": item["total_line_value"],
+            "nombre": item["product_name"],
+            "precio": item["unit_price"],
+        }
+
+    def _armar_cabecera(self, po_number: str, lineas: list) -> dict:
+        return {
+            "po_number": po_number,
+            "vendor": lineas[0].get("vendor", "BM"),
+            "ship_date": datetime.now().strftime("%Y-%m-%d"),
+            "origin": "BOG",
+            "status": "Confirmed",
+            "source_file": "Bot_Telegram_V2_Smart",
+            "total_boxes": sum(int(d["cajas"]) for d in lineas),
+            "total_value": round(sum(float(d["valor_total_pedido"]) for d in lineas), 2)
+        }
+
+    def _armar_item(self, order_uuid: str, datos_orden: dict) -> dict:
+        return {
+            "order_id": order_uuid,
+            "customer_code": datos_orden["cliente_nombre"], 
+            "product_name": datos_orden["producto_descripcion"],
+            "box_type": datos_orden["tipo_caja"],
+            "boxes": int(datos_orden["cajas"]),
+            "total_units": int(datos_orden["total_tallos"]),
+            "unit_price": float(datos_orden["precio_unitario"]),
+            "total_line_value": float(datos_orden["valor_total_pedido"]),
+            "notes": "Generado vía Bot",
+            "mark_code": datos_orden.get("marcacion", "")
+        }
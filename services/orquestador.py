@@ -1,5 +1,12 @@
+import os
+import html
 from services.cliente_supabase import db_client, logger
-from datetime import datetime
+from services.cache_ttl import CacheTTL
+from services.eventos import suscribir, FACTURAS_EMITIDAS, ORDENES_REGISTRADAS
+
+CLIENTES_POR_PAGINA = 10
+MAX_POS_LOTE = int(os.getenv("MAX_POS_LOTE", "300"))
+PENDIENTES_TTL_SEG = float(os.getenv("PENDIENTES_TTL_SEG", "60"))
 
 class OrquestadorPedidos:
     """
@@ -7,55 +14,132 @@ class OrquestadorPedidos:
     Coordina: Ingesta -> Edición -> Facturación -> Despacho.
     """
 
-    def obtener_resumen_pendientes(self):
+    def __init__(self):
+        self._cache = CacheTTL(ttl_segundos=PENDIENTES_TTL_SEG, max_items=50)  # pagina -> {"filas", "total"}
+        self._vista = True
+        # Facturar u ordenar cambia el tablero: se olvida todo y la próxima consulta va a la DB
+        suscribir(FACTURAS_EMITIDAS, self._invalidar)
+        suscribir(ORDENES_REGISTRADAS, self._invalidar)
+
+    def _invalidar(self, **_):
+        self._cache.invalidar()
+
+    def _leer_vista(self, pagina: int) -> dict:
+        inicio = pagina * CLIENTES_POR_PAGINA
+        res = db_client.table("v_pendientes_factura")\
+            .select("*", count="exact")\
+            .order("total_valor", desc=True)\
+            .order("customer_name")\
+            .range(inicio, inicio + CLIENTES_POR_PAGINA - 1)\
+            .execute()
+        return {"filas": res.data or [], "total": res.count or 0}
+
+    def _leer_agrupando(self, pagina: int) -> dict:
+        """Sin la vista (sql/006): solo las columnas que suman, sin sales_items."""
+        res = db_client.table("sales_orders")\
+            .select("customer_name, total_boxes, total_value")\
+            .eq("status", "Confirmed")\
+            .is_("invoice_id", "null")\
+            .execute()
+        grupos = {}
+        for o in res.data or []:
+            g = grupos.setdefault(o.get('customer_name') or 'Varios', [0, 0, 0.0])
+            g[0] += 1
+            g[1] += o.get('total_boxes') or 0
+            g[2] += float(o.get('total_value') or 0)
+        filas = sorted(
+            ({"customer_name": c, "pos_pendientes": n, "total_cajas": cajas, "total_valor": valor}
+             for c, (n, cajas, valor) in grupos.items()),
+            key=lambda f: (-f["total_valor"], f["customer_name"])
+        )
+        inicio = pagina * CLIENTES_POR_PAGINA
+        return {"filas": filas[inicio:inicio + CLIENTES_POR_PAGINA], "total": len(filas)}
+
+    def pendientes_por_cliente(self, pagina: int = 0) -> dict:
+        """{"filas": [{customer_name, pos_pendientes, total_cajas, total_valor}], "total": n_clientes}"""
+        def calcular():
+            if self._vista:
+                try:
+                    return self._leer_vista(pagina)
+                except Exception as e:
+                    if "v_pendientes_factura" not in str(e) and "PGRST205" not in str(e) and "42P01" not in str(e):
+                        raise
+                    logger.warning("⚠️ Vista v_pendientes_factura no instalada (sql/006); agrupando en Python.")
+                    self._vista = False
+            return self._leer_agrupando(pagina)
+
+        return self._cache.obtener_o_calcular(pagina, calcular)
+
+    def ordenes_pendientes(self, cliente: str = None, desde: str = None, hasta: str = None):
+        """
+        Filas de sales_orders Confirmed y sin factura para facturar en lote (/facturar).
+        cliente: nombre tal como sale en /pendientes ('_' vale por espacio) o customer_code de sus items.
+                 'Varios' son las órdenes sin nombre de cliente (así las agrupa /pendientes).
+        desde/hasta: 'YYYY-MM-DD' sobre ship_date (inclusive).
+        Retorna (ordenes, total): como mucho MAX_POS_LOTE órdenes y cuántas cumplen el filtro en total.
+        """
+        query = db_client.table("sales_orders").select("*", count="exact")\
+            .eq("status", "Confirmed")\
+            .is_("invoice_id", "null")
+
+        if cliente:
+            # En ILIKE '_' es comodín de un carácter: 'FLORES_MIA' encuentra 'Flores Mia'
+            cliente = cliente.replace('"', '')
+            condiciones = [f'customer_name.ilike."{cliente}"']
+            if cliente.lower() == "varios":
+                # NULL o '' nunca cumplen un ILIKE
+                condiciones += ["customer_name.is.null", "customer_name.eq."]
+            por_codigo = db_client.table("sales_items").select("order_id")\
+                .eq("customer_code", cliente.upper())\
+                .limit(MAX_POS_LOTE * 20)\
+                .execute().data or []
+            ids = sorted({str(i['order_id']) for i in por_codigo})[:MAX_POS_LOTE]
+            if ids:
+                condiciones.append(f"id.in.({','.join(ids)})")
+            query = query.or_(",".join(condiciones))
+        if desde:
+            query = query.gte("ship_date", desde)
+        if hasta:
+            query = query.lte("ship_date", hasta)
+
+        res = query.order("ship_date").order("po_number").limit(MAX_POS_LOTE).execute()
+        ordenes = res.data or []
+        return ordenes, max(res.count or 0, len(ordenes))
+
+    def obtener_resumen_pendientes(self, pagina: int = 0):
         """
         Analiza 'sales_orders' que están en estado 'Confirmed' pero SIN Factura.
         Equivalente a mirar la hoja ORDENAA y ver qué falta procesar.
+        Retorna (texto, botones_data, total_paginas).
         """
         try:
-            # Buscamos órdenes confirmadas que no tienen ID de factura (is null)
-            # Nota: Supabase filter 'is' se usa como .is_('column', 'null')
-            res = db_client.table("sales_orders")\
-                .select("*, sales_items(*)")\
-                .eq("status", "Confirmed")\
-                .is_("invoice_id", "null")\
-                .execute()
-            
-            ordenes = res.data or []
-            
-            if not ordenes:
-                return "✅ Todo está al día. No hay órdenes pendientes de facturar.", []
-
-            # Agrupamos por Cliente para mostrar bonito
-            resumen_texto = "📊 **Tablero de Control (Pendientes)**\n\n"
-            grupos_cliente = {}
-            
-            for orden in ordenes:
-                cliente = orden.get('customer_name', 'Varios')
-                if cliente not in grupos_cliente: grupos_cliente[cliente] = []
-                grupos_cliente[cliente].append(orden)
+            datos = self.pendientes_por_cliente(pagina)
 
+            if not datos["total"]:
+                return "✅ Todo está al día. No hay órdenes pendientes de facturar.", [], 0
+
+            total_paginas = -(-datos["total"] // CLIENTES_POR_PAGINA)
+            resumen_texto = f"📊 <b>Tablero de Control (Pendientes)</b> — {datos['total']} clientes\n\n"
             botones_data = []
 
-            for cliente, lista_ordenes in grupos_cliente.items():
-                total_cajas = sum(o['total_boxes'] for o in lista_ordenes)
-                total_plata = sum(o['total_value'] for o in lista_ordenes)
-                cant_pos = len(lista_ordenes)
-                
+            for fila in datos["filas"]:
+                cliente = fila['customer_name']
+                cant_pos = fila['pos_pendientes']
+
                 resumen_texto += (
-                    f"👤 <b>{cliente}</b>\n"
-                    f"   📦 {cant_pos} POs pendientes ({total_cajas} cajas)\n"
-                    f"   💰 Valor Aprox: ${total_plata:,.2f}\n"
-                    f"   <i>/facturar_{cliente.replace(' ', '_')}</i>\n\n"
+                    f"👤 <b>{html.escape(cliente)}</b>\n"
+                    f"   📦 {cant_pos} POs pendientes ({fila['total_cajas']} cajas)\n"
+                    f"   💰 Valor Aprox: ${float(fila['total_valor']):,.2f}\n"
+                    f"   <i>/facturar_{html.escape(cliente.replace(' ', '_'))}</i>\n\n"
                 )
-                
+
                 # Guardamos datos para generar botones después
                 botones_data.append({"cliente": cliente, "cantidad": cant_pos})
 
-            return resumen_texto, botones_data
+            return resumen_texto, botones_data, total_paginas
 
         except Exception as e:
             logger.error(f"Error orquestador: {e}")
-            return f"💥 Error consultando pendientes: {e}", []
+            return f"💥 Error consultando pendientes: {html.escape(str(e))}", [], 0
 
 orquestador = OrquestadorPedidos()
@@ -0,0 +1,289 @@
+import logging
+import threading
+from datetime import date
+import numpy as np
+from services.cliente_supabase import db_client
+from services.eventos import suscribir, ORDENES_REGISTRADAS
+from services.motor_rfm import _a_dia
+
+logger = logging.getLogger(__name__)
+
+TAMANO_PAGINA = 1000
+SEMANAS = 53
+FACTOR_SEMANA_MIN, FACTOR_SEMANA_MAX = 0.8, 1.2   # La estacionalidad ajusta, no inventa precios
+
+
+def _semana(dias: np.ndarray) -> np.ndarray:
+    """Días desde 1970 -> semana del año 0..52 (vectorizado)."""
+    fechas = dias.astype("datetime64[D]")
+    dia_del_anio = (fechas - fechas.astype("datetime64[Y]")).astype(np.int64)
+    return np.minimum(dia_del_anio // 7, SEMANAS - 1)
+
+
+def _clave_producto(codigo, nombre) -> str:
+    """El código de producto manda; las órdenes del bot solo traen nombre."""
+    codigo = str(codigo or "").strip().upper()
+    if codigo and codigo != "NAN":
+        return codigo
+    return " ".join(str(nombre or "").upper().split())
+
+
+def _precio(fila: dict) -> float:
+    return float(fila.get("unit_price") or fila.get("sales_price") or 0.0)
+
+
+class AlmacenPrecios:
+    """
+    La Libreta de Precios.
+    Por cada par cliente×producto guarda: último precio, mediana, tendencia (USD/mes)
+    y un factor de estacionalidad por semana del año. Se calcula en bloque con NumPy
+    al arrancar y luego solo se recalculan los pares que tocan las órdenes nuevas.
+    Consultar un precio es un lookup de diccionario + una celda de matriz: O(1).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.listo = False
+        self._indice = {}          # (cliente, producto) -> slot
+        self._pares = []           # slot -> (cliente, producto)
+        self._nombres = []         # slot -> último product_name visto
+        self._obs = []             # slot -> [(order_id, dia, precio)]
+        self._ordenes = {}         # order_id -> {slots}
+        self._por_cliente = {}     # cliente -> [slots]
+        self._favorito = {}        # cliente -> slot más comprado
+        self._ultimo = np.zeros(0, dtype=np.float64)
+        self._ultimo_dia = np.zeros(0, dtype=np.int64)
+        self._mediana = np.zeros(0, dtype=np.float64)
+        self._tendencia = np.zeros(0, dtype=np.float64)
+        self._conteo = np.zeros(0, dtype=np.int64)
+        self._estacional = np.ones((0, SEMANAS), dtype=np.float32)
+        suscribir(ORDENES_REGISTRADAS, self._al_registrar_ordenes)
+
+    # --- CARGA INICIAL ---
+    def cargar(self):
+        """Lee sales_items (+ fecha de su orden) paginado y calcula todo el almacén."""
+        filas = []
+        inicio = 0
+        while True:
+            res = db_client.table("sales_items")\
+                .select("order_id, customer_code, product_code, product_name, unit_price, sales_price, sales_orders(ship_date)")\
+                .range(inicio, inicio + TAMANO_PAGINA - 1)\
+                .execute()
+            pagina = res.data or []
+            filas.extend(pagina)
+            if len(pagina) < TAMANO_PAGINA:
+                break
+            inicio += TAMANO_PAGINA
+
+        obs = [
+            (
+                str(f.get("customer_code") or "").strip(),
+                _clave_producto(f.get("product_code"), f.get("product_name")),
+                str(f.get("product_name") or "").strip(),
+                str(f.get("order_id")),
+                _a_dia((f.get("sales_orders") or {}).get("ship_date")),
+                _precio(f),
+            )
+            for f in filas
+        ]
+        self._construir([o for o in obs if o[0] and o[1] and o[4] >= 0 and o[5] > 0])
+        logger.info(f"💲 Almacén de precios cargado: {len(self._pares)} pares cliente×producto.")
+
+    def _construir(self, obs: list):
+        pares, slot = np.unique(
+            np.array([f"{o[0]}\x1f{o[1]}" for o in obs], dtype=object), return_inverse=True
+        )
+        n = len(pares)
+        dias = np.array([o[4] for o in obs], dtype=np.int64)
+        precios = np.array([o[5] for o in obs], dtype=np.float64)
+
+        conteo = np.bincount(slot, minlength=n).astype(np.int64)
+        inicio = np.concatenate(([0], np.cumsum(conteo)[:-1])).astype(np.int64)
+        fin = inicio + conteo - 1
+
+        # Último precio: orden por (slot, día) y tomamos el final de cada grupo
+        por_dia = np.lexsort((dias, slot))
+        ultimo = precios[por_dia][fin] if n else np.zeros(0)
+        ultimo_dia = dias[por_dia][fin] if n else np.zeros(0, dtype=np.int64)
+
+        # Mediana: orden por (slot, precio) y promediamos los dos centrales
+        por_precio = np.lexsort((precios, slot))
+        p = precios[por_precio]
+        mediana = (p[inicio + (conteo - 1) // 2] + p[inicio + conteo // 2]) / 2 if n else np.zeros(0)
+
+        tendencia = self._pendientes(slot, dias, precios, n)
+        estacional = self._estacionalidad(slot, dias, precios, n)
+
+        # Observaciones crudas por par (para recalcular solo lo que cambie)
+        nombres = [""] * n
+        por_slot = [[] for _ in range(n)]
+        ordenes = {}
+        for s_, o in zip(slot.tolist(), obs):
+            por_slot[s_].append((o[3], o[4], o[5]))
+            ordenes.setdefault(o[3], set()).add(s_)
+            if o[2]:
+                nombres[s_] = o[2]
+
+        with self._lock:
+            self._pares = [tuple(k.split("\x1f", 1)) for k in pares]
+            self._indice = {par: i for i, par in enumerate(self._pares)}
+            self._nombres = nombres
+            self._obs = por_slot
+            self._ordenes = ordenes
+            self._ultimo, self._ultimo_dia, self._mediana = ultimo, ultimo_dia, mediana
+            self._tendencia, self._conteo, self._estacional = tendencia, conteo, estacional
+            self._por_cliente = {}
+            for s_, (cliente, _) in enumerate(self._pares):
+                self._por_cliente.setdefault(cliente, []).append(s_)
+            self._favorito = {}
+            for cliente in self._por_cliente:
+                self._actualizar_favorito(cliente)
+            self.listo = True
+
+    @staticmethod
+    def _pendientes(slot, dias, precios, n) -> np.ndarray:
+        """Mínimos cuadrados por grupo con sumas de bincount: USD por cada 30 días."""
+        x = dias.astype(np.float64)
+        k = np.bincount(slot, minlength=n)
+        sx = np.bincount(slot, weights=x, minlength=n)
+        sy = np.bincount(slot, weights=precios, minlength=n)
+        sxx = np.bincount(slot, weights=x * x, minlength=n)
+        sxy = np.bincount(slot, weights=x * precios, minlength=n)
+        denominador = k * sxx - sx * sx
+        with np.errstate(divide="ignore", invalid="ignore"):
+            pendiente = np.where(denominador > 0, (k * sxy - sx * sy) / denominador, 0.0)
+        return pendiente * 30
+
+    @staticmethod
+    def _estacionalidad(slot, dias, precios, n) -> np.ndarray:
+        """Matriz par×semana con precio_semana / precio_promedio (1.0 donde no hay datos)."""
+        celda = slot * SEMANAS + _semana(dias)
+        suma = np.bincount(celda, weights=precios, minlength=n * SEMANAS).reshape(n, SEMANAS)
+        cuenta = np.bincount(celda, minlength=n * SEMANAS).reshape(n, SEMANAS)
+        promedio = suma.sum(axis=1) / np.maximum(cuenta.sum(axis=1), 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            factor = (suma / cuenta) / promedio[:, None]
+        factor = np.where(cuenta > 0, factor, 1.0)
+        return np.clip(factor, FACTOR_SEMANA_MIN, FACTOR_SEMANA_MAX).astype(np.float32)
+
+    # --- ACTUALIZACIÓN INCREMENTAL ---
+    def _slot(self, cliente: str, producto: str) -> int:
+        slot = self._indice.get((cliente, producto))
+        if slot is None:
+            slot = len(self._pares)
+            self._pares.append((cliente, producto))
+            self._indice[(cliente, producto)] = slot
+            self._por_cliente.setdefault(cliente, []).append(slot)
+            self._nombres.append("")
+            self._obs.append([])
+            self._ultimo = np.append(self._ultimo, 0.0)
+            self._ultimo_dia = np.append(self._ultimo_dia, -1)
+            self._mediana = np.append(self._mediana, 0.0)
+            self._tendencia = np.append(self._tendencia, 0.0)
+            self._conteo = np.append(self._conteo, 0)
+            self._estacional = np.vstack([self._estacional, np.ones((1, SEMANAS), dtype=np.float32)])
+        return slot
+
+    def _recalcular(self, slot: int):
+        obs = self._obs[slot]
+        self._conteo[slot] = len(obs)
+        if not obs:
+            self._ultimo[slot] = self._mediana[slot] = self._tendencia[slot] = 0.0
+            self._ultimo_dia[slot] = -1
+            self._estacional[slot] = 1.0
+            return
+        dias = np.array([d for _, d, _ in obs], dtype=np.int64)
+        precios = np.array([p for _, _, p in obs], dtype=np.float64)
+        cero = np.zeros(len(obs), dtype=np.int64)
+        ultimo = int(np.lexsort((dias,))[-1])
+        self._ultimo[slot] = precios[ultimo]
+        self._ultimo_dia[slot] = dias[ultimo]
+        self._mediana[slot] = float(np.median(precios))
+        self._tendencia[slot] = self._pendientes(cero, dias, precios, 1)[0]
+        self._estacional[slot] = self._estacionalidad(cero, dias, precios, 1)[0]
+
+    def _actualizar_favorito(self, cliente: str):
+        """Favorito del cliente = par con más líneas (empate: compra más reciente)."""
+        vivos = [s for s in self._por_cliente.get(cliente, ()) if self._conteo[s] > 0]
+        if vivos:
+            self._favorito[cliente] = max(vivos, key=lambda s: (self._conteo[s], self._ultimo_dia[s]))
+        else:
+            self._favorito.pop(cliente, None)
+
+    def registrar_ordenes(self, ordenes: list):
+        """
+        ordenes = [{"order_id", "customer_code", "fecha", "producto", "nombre", "precio"}]
+        Las entradas sin producto o sin precio se ignoran. Re-importar una orden reemplaza sus líneas.
+        """
+        if not self.listo:
+            return
+        nuevas = {}
+        for o in ordenes:
+            cliente = str(o.get("customer_code") or "").strip()
+            producto = _clave_producto(o.get("producto"), o.get("nombre"))
+            precio = float(o.get("precio") or 0.0)
+            dia = _a_dia(o.get("fecha"))
+            if cliente and producto and precio > 0 and dia >= 0:
+                nuevas.setdefault(str(o["order_id"]), []).append((cliente, producto, str(o.get("nombre") or ""), dia, precio))
+
+        with self._lock:
+            tocados = set()
+            for order_id, lineas in nuevas.items():
+                for slot in self._ordenes.pop(order_id, set()):
+                    self._obs[slot] = [x for x in self._obs[slot] if x[0] != order_id]
+                    tocados.add(slot)
+                slots = set()
+                for cliente, producto, nombre, dia, precio in lineas:
+                    slot = self._slot(cliente, producto)
+                    self._obs[slot].append((order_id, dia, precio))
+                    if nombre:
+                        self._nombres[slot] = nombre
+                    slots.add(slot)
+                self._ordenes[order_id] = slots
+                tocados |= slots
+
+            for slot in tocados:
+                self._recalcular(slot)
+            for cliente in {self._pares[s][0] for s in tocados}:
+                self._actualizar_favorito(cliente)
+
+    def _al_registrar_ordenes(self, ordenes: list, **_):
+        self.registrar_ordenes(ordenes)
+
+    # --- CONSULTAS ---
+    def _ficha(self, slot: int, dia: date = None) -> dict:
+        semana = int(_semana(np.array([_a_dia(dia or date.today())]))[0])
+        factor = float(self._estacional[slot, semana])
+        return {
+            "producto": self._pares[slot][1],
+            "nombre": self._nombres[slot] or self._pares[slot][1],
+            "ultimo": float(self._ultimo[slot]),
+            "mediana": float(self._mediana[slot]),
+            "tendencia_mes": float(self._tendencia[slot]),
+            "factor_semana": factor,
+            "observaciones": int(self._conteo[slot]),
+            # Precio realista: lo último que pagó, corregido por la semana del año
+            "precio_esperado": round(float(self._ultimo[slot]) * factor, 2),
+        }
+
+    def precio(self, cliente: str, producto: str, dia: date = None):
+        """Ficha de precio del par cliente×producto (None si no hay historial)."""
+        if not self.listo:
+            return None
+        slot = self._indice.get((str(cliente or "").strip(), _clave_producto(producto, producto)))
+        if slot is None or self._conteo[slot] == 0:
+            return None
+        return self._ficha(slot, dia)
+
+    def favorito(self, cliente: str, dia: date = None):
+        """Ficha del producto que más compra el cliente (None si no hay historial)."""
+        if not self.listo:
+            return None
+        slot = self._favorito.get(str(cliente or "").strip())
+        if slot is None:
+            return None
+        return self._ficha(slot, dia)
+
+
+# Instancia singleton: se carga al arrancar el bot (main.py)
+almacen_precios = AlmacenPrecios()
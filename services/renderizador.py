@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+# Cuántos mensajes recordamos antes de olvidar el más viejo
+MAX_MENSAJES_RECORDADOS = 2000
+
+
+class RenderizadorMensajes:
+    """
+    La Memoria Visual.
+    Recuerda la huella (hash) de lo último que se pintó en cada mensaje (chat, message_id)
+    y se niega a llamar a Telegram cuando la nueva pintura es idéntica a la anterior.
+    Ahorra llamadas, evita el "message is not modified" y nos aleja del flood limit.
+    """
+
+    def __init__(self, max_mensajes: int = MAX_MENSAJES_RECORDADOS):
+        self.max_mensajes = max_mensajes
+        self._huellas = OrderedDict()
+        self._respondidas = OrderedDict()
+        self.enviadas = 0
+        self.omitidas = 0
+
+    # --- HUELLAS ---
+    def _huella(self, texto: str, reply_markup=None, parse_mode=None) -> str:
+        teclado = reply_markup.to_dict() if reply_markup is not None else None
+        crudo = json.dumps([texto, teclado, parse_mode], sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(crudo.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _clave(self, mensaje):
+        return (mensaje.chat.id, mensaje.message_id)
+
+    def _recordar(self, clave, huella: str):
+        self._huellas[clave] = huella
+        self._huellas.move_to_end(clave)
+        while len(self._huellas) > self.max_mensajes:
+            self._huellas.popitem(last=False)
+
+    def olvidar(self, chat_id: int, message_id: int):
+        """Fuerza que la próxima edición de ese mensaje sí viaje a Telegram."""
+        self._huellas.pop((chat_id, message_id), None)
+
+    # --- CALLBACKS ---
+    async def responder(self, query, texto: str = None, show_alert: bool = False):
+        """Contesta el callback una sola vez (Telegram no admite dos respuestas)."""
+        if query.id in self._respondidas:
+            return
+        self._respondidas[query.id] = True
+        while len(self._respondidas) > self.max_mensajes:
+            self._respondidas.popitem(last=False)
+        try:
+            await query.answer(texto, show_alert=show_alert)
+        except BadRequest as e:
+            logger.warning(f"Callback ya expirado: {e}")
+
+    # --- PINTURA ---
+    async def enviar(self, message, texto: str, reply_markup=None, parse_mode=None):
+        """reply_text que deja registrada la huella del mensaje nuevo."""
+        nuevo = await message.reply_text(texto, reply_markup=reply_markup, parse_mode=parse_mode)
+        self._recordar(self._clave(nuevo), self._huella(texto, reply_markup, parse_mode))
+        return nuevo
+
+    async def editar(self, query, texto: str, reply_markup=None, parse_mode=None) -> bool:
+        """
+        edit_message_text con memoria.
+        Retorna True si se envió la edición, False si se omitió por ser idéntica.
+        """
+        clave = self._clave(query.message) if query.message else ("inline", query.inline_message_id)
+        enviado = await self._editar_si_cambia(
+            clave, query.edit_message_text, texto, reply_markup=reply_markup, parse_mode=parse_mode
+        )
+        if not enviado:
+            await self.responder(query, "🟰 Sin cambios")
+        return enviado
+
+    async def editar_mensaje(self, bot, chat_id: int, message_id: int, texto: str, reply_markup=None, parse_mode=None) -> bool:
+        """Igual que editar() pero sin callback de por medio (jobs, notificaciones)."""
+        async def _enviar(t, **kwargs):
+            return await bot.edit_message_text(t, chat_id=chat_id, message_id=message_id, **kwargs)
+        return await self._editar_si_cambia(
+            (chat_id, message_id), _enviar, texto, reply_markup=reply_markup, parse_mode=parse_mode
+        )
+
+    async def _editar_si_cambia(self, clave, enviar, texto: str, reply_markup=None, parse_mode=None) -> bool:
+        huella = self._huella(texto, reply_markup, parse_mode)
+
+        if self._huellas.get(clave) == huella:
+            self.omitidas += 1
+            return False
+
+        try:
+            await enviar(texto, reply_markup=reply_markup, parse_mode=parse_mode)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+            # Telegram ya tenía esa pintura (p.ej. tras un reinicio del bot)
+            self._recordar(clave, huella)
+            self.omitidas += 1
+            return False
+
+        self._recordar(clave, huella)
+        self.enviadas += 1
+        return True
+
+    def metricas(self) -> dict:
+        total = self.enviadas + self.omitidas
+        return {
+            "enviadas": self.enviadas,
+            "omitidas": self.omitidas,
+            "ahorro_pct": (self.omitidas / total * 100) if total else 0.0,
+            "mensajes_en_memoria": len(self._huellas),
+        }
+
+
+# Instancia singleton compartida por panel y pedidos
+renderizador = RenderizadorMensajes()
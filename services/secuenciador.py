@@ -1,12 +1,32 @@
+import os
+import threading
 from datetime import datetime
 from services.cliente_supabase import db_client, logger
 
+# Cuántos números se reservan por viaje a la DB. Un reinicio del bot deja huecos
+# (los números no usados del bloque), nunca duplicados.
+BLOQUE_SECUENCIA = int(os.getenv("SECUENCIA_BLOQUE", "20"))
+BLOQUE_INVOICE = int(os.getenv("SECUENCIA_BLOQUE_INVOICE", str(BLOQUE_SECUENCIA)))
+INTENTOS_CAS = 5
+
+
+class ErrorSecuencia(Exception):
+    """No se pudo reservar un consecutivo: mejor fallar que repetir un número."""
+
+
 class Secuenciador:
     """
     El Contador Oficial.
     Reemplaza la hoja 'INDICES'. Genera consecutivos únicos para Facturas y POs.
+    Reserva bloques (hi/lo) con un incremento atómico en la DB (fn_reservar_secuencia)
+    y reparte los números del bloque desde memoria.
     """
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bloques = {}        # tipo -> [siguiente, fin]
+        self._rpc_reservar = True
+
     def obtener_siguiente_invoice(self) -> str:
         """
         Genera: AÑOMESDIA / CONSECUTIVO (Ej: 251126/1051)
@@ -19,33 +39,67 @@ class Secuenciador:
         """
         Genera: FINCA + FECHA / CONSECUTIVO (Ej: TUC251126/0901)
         """
-        clave = f"PO_{finca_code.upper()}"
+        finca_code = (finca_code or "GEN").strip().upper() or "GEN"
+        clave = f"PO_{finca_code}"
         consec = self._incrementar(clave)
         fecha_str = datetime.now().strftime("%y%m%d")
-        
+
         # Formato con ceros a la izquierda (0901)
         consec_fmt = str(consec).zfill(4)
-        return f"{finca_code.upper()}{fecha_str}/{consec_fmt}"
+        return f"{finca_code}{fecha_str}/{consec_fmt}"
 
     def _incrementar(self, tipo: str) -> int:
-        try:
-            # 1. Obtener valor actual
+        """Siguiente número del bloque en memoria; si se agotó, reserva otro. Lanza ErrorSecuencia."""
+        with self._lock:
+            bloque = self._bloques.get(tipo)
+            if not bloque or bloque[0] > bloque[1]:
+                cantidad = BLOQUE_INVOICE if tipo == 'INVOICE' else BLOQUE_SECUENCIA
+                try:
+                    fin = self._reservar_bloque(tipo, cantidad)
+                except Exception as e:
+                    logger.error(f"Error secuencia {tipo}: {e}")
+                    raise ErrorSecuencia(f"No se pudo reservar la secuencia {tipo}") from e
+                bloque = self._bloques[tipo] = [fin - cantidad + 1, fin]
+            valor = bloque[0]
+            bloque[0] += 1
+            return valor
+
+    def _reservar_bloque(self, tipo: str, cantidad: int) -> int:
+        """Último número del bloque reservado [fin - cantidad + 1, fin]."""
+        if self._rpc_reservar:
+            try:
+                res = db_client.rpc("fn_reservar_secuencia", {"p_tipo": tipo, "p_cantidad": cantidad}).execute()
+                return int(res.data)
+            except Exception as e:
+                if "fn_reservar_secuencia" not in str(e) and "PGRST202" not in str(e):
+                    raise
+                logger.warning("⚠️ fn_reservar_secuencia no instalada (sql/005); usando compare-and-set.")
+                self._rpc_reservar = False
+        return self._reservar_cas(tipo, cantidad)
+
+    def _reservar_cas(self, tipo: str, cantidad: int) -> int:
+        """
+        Sin la función: UPDATE condicionado al valor leído. Si otro proceso se adelantó,
+        el UPDATE no toca filas y se reintenta con el valor nuevo.
+        """
+        for _ in range(INTENTOS_CAS):
             res = db_client.table("secuencias").select("ultimo_valor").eq("tipo", tipo).execute()
-            
             if not res.data:
-                # Si es una finca nueva, la inicializamos en 1
-                db_client.table("secuencias").insert({"tipo": tipo, "ultimo_valor": 1}).execute()
-                return 1
-            
-            val_actual = res.data[0]['ultimo_valor']
-            nuevo_val = val_actual + 1
-            
-            # 2. Actualizar (+1) atómicamente
-            db_client.table("secuencias").update({"ultimo_valor": nuevo_val}).eq("tipo", tipo).execute()
-            
-            return nuevo_val
-        except Exception as e:
-            logger.error(f"Error secuencia {tipo}: {e}")
-            return 9999 # Fallback de emergencia
+                try:
+                    # Si es una finca nueva, la inicializamos con el bloque completo
+                    db_client.table("secuencias").insert({"tipo": tipo, "ultimo_valor": cantidad}).execute()
+                    return cantidad
+                except Exception:
+                    continue   # Otro proceso la creó primero (llave única): se relee
+
+            actual = int(res.data[0]['ultimo_valor'])
+            fin = actual + cantidad
+            escrito = db_client.table("secuencias")\
+                .update({"ultimo_valor": fin})\
+                .eq("tipo", tipo).eq("ultimo_valor", actual)\
+                .execute()
+            if escrito.data:
+                return fin
+        raise ErrorSecuencia(f"Contención en la secuencia {tipo} tras {INTENTOS_CAS} intentos")
 
 secuenciador = Secuenciador()
@@ -0,0 +1,70 @@
+import logging
+from datetime import datetime, timezone
+from services.supabase_client import supabase
+
+logger = logging.getLogger(__name__)
+
+TABLE_NAME = "staging_komet"
+MAX_FILAS_POR_RONDA = 500
+
+
+class VigiaKomet:
+    """
+    El Centinela de staging_komet.
+    Guarda un cursor (el timestamp más alto visto) y en cada ronda solo pregunta
+    por los ids que se movieron después de él. Proyección mínima: id + fechas.
+    """
+
+    def __init__(self):
+        self.cursor = None
+        self.usa_updated_at = True  # Si la columna no existe (sin migración 001) caemos a created_at
+
+    def _inicializar_cursor(self):
+        # Arrancamos desde el dato más reciente del servidor (evita desfases de reloj)
+        columna = "updated_at" if self.usa_updated_at else "created_at"
+        try:
+            res = supabase.table(TABLE_NAME).select(columna).order(columna, desc=True).limit(1).execute()
+        except Exception as e:
+            if self.usa_updated_at and "updated_at" in str(e):
+                logger.warning("staging_komet sin updated_at: el vigía solo verá filas nuevas.")
+                self.usa_updated_at = False
+                return self._inicializar_cursor()
+            raise
+        self.cursor = res.data[0][columna] if res.data else datetime.now(timezone.utc).isoformat()
+
+    def revisar(self):
+        """
+        Retorna (ids_nuevos, ids_modificados) desde la última ronda y avanza el cursor.
+        """
+        if self.cursor is None:
+            self._inicializar_cursor()
+            return [], []
+
+        if self.usa_updated_at:
+            query = supabase.table(TABLE_NAME)\
+                .select("id, created_at, updated_at")\
+                .or_(f"created_at.gt.{self.cursor},updated_at.gt.{self.cursor}")\
+                .order("updated_at")
+        else:
+            query = supabase.table(TABLE_NAME)\
+                .select("id, created_at")\
+                .gt("created_at", self.cursor)\
+                .order("created_at")
+
+        filas = query.limit(MAX_FILAS_POR_RONDA).execute().data or []
+
+        nuevos, modificados = [], []
+        for f in filas:
+            if (f.get("created_at") or "") > self.cursor:
+                nuevos.append(f["id"])
+            else:
+                modificados.append(f["id"])
+            marca = max(f.get("created_at") or "", f.get("updated_at") or "")
+            if marca > self.cursor:
+                self.cursor = marca
+
+        return nuevos, modificados
+
+
+# Instancia singleton (un solo cursor para todo el bot)
+vigia_komet = VigiaKomet()
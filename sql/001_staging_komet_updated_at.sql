@@ -0,0 +1,21 @@
+-- Cursor barato para el vigía del /panel (services/vigia_komet.py).
+-- Cada UPDATE sobre staging_komet deja su marca en updated_at.
+
+ALTER TABLE staging_komet
+    ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now();
+
+CREATE OR REPLACE FUNCTION tocar_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := now();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_staging_komet_updated_at ON staging_komet;
+CREATE TRIGGER trg_staging_komet_updated_at
+    BEFORE UPDATE ON staging_komet
+    FOR EACH ROW EXECUTE FUNCTION tocar_updated_at();
+
+-- El vigía filtra por (created_at > cursor OR updated_at > cursor)
+CREATE INDEX IF NOT EXISTS idx_staging_komet_updated_at ON staging_komet (updated_at);
+CREATE INDEX IF NOT EXISTS idx_staging_komet_created_at ON staging_komet (created_at);
@@ -0,0 +1,35 @@
+-- Contexto completo para /sugerir en un solo viaje (services/motor_ventas.py).
+-- Devuelve: {"cliente": {...}, "rfm": {...}, "reglas": [...]} con las reglas más recientes primero.
+-- p_con_rfm = false salta la vista v_customer_rfm (el join caro): el bot la pide solo
+-- mientras su motor RFM en memoria no está listo; después "rfm" viene null.
+
+-- La versión anterior tenía un solo argumento: se borra para no dejar dos sobrecargas
+DROP FUNCTION IF EXISTS fn_contexto_sugerencia(text);
+
+CREATE OR REPLACE FUNCTION fn_contexto_sugerencia(p_codigo text, p_con_rfm boolean DEFAULT true)
+RETURNS jsonb
+LANGUAGE sql
+STABLE
+AS $$
+    WITH c AS (
+        SELECT id, name, code
+        FROM customers
+        WHERE code = p_codigo OR customer_code = p_codigo
+        LIMIT 1
+    )
+    SELECT jsonb_build_object(
+        'cliente', (SELECT to_jsonb(c) FROM c),
+        'rfm', CASE WHEN p_con_rfm THEN (
+            SELECT to_jsonb(r)
+            FROM v_customer_rfm r
+            JOIN c ON r.customer_id = c.id
+            LIMIT 1
+        ) END,
+        'reglas', COALESCE((
+            SELECT jsonb_agg(to_jsonb(pr) ORDER BY pr.last_updated DESC NULLS LAST)
+            FROM customer_packing_rules pr
+            WHERE pr.customer_code = p_codigo
+               OR pr.customer_code = (SELECT code FROM c)
+        ), '[]'::jsonb)
+    );
+$$;
@@ -0,0 +1,48 @@
+-- Orden multilínea atómica para el bot (services/motor_ventas.py -> crear_orden_multilinea).
+-- Cabecera + N items en una sola transacción: si falla un item, no queda cabecera huérfana.
+-- Los totales de la cabecera se calculan aquí, desde las líneas (el cliente no manda totales).
+-- Devuelve: {"id": uuid, "po_number": text}
+
+CREATE OR REPLACE FUNCTION fn_crear_orden(p_cabecera jsonb, p_items jsonb)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_id uuid;
+    v_po text;
+BEGIN
+    IF p_items IS NULL OR jsonb_array_length(p_items) = 0 THEN
+        RAISE EXCEPTION 'La orden % no tiene líneas', p_cabecera->>'po_number';
+    END IF;
+
+    INSERT INTO sales_orders (po_number, vendor, ship_date, origin, status, source_file, total_boxes, total_value)
+    SELECT
+        p_cabecera->>'po_number',
+        p_cabecera->>'vendor',
+        (p_cabecera->>'ship_date')::date,
+        p_cabecera->>'origin',
+        p_cabecera->>'status',
+        p_cabecera->>'source_file',
+        SUM((i->>'boxes')::int),
+        ROUND(SUM((i->>'total_line_value')::numeric), 2)
+    FROM jsonb_array_elements(p_items) AS i
+    RETURNING id, po_number INTO v_id, v_po;
+
+    INSERT INTO sales_items (order_id, customer_code, product_name, box_type, boxes, total_units,
+                             unit_price, total_line_value, notes, mark_code)
+    SELECT
+        v_id,
+        i->>'customer_code',
+        i->>'product_name',
+        i->>'box_type',
+        (i->>'boxes')::int,
+        (i->>'total_units')::int,
+        (i->>'unit_price')::numeric,
+        (i->>'total_line_value')::numeric,
+        i->>'notes',
+        i->>'mark_code'
+    FROM jsonb_array_elements(p_items) AS i;
+
+    RETURN jsonb_build_object('id', v_id, 'po_number', v_po);
+END;
+$$;
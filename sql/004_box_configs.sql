@@ -0,0 +1,28 @@
+-- Configuración de cajas por finca (services/config_cajas.py).
+-- factor = fracción de una caja Full (EB 0.125, QB 0.25, HB 0.5, FB 1).
+-- '*' en farm_code / flower_type = aplica a todas. La fila más específica gana.
+
+CREATE TABLE IF NOT EXISTS box_configs (
+    id              bigint GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    farm_code       text    NOT NULL DEFAULT '*',
+    box_type        text    NOT NULL,
+    flower_type     text    NOT NULL DEFAULT '*',
+    factor          numeric NOT NULL CHECK (factor > 0),
+    bunches_per_box integer,
+    stems_per_bunch integer,
+    updated_at      timestamptz NOT NULL DEFAULT now(),
+    UNIQUE (farm_code, box_type, flower_type)
+);
+
+-- Estándar de la casa (lo mismo que CalculadoraFloral.FACTORES_CAJA)
+INSERT INTO box_configs (farm_code, box_type, flower_type, factor, bunches_per_box, stems_per_bunch) VALUES
+    ('*', 'EB', '*', 0.125, NULL, 25),
+    ('*', 'QB', '*', 0.25,  10,   25),
+    ('*', 'HB', '*', 0.5,   NULL, 25),
+    ('*', 'FB', '*', 1.0,   NULL, 25)
+ON CONFLICT (farm_code, box_type, flower_type) DO NOTHING;
+
+DROP TRIGGER IF EXISTS trg_box_configs_updated_at ON box_configs;
+CREATE TRIGGER trg_box_configs_updated_at
+    BEFORE UPDATE ON box_configs
+    FOR EACH ROW EXECUTE FUNCTION tocar_updated_at();
@@ -0,0 +1,28 @@
+-- Consecutivos atómicos (services/secuenciador.py -> Secuenciador._reservar_bloque).
+-- Reserva un bloque de p_cantidad números para p_tipo en UNA sentencia: dos procesos
+-- que piden a la vez nunca reciben el mismo número (el UPDATE toma el candado de la fila).
+-- Devuelve el ÚLTIMO número del bloque: el bloque es [fin - p_cantidad + 1, fin].
+-- Un tipo nuevo (finca nueva) arranca en 1, como antes.
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_secuencias_tipo ON secuencias (tipo);
+
+CREATE OR REPLACE FUNCTION fn_reservar_secuencia(p_tipo text, p_cantidad integer DEFAULT 1)
+RETURNS bigint
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_fin bigint;
+BEGIN
+    IF p_cantidad IS NULL OR p_cantidad < 1 THEN
+        RAISE EXCEPTION 'Cantidad inválida para la secuencia %: %', p_tipo, p_cantidad;
+    END IF;
+
+    INSERT INTO secuencias (tipo, ultimo_valor)
+    VALUES (p_tipo, p_cantidad)
+    ON CONFLICT (tipo) DO UPDATE
+        SET ultimo_valor = secuencias.ultimo_valor + EXCLUDED.ultimo_valor
+    RETURNING ultimo_valor INTO v_fin;
+
+    RETURN v_fin;
+END;
+$$;
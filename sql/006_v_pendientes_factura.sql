@@ -0,0 +1,18 @@
+-- Tablero de pendientes por facturar (services/orquestador.py -> /pendientes).
+-- Una fila por cliente con las órdenes Confirmed sin factura: la DB agrupa y el bot
+-- solo recibe la página que va a mostrar (antes bajaba todas las órdenes con sus items).
+
+CREATE INDEX IF NOT EXISTS idx_sales_orders_pendientes
+    ON sales_orders (customer_name)
+    WHERE status = 'Confirmed' AND invoice_id IS NULL;
+
+CREATE OR REPLACE VIEW v_pendientes_factura AS
+SELECT
+    COALESCE(NULLIF(customer_name, ''), 'Varios') AS customer_name,
+    COUNT(*)                                      AS pos_pendientes,
+    COALESCE(SUM(total_boxes), 0)                 AS total_cajas,
+    COALESCE(SUM(total_value), 0)                 AS total_valor
+FROM sales_orders
+WHERE status = 'Confirmed'
+  AND invoice_id IS NULL
+GROUP BY 1;
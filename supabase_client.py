@@ -13,15 +13,19 @@ HEADERS = {
     "Content-Type": "application/json"
 }
 
-def supabase_select(table: str, filters: dict = None):
+def supabase_select(table: str, filters: dict = None, timeout: float = 10):
     url = f"{SUPABASE_URL}/rest/v1/{table}"
     params = {}
 
     if filters:
+        # Sintaxis PostgREST: columna=eq.valor | columna=in.(a,b)
         for key, value in filters.items():
-            params[f"{key}.eq"] = value
+            if isinstance(value, (list, tuple, set)):
+                params[key] = "in.(" + ",".join(f'"{v}"' for v in value) + ")"
+            else:
+                params[key] = f"eq.{value}"
 
-    r = requests.get(url, headers=HEADERS, params=params)
+    r = requests.get(url, headers=HEADERS, params=params, timeout=timeout)
 
     if r.status_code != 200:
         return None